@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime
+from importlib import metadata
+from pathlib import Path
+from typing import Dict, List, Optional
+
+
+# Offline benchmarks of the lossmap scripts on a synthetic ring
+# =============================================================
+#
+# Usage: python benchmarks/run_benchmarks.py [--scenarios ...] [--engines black everest]
+#                                            [--particles 100 1000] [--turns 10 50] [--output results.json]
+#        python benchmarks/run_benchmarks.py --compare baseline.json results.json [--tolerance 0.2]
+#
+# Builds the synthetic ring of synthetic_ring.py and its colldb, prepares the collimated line per
+# engine (as submit.sh does for a study), and runs every scenario with every engine, particle count
+# and turn count in its own process, through the setup/run_task/teardown of the scripts. The
+# results file has the wall time, the per-phase times and the peak memory of the timing record of
+# every run (see scripts/timing.py), and the versions of the packages. Only xsuite is needed (no
+# Geant4, FLUKA, cvmfs or EOS), such that this runs on a laptop. With --compare, two results files
+# are matched run by run, and the exit code is 1 when a run got slower than the tolerance allows.
+
+BENCH_DIR = Path(__file__).resolve().parent
+REPO_DIR = BENCH_DIR.parent
+SCRIPTS_DIR = REPO_DIR / "scripts"
+
+SCENARIOS = ["fast_instability", "blowup", "pencil", "offmom"]
+ENGINES = ["black", "everest"]
+PACKAGES = ["numpy", "xobjects", "xdeps", "xpart", "xtrack", "xfields", "xcoll"]
+# The task every scenario runs (fixed, such that runs are comparable)
+TASK = {"fast_instability": {"plane": "H", "phase": 0}, "blowup": {"plane": "H"},
+        "pencil": {"plane": "H"}, "offmom": {"plane": "DPpos"}}
+SEED = 1
+
+
+def run_single(scenario: str, engine: str, particles: int, turns: int, machine: str, colldb: str) -> None:
+    # Runs in the benchmark subprocess, in its own working directory: one task of the scenario with
+    # the number of particles and turns overridden
+    sys.path.insert(0, str(SCRIPTS_DIR))
+    import worker
+    module = worker.load_runfile(SCRIPTS_DIR / f"{scenario}.py")
+    module.num_part = particles
+    module.num_turns = turns
+    if scenario == "fast_instability":
+        for plane_settings in module.settings.values():
+            for phase_settings in plane_settings.values():
+                phase_settings["n_turns"] = turns
+    state = module.setup(machine, colldb, engine, [TASK[scenario]], seed=SEED)
+    if "num_part" in state:
+        state["num_part"] = particles  # pencil.py chooses it per engine in setup()
+    module.run_task(state, **TASK[scenario], seed=SEED, outdir=".")
+    module.teardown(state)
+
+
+def versions() -> Dict[str, str]:
+    result = {}
+    for package in PACKAGES:
+        try:
+            result[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            result[package] = None
+    return result
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def prepare(workdir: Path, engines: List[str], python: str) -> tuple:
+    # Synthetic ring, colldb and the prepared line per engine (skipped when already there)
+    machine = workdir / "synthetic_ring.json"
+    colldb = workdir / "synthetic_ring.colldb.yaml"
+    if not machine.exists() or not colldb.exists():
+        subprocess.run([python, str(BENCH_DIR / "synthetic_ring.py"), str(workdir)], check=True)
+    for engine in engines:
+        subprocess.run([python, str(SCRIPTS_DIR / "prepared_line.py"), str(machine), str(colldb), engine], check=True)
+    return machine, colldb
+
+
+def run_benchmarks(args: argparse.Namespace) -> dict:
+    workdir = Path(args.workdir).resolve()
+    workdir.mkdir(parents=True, exist_ok=True)
+    machine, colldb = prepare(workdir, args.engines, args.python)
+    results = {"meta": {"date": datetime.now().isoformat(timespec="seconds"), "host": platform.node(),
+                        "python": platform.python_version(), "commit": git_commit(), "versions": versions(),
+                        "omp_threads": int(os.environ.get("OMP_NUM_THREADS", 1))},
+               "runs": []}
+    for scenario in args.scenarios:
+        for engine in args.engines:
+            for particles in args.particles:
+                for turns in args.turns:
+                    for repeat in range(args.repeat):
+                        name = f"{scenario}_{engine}_p{particles}_t{turns}_r{repeat}"
+                        rundir = workdir / "runs" / name
+                        rundir.mkdir(parents=True, exist_ok=True)
+                        start = time.time()
+                        with (rundir / "run.log").open("w") as log:
+                            proc = subprocess.run([args.python, str(Path(__file__).resolve()), "--single", scenario,
+                                                   engine, str(particles), str(turns), str(machine), str(colldb)],
+                                                  cwd=rundir, stdout=log, stderr=subprocess.STDOUT)
+                        wall = time.time() - start
+                        run = {"scenario": scenario, "engine": engine, "particles": particles, "turns": turns,
+                               "repeat": repeat, "returncode": proc.returncode, "wall": round(wall, 3)}
+                        timing_file = rundir / "timing.json"
+                        if proc.returncode == 0 and timing_file.exists():
+                            with timing_file.open() as fid:
+                                record = json.load(fid)
+                            run.update({kk: record[kk] for kk in ["phases", "total", "peak_rss_mb",
+                                                                  "peak_rss_children_mb"]})
+                        results["runs"].append(run)
+                        status = "ok" if proc.returncode == 0 else f"FAILED (see {rundir / 'run.log'})"
+                        print(f"{name:<40} {wall:8.1f}s  {run.get('peak_rss_mb', 0):8.0f}MB  {status}", flush=True)
+    return results
+
+
+def _key(run: dict) -> tuple:
+    return (run["scenario"], run["engine"], run["particles"], run["turns"])
+
+
+def _median(values: List[float]) -> float:
+    values = sorted(values)
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2
+
+
+def compare(baseline: dict, results: dict, tolerance: float) -> int:
+    # Median over the repeats of the wall time and of the tracking phase, per run key
+    def medians(data):
+        grouped = {}
+        for run in data["runs"]:
+            if run["returncode"] == 0:
+                grouped.setdefault(_key(run), []).append(run)
+        return {key: (_median([run["wall"] for run in runs]),
+                      _median([run.get("phases", {}).get("tracking", 0.) for run in runs]))
+                for key, runs in grouped.items()}
+
+    base = medians(baseline)
+    new = medians(results)
+    slower = 0
+    print(f"{'scenario':<18}{'engine':<9}{'particles':>10}{'turns':>7}{'wall':>10}{'ratio':>8}{'tracking':>10}{'ratio':>8}")
+    for key in sorted(set(base) | set(new)):
+        if key not in base or key not in new:
+            print(f"{key[0]:<18}{key[1]:<9}{key[2]:>10}{key[3]:>7}  only in {'baseline' if key in base else 'results'}")
+            continue
+        wall_ratio = new[key][0] / base[key][0] if base[key][0] > 0 else float("nan")
+        track_ratio = new[key][1] / base[key][1] if base[key][1] > 0 else float("nan")
+        flag = ""
+        if wall_ratio > 1 + tolerance or track_ratio > 1 + tolerance:
+            flag = "  SLOWER"
+            slower += 1
+        print(f"{key[0]:<18}{key[1]:<9}{key[2]:>10}{key[3]:>7}{new[key][0]:>9.1f}s{wall_ratio:>8.2f}"
+              f"{new[key][1]:>9.1f}s{track_ratio:>8.2f}{flag}")
+    print(f"\n{slower} run(s) slower than the tolerance of {tolerance:.0%}")
+    return 1 if slower else 0
+
+
+def main(argv=None) -> int:
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] == "--single":
+        scenario, engine, particles, turns, machine, colldb = argv[1:7]
+        run_single(scenario, engine, int(particles), int(turns), machine, colldb)
+        return 0
+
+    p = argparse.ArgumentParser(description="Benchmark the lossmap scripts on a synthetic ring.")
+    p.add_argument("--scenarios", nargs="+", default=SCENARIOS, choices=SCENARIOS)
+    p.add_argument("--engines", nargs="+", default=ENGINES, choices=ENGINES)
+    p.add_argument("--particles", nargs="+", type=int, default=[100, 1000])
+    p.add_argument("--turns", nargs="+", type=int, default=[10, 50])
+    p.add_argument("--repeat", type=int, default=1, help="Runs per combination (the comparison uses the median).")
+    p.add_argument("--workdir", default=str(BENCH_DIR / "work"),
+                   help="Directory for the synthetic ring, the prepared lines and the runs.")
+    p.add_argument("--output", default=None, help="Results file (default: <workdir>/results_<date>.json).")
+    p.add_argument("--python", default=sys.executable, help="Python of the xsuite environment to benchmark.")
+    p.add_argument("--compare", nargs=2, metavar=("BASELINE", "RESULTS"), default=None,
+                   help="Compare two results files instead of running.")
+    p.add_argument("--tolerance", type=float, default=0.2,
+                   help="Allowed relative slowdown in --compare before failing (default: 0.2).")
+    args = p.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as fid:
+            baseline = json.load(fid)
+        with open(args.compare[1]) as fid:
+            results = json.load(fid)
+        return compare(baseline, results, args.tolerance)
+
+    results = run_benchmarks(args)
+    output = Path(args.output) if args.output else \
+        Path(args.workdir) / f"results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    with output.open("w") as fid:
+        json.dump(results, fid, indent=1)
+    print(f"Results written to {output}")
+    failed = sum(run["returncode"] != 0 for run in results["runs"])
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,137 @@
+import sys
+import numpy as np
+from pathlib import Path
+from scipy.constants import c as clight
+
+import xtrack as xt
+
+
+# Synthetic ring for the benchmarks
+# =================================
+#
+# Usage: python benchmarks/synthetic_ring.py outdir
+#
+# Writes <outdir>/synthetic_ring.json (an environment with a line called like the FCC-ee line the
+# scripts load) and <outdir>/synthetic_ring.colldb.yaml. The ring is a FODO lattice with the FCC-ee
+# circumference and beam energy, built from thin elements only, such that the collimators of the
+# colldb and the blowups (installed at fixed s by blowup.py) always land in a drift. Bends have a
+# length for the radiation, there is one RF cavity, and every plane and phase has two
+# fast_instability_marker.<plane>.<phase>.<i> markers for fast_instability.py.
+
+line_name = 'fccee_p_ring'
+circumference = 90658.8
+num_cells = 120
+energy = 45.6e9
+tune_per_cell = 0.2425
+rf_voltage = 100e6
+rf_frequency = 400e6
+aperture = 0.035
+phases = [0, 30, 60, 90]
+
+# A subset of the FCC-ee betatron and momentum cleaning, at the same positions
+colldb_families = """\
+%YAML 1.2
+---
+All:
+  - &ALL     { parking: 0.030 }
+
+families:
+  - &TCPH   { <<: *ALL,  gap: 8,    stage: primary,     material: MoGR,  length: 0.25   }
+  - &TCSH   { <<: *ALL,  gap: 9.5,  stage: secondary,   material: Mo,    length: 0.3    }
+  - &TCPV   { <<: *ALL,  gap: 47.5, stage: primary,     material: MoGR,  length: 0.25,  angle: 90  }
+  - &TCSV   { <<: *ALL,  gap: 57.5, stage: secondary,   material: Mo,    length: 0.3,   angle: 90  }
+  - &TCPHP  { <<: *ALL,  gap: 15,   stage: primary,     material: MoGR,  length: 0.25   }
+  - &TCSHP  { <<: *ALL,  gap: 18,   stage: secondary,   material: Mo,    length: 0.3    }
+
+emittance:
+  x: 62.4659e-6  # gemitt_x = 0.7e-9
+  y: 0.23201e-6  # gemitt_y = 2.6e-12
+
+collimators:
+  b1:
+"""
+collimators = [
+    ('tcp.h.b1',   'TCPH',  0.25, 10488.25),
+    ('tcs.h1.b1',  'TCSH',  0.3,  10704.75),
+    ('tcs.h2.b1',  'TCSH',  0.3,  11591.65),
+    ('tcp.v.b1',   'TCPV',  0.25, 10644.55),
+    ('tcs.v1.b1',  'TCSV',  0.3,  10958.10),
+    ('tcs.v2.b1',  'TCSV',  0.3,  12019.80),
+    ('tcp.hp.b1',  'TCPHP', 0.25, 33659.20),
+    ('tcs.hp1.b1', 'TCSHP', 0.3,  34158.30),
+    ('tcs.hp2.b1', 'TCSHP', 0.3,  34702.55),
+]
+
+
+def build():
+    # Returns the environment and the s positions of the thin elements
+    cell_length = circumference / num_cells
+    half_cell = cell_length / 2
+    focal_length = half_cell / (2 * np.sin(np.pi * tune_per_cell))
+    bend_angle = 2 * np.pi / (2 * num_cells)
+    f_rev = clight / circumference  # Close enough for the harmonic number
+    env = xt.Environment(particle_ref=xt.Particles(mass0=xt.ELECTRON_MASS_EV, q0=1, p0c=energy))
+
+    # Markers for the exciters, spread over the ring
+    num_markers = 2 * 2 * len(phases)
+    marker_cells = {int(cell): ii for ii, cell in enumerate(np.linspace(5, num_cells - 5, num_markers))}
+
+    names = []
+    thin_s = []
+    def add(name, element, s):
+        env.elements[name] = element
+        names.append(name)
+        thin_s.append(s)
+    def drift(name):
+        # Every drift is its own element, such that inserting a collimator or blowup splits only that one
+        env.elements[name] = xt.Drift(length=cell_length / 4)
+        return name
+
+    add('rf.cavity', xt.Cavity(voltage=rf_voltage, frequency=round(rf_frequency / f_rev) * f_rev, lag=180), 0)
+    for cell in range(num_cells):
+        s0 = cell * cell_length
+        add(f'qf.{cell}.aper', xt.LimitEllipse(a=aperture, b=aperture), s0)
+        add(f'qf.{cell}', xt.Multipole(knl=[0, 1 / focal_length]), s0)
+        if cell in marker_cells:
+            ii = marker_cells[cell]
+            plane = 'h' if ii % 2 == 0 else 'v'
+            phase = phases[(ii // 2) % len(phases)]
+            add(f'fast_instability_marker.{plane}.{phase}.{ii // (2 * len(phases))}', xt.Marker(), s0)
+        names.append(drift(f'drift.{cell}.0'))
+        add(f'mb.{cell}.a', xt.Multipole(knl=[bend_angle], hxl=bend_angle, length=half_cell), s0 + cell_length / 4)
+        names.append(drift(f'drift.{cell}.1'))
+        add(f'qd.{cell}.aper', xt.LimitEllipse(a=aperture, b=aperture), s0 + half_cell)
+        # Slightly weaker, to split the tunes
+        add(f'qd.{cell}', xt.Multipole(knl=[0, -0.98 / focal_length]), s0 + half_cell)
+        names.append(drift(f'drift.{cell}.2'))
+        add(f'mb.{cell}.b', xt.Multipole(knl=[bend_angle], hxl=bend_angle, length=half_cell),
+            s0 + 3 * cell_length / 4)
+        names.append(drift(f'drift.{cell}.3'))
+    env.new_line(name=line_name, components=names)
+    return env, np.array(thin_s)
+
+
+def write_colldb(path, thin_s):
+    # Collimators straddling a thin element are shifted into the drift
+    lines = []
+    for name, family, length, s_center in collimators:
+        while np.any(np.abs(thin_s - s_center) < length / 2 + 0.1):
+            s_center += 1
+        lines.append(f"    {name + ':':<14}{{ <<: *{family + ',':<7} s_center: {s_center:.2f} }}")
+    with open(path, 'w') as fid:
+        fid.write(colldb_families + '\n'.join(lines) + '\n')
+
+
+def write(outdir):
+    outdir = Path(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    env, thin_s = build()
+    tw = env.lines[line_name].twiss()
+    print(f"Synthetic ring: length {tw.circumference:.1f}m, qx {tw.qx:.3f}, qy {tw.qy:.3f}, qs {tw.qs:.4f}")
+    env.to_json(outdir / 'synthetic_ring.json')
+    write_colldb(outdir / 'synthetic_ring.colldb.yaml', thin_s)
+    return outdir / 'synthetic_ring.json', outdir / 'synthetic_ring.colldb.yaml'
+
+
+if __name__ == "__main__":
+    write(sys.argv[1])
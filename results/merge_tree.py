@@ -0,0 +1,319 @@
+import os
+import re
+import sys
+import json
+import math
+import time
+import shutil
+import argparse
+import traceback
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+
+# Hierarchical (tree) merge of the job outputs of a study
+# =======================================================
+#
+# Usage: python merge_tree.py plan [--index jobs.index.json] [--study-dir ../studies/NAME] --fanin 64
+#                                  --out merge_graph.json [--dag merge.dag]
+#        python merge_tree.py run --graph merge_graph.json --study-dir ../studies/NAME [--workers 8]
+#        python merge_tree.py node --graph merge_graph.json --node ID --study-dir ../studies/NAME
+#
+# Per case, every leaf node merges the outputs of a block of fanin job_<step> directories into a
+# partial result in <case>/merge/L0_<i>/, every node of the next level merges fanin partial results
+# of the level below, and so on, until the single top node writes the merged lossmaps and
+# particles_dicts to the results and plots directories (with the same names and manifests as
+# postprocess.py, together with the timing tables), after which the partial results are removed. The graph is planned from the case step ranges in
+# the jobs.index.json of generate_jobs.py (or from the job directories of an existing study), and
+# can run locally on a process pool ('run', which starts every node as soon as its inputs are
+# done), or on HTCondor as a DAG next to the tracking jobs ('plan --dag', see submit.sh and
+# submission_scripts/merge.sub). With N jobs per case the merge takes log(N)/log(fanin) levels.
+
+merge_dir = 'merge'
+_job_dir_re = re.compile(r"job_(\d+)$")
+
+
+def node_id(case, level, index):
+    # Usable as DAG node name and in file names
+    return f'{case}__L{level}_{index}'
+
+
+def plan_case(case, first_step, last_step, fanin):
+    # Returns the nodes of the merge tree of one case, leaves first
+    num_leaves = max(1, math.ceil((last_step - first_step + 1) / fanin))
+    nodes = []
+    level_ids = []
+    for index in range(num_leaves):
+        lo = first_step + index * fanin
+        hi = min(lo + fanin - 1, last_step)
+        nodes.append({'id': node_id(case, 0, index), 'case': case, 'level': 0, 'index': index,
+                      'steps': [lo, hi], 'parents': []})
+        level_ids.append(nodes[-1]['id'])
+    level = 0
+    while len(level_ids) > 1:
+        level += 1
+        next_ids = []
+        for index in range(math.ceil(len(level_ids) / fanin)):
+            nodes.append({'id': node_id(case, level, index), 'case': case, 'level': level, 'index': index,
+                          'parents': level_ids[index * fanin:(index + 1) * fanin]})
+            next_ids.append(nodes[-1]['id'])
+        level_ids = next_ids
+    nodes[-1]['final'] = True
+    return nodes
+
+
+def plan(case_steps, fanin, s_bin=None, store=False):
+    # case_steps: {case: (first_step, last_step)}; with an s_bin, the top nodes also save the loss
+    # histograms of the particles_dicts (see postprocess.LossHistograms), and with store, they
+    # build the query store of the particles_dicts (see particle_store.py)
+    if fanin < 2:
+        raise ValueError("The fan-in of the merge tree must be at least 2!")
+    nodes = []
+    for case, (first_step, last_step) in case_steps.items():
+        nodes.extend(plan_case(case, first_step, last_step, fanin))
+    return {'fanin': fanin, 's_bin': s_bin, 'store': store, 'cases': {case: list(steps) for case, steps in case_steps.items()},
+            'nodes': nodes}
+
+
+def case_steps_from_index(index_file):
+    with open(index_file, 'r') as fid:
+        index = json.load(fid)
+    return {case: (info['first_step'], info['last_step']) for case, info in index['cases'].items()}
+
+
+def case_steps_from_study(study_dir):
+    case_steps = {}
+    for case_dir in sorted(pp for pp in Path(study_dir).iterdir() if pp.is_dir()):
+        steps = [int(mm.group(1)) for mm in (_job_dir_re.match(ee.name) for ee in os.scandir(case_dir)) if mm]
+        if steps:
+            case_steps[case_dir.name] = (min(steps), max(steps))
+    return case_steps
+
+
+def write_dag(graph, dag_file, name, path):
+    # One DAG node per merge node (submitted with merge.sub), below a NOOP node whose PRE script
+    # waits until the tracking clusters of the study are done
+    lines = ["# Tree merge of the job outputs, see results/merge_tree.py",
+             "JOB tracking merge.sub NOOP",
+             f"SCRIPT PRE tracking wait_tracking.sh {name}"]
+    for node in graph['nodes']:
+        lines.append(f"JOB {node['id']} merge.sub")
+        lines.append(f'VARS {node["id"]} NODE="{node["id"]}" NAME="{name}" PATH="{path}"')
+        lines.append(f"RETRY {node['id']} 2")
+    for node in graph['nodes']:
+        parents = node['parents'] if node['parents'] else ['tracking']
+        lines.append(f"PARENT {' '.join(parents)} CHILD {node['id']}")
+    with open(dag_file, 'w') as fid:
+        fid.write('\n'.join(lines) + '\n')
+
+
+def _inputs(study_dir, nodes, node):
+    # Output files of the jobs (leaves) or partial results (higher levels) to merge, per type
+    case_dir = Path(study_dir) / node['case']
+    if node['level'] == 0:
+        lo, hi = node['steps']
+        dirs = [case_dir / f'job_{step}' for step in range(lo, hi + 1)]
+    else:
+        dirs = [case_dir / merge_dir / f"L{nodes[pp]['level']}_{nodes[pp]['index']}" for pp in node['parents']]
+    lossmaps, particle_dicts = {}, {}
+    for dd in dirs:
+        if not dd.is_dir():
+            continue  # A job without outputs (yet), or a partial without any
+        for entry in os.scandir(dd):
+            if entry.name.endswith('.tmp'):
+                continue  # Left by an interrupted merge
+            stem, suffix = os.path.splitext(entry.name)
+            if entry.name.startswith('lossmap_') and suffix == '.json':
+                lossmaps.setdefault(stem, []).append(Path(entry.path))
+            elif entry.name.startswith('particles_dict_') and (suffix in ['.npz', '.json'] or entry.is_dir()):
+                particle_dicts.setdefault(stem if not entry.is_dir() else entry.name, []).append(Path(entry.path))
+    return lossmaps, particle_dicts
+
+
+def _accumulate(node, files):
+    # Leaves merge job outputs, higher levels partial results with the state of their statistics
+    import postprocess
+    if node['level'] == 0:
+        return postprocess.accumulate_lossmaps(files)
+    states = []
+    for file in files:
+        with file.with_name(f'stats_{file.name}').open('r') as fid:
+            states.append(json.load(fid))
+    return postprocess.accumulate_lossmaps(files, states)
+
+
+def run_node(graph, node_name, study_dir, result_path=None, plot_path=None, memory_budget_mb=256):
+    import postprocess  # Only here, such that planning does not need xsuite
+    import particle_store
+    study_dir = Path(study_dir).resolve()
+    nodes = {node['id']: node for node in graph['nodes']}
+    node = nodes[node_name]
+    lossmaps, particle_dicts = _inputs(study_dir, nodes, node)
+    case_dir = study_dir / node['case']
+    if node.get('final'):
+        result_path = Path(result_path) if result_path else study_dir.parents[1] / 'results'
+        plot_path = Path(plot_path) if plot_path else study_dir.parents[1] / 'plots'
+        output_name = f'{study_dir.name}_{node["case"]}_'
+        result_path.mkdir(parents=True, exist_ok=True)
+        plot_path.mkdir(parents=True, exist_ok=True)
+        # The job outputs in the steps of the tree, for the manifests of the merged results, such that
+        # postprocess.py --incremental only adds the jobs that finish later
+        first_step, last_step = graph['cases'][node['case']]
+        index = {kk: {ff: vv for ff, vv in files.items() if first_step <= int(ff.split('/')[0][4:]) <= last_step}
+                 for kk, files in postprocess.study_index(case_dir).items()}
+        for lm_type, files in lossmaps.items():
+            manifest_file = result_path / f'{output_name}{lm_type}.manifest.json'
+            if manifest_file.exists():
+                manifest_file.unlink()  # Until the new merged result is written
+            acc, job_stats = _accumulate(node, files)
+            lm = acc.to_lossmap(result_path / f'{output_name}{lm_type}.json')
+            lm.save_summary(result_path / f'{output_name}{lm_type}.out')
+            lm.plot(show=False, savefig=plot_path / f'{output_name}{lm_type}.pdf')
+            job_stats.write(result_path / f'{output_name}{lm_type}.stats')
+            postprocess._save_manifest(manifest_file, index.get(lm_type, {}))
+        for pd_type, files in particle_dicts.items():
+            merged = result_path / f'{output_name}{pd_type}'
+            manifest_file = result_path / f'{output_name}{pd_type}.manifest.json'
+            if manifest_file.exists():
+                manifest_file.unlink()
+            postprocess.merge_particle_dicts(files, merged, memory_budget_mb=memory_budget_mb, s_bin=graph.get('s_bin'))
+            if graph.get('store'):
+                particle_store.build_store(merged, memory_budget_mb=memory_budget_mb)
+            with (merged / 'header.json').open('r') as fid:
+                num_particles = json.load(fid)['num_particles']
+            postprocess._save_manifest(manifest_file, index.get(pd_type, {}), num_particles=num_particles)
+        postprocess.combine_timings(case_dir, output_name[:-1], result_path=result_path, index=index, verbose=False)
+        if (case_dir / merge_dir).is_dir():
+            shutil.rmtree(case_dir / merge_dir)
+    else:
+        out = case_dir / merge_dir / f"L{node['level']}_{node['index']}"
+        out.mkdir(parents=True, exist_ok=True)
+        for lm_type, files in lossmaps.items():
+            # The statistics first, as the lossmap (written to a temporary file first) marks the partial as done
+            acc, job_stats = _accumulate(node, files)
+            with (out / f'stats_{lm_type}.json').open('w') as fid:
+                json.dump(job_stats.state(), fid)
+            acc.to_json(out / f'{lm_type}.json')
+        for pd_type, files in particle_dicts.items():
+            postprocess.merge_particle_dicts(files, out / pd_type, memory_budget_mb=memory_budget_mb)
+    return sum(len(ff) for ff in lossmaps.values()) + sum(len(ff) for ff in particle_dicts.values())
+
+
+def _run_node_safe(graph, node_name, study_dir, result_path, plot_path, memory_budget_mb):
+    # Returns (node, seconds, error), with error None on success
+    start = time.time()
+    try:
+        run_node(graph, node_name, study_dir, result_path, plot_path, memory_budget_mb)
+    except Exception:
+        return node_name, time.time() - start, traceback.format_exc()
+    return node_name, time.time() - start, None
+
+
+def run_graph(graph, study_dir, result_path=None, plot_path=None, workers=1, memory_budget_mb=256):
+    # Every node starts as soon as all its parents are done; the descendants of a failed node are skipped
+    nodes = {node['id']: node for node in graph['nodes']}
+    children = {name: [] for name in nodes}
+    waiting = {}
+    for node in graph['nodes']:
+        waiting[node['id']] = len(node['parents'])
+        for pp in node['parents']:
+            children[pp].append(node['id'])
+    ready = [name for name, count in waiting.items() if count == 0]
+    failed, skipped = {}, []
+    done = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        running = {}
+        while ready or running:
+            for name in ready:
+                running[pool.submit(_run_node_safe, graph, name, study_dir, result_path, plot_path,
+                                    memory_budget_mb)] = name
+            ready = []
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                running.pop(future)
+                name, seconds, error = future.result()
+                if error:
+                    failed[name] = error
+                    stack = list(children[name])
+                    while stack:
+                        child = stack.pop()
+                        skipped.append(child)
+                        stack.extend(children[child])
+                    print(f"FAILED {name} in {seconds:.1f}s", flush=True)
+                    continue
+                done += 1
+                print(f"done   {name} in {seconds:.1f}s ({done}/{len(nodes)})", flush=True)
+                for child in children[name]:
+                    waiting[child] -= 1
+                    if waiting[child] == 0 and child not in skipped:
+                        ready.append(child)
+    return failed, skipped
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Hierarchical merge of the job outputs of a study.")
+    sub = parser.add_subparsers(dest='command', required=True)
+    p_plan = sub.add_parser('plan', help="Plan the merge tree.")
+    p_plan.add_argument('--index', default=None, help="jobs.index.json of generate_jobs.py.")
+    p_plan.add_argument('--study-dir', default=None,
+                        help="Existing study directory (studies/NAME); with --index, the step ranges are combined "
+                             "(for resumed studies).")
+    p_plan.add_argument('--fanin', type=int, default=64, help="Inputs per merge node (default: 64).")
+    p_plan.add_argument('--out', default='merge_graph.json', help="Graph file (default: merge_graph.json).")
+    p_plan.add_argument('--histograms', type=float, default=None, metavar='S_BIN',
+                        help="Also save the loss histograms of the particles_dicts, in s bins of S_BIN metres.")
+    p_plan.add_argument('--store', action='store_true',
+                        help="Also build the query store of the particles_dicts (see particle_store.py).")
+    p_plan.add_argument('--dag', default=None, help="Also write an HTCondor DAG for merge.sub.")
+    p_plan.add_argument('--name', default=None, help="Study name (for --dag).")
+    p_plan.add_argument('--path', default=None, help="Study path (for --dag).")
+    p_run = sub.add_parser('run', help="Run the merge tree locally on a process pool.")
+    p_run.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    p_node = sub.add_parser('node', help="Run a single node of the merge tree.")
+    p_node.add_argument('--node', required=True)
+    for p_sub in [p_run, p_node]:
+        p_sub.add_argument('--graph', default='merge_graph.json')
+        p_sub.add_argument('--study-dir', required=True, help="Study directory (studies/NAME).")
+        p_sub.add_argument('--result-path', default=None, help="Default: results/ next to studies/.")
+        p_sub.add_argument('--plot-path', default=None, help="Default: plots/ next to studies/.")
+        p_sub.add_argument('--memory-budget-mb', type=float, default=256,
+                           help="Buffer of the particles_dict merge (default: 256).")
+    args = parser.parse_args()
+
+    if args.command == 'plan':
+        if not args.index and not args.study_dir:
+            parser.error("plan needs --index and/or --study-dir")
+        case_steps = {}
+        for steps in [case_steps_from_index(args.index) if args.index else {},
+                      case_steps_from_study(args.study_dir) if args.study_dir and Path(args.study_dir).is_dir() else {}]:
+            for case, (first_step, last_step) in steps.items():
+                if case in case_steps:
+                    first_step = min(first_step, case_steps[case][0])
+                    last_step = max(last_step, case_steps[case][1])
+                case_steps[case] = (first_step, last_step)
+        graph = plan(case_steps, args.fanin, args.histograms, args.store)
+        with open(args.out, 'w') as fid:
+            json.dump(graph, fid, indent=1)
+        levels = max((node['level'] for node in graph['nodes']), default=-1) + 1
+        print(f"Merge tree of {len(graph['nodes'])} nodes in {levels} levels written to {args.out}")
+        if args.dag:
+            if not args.name or not args.path:
+                parser.error("--dag needs --name and --path")
+            write_dag(graph, args.dag, args.name, args.path)
+            print(f"DAG written to {args.dag}")
+    else:
+        with open(args.graph, 'r') as fid:
+            graph = json.load(fid)
+        if args.command == 'node':
+            num_inputs = run_node(graph, args.node, args.study_dir, args.result_path, args.plot_path,
+                                  args.memory_budget_mb)
+            print(f"Merged {num_inputs} inputs for {args.node}")
+        else:
+            start = time.time()
+            failed, skipped = run_graph(graph, args.study_dir, args.result_path, args.plot_path, args.workers,
+                                        args.memory_budget_mb)
+            print(f"\nMerge tree done in {time.time()-start:.1f}s: {len(failed)} failed, {len(skipped)} skipped")
+            for name, error in failed.items():
+                print(f"\n{name}:\n{error}")
+            if failed:
+                sys.exit(1)
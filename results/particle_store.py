@@ -0,0 +1,227 @@
+import sys
+import json
+import shutil
+import argparse
+import numpy as np
+from pathlib import Path
+
+
+# Query store of the merged lost particles
+# ========================================
+#
+# Usage: python particle_store.py build ../results/STUDY_CASE_particles_dict_B1H [--memory-budget-mb 256]
+#        python particle_store.py query ../results/STUDY_CASE_particles_dict_B1H [--s 100 200] [--element 1234]
+#                                      [--turns 0 10] [--state lost]
+#
+# A merged particles_dict (see postprocess.py) has its columns in job order, so any selection needs
+# a full pass over them. The store (in the store/ directory of the merged result) has the same
+# columns sorted by s (and by at_element at equal s), as .npy files that are memory-mapped, with
+# three small indices: the rows of every element, and the rows of every turn (a permutation of the
+# rows sorted by at_turn, with the offset of every turn). Selections by s range or element are
+# then a slice of the columns (numpy views of the mapped files, nothing is copied), and selections
+# by turns only read the rows of those turns:
+#
+#     store = LossStore('../results/STUDY_CASE_particles_dict_B1H')
+#     data = store.query(s=(10400, 10500), turns=(0, 20), state='lost')
+#
+# Building sorts the s column in memory (16 bytes per particle); the columns are permuted in
+# chunks of memory_budget_mb. The store is rebuilt when the merged result changed since.
+
+store_dir = 'store'
+store_version = 1
+
+
+def _merged_columns(path):
+    # Memory-mapped columns of a merged result (the format of postprocess.write_particle_dict)
+    with (Path(path) / 'header.json').open('r') as fp:
+        header = json.load(fp)
+    return {kk: np.load(Path(path) / f'{kk}.npy', mmap_mode='r') for kk in header['columns']}, header['num_particles']
+
+
+def _index_dtype(num_rows):
+    return np.int32 if num_rows < 2**31 else np.int64
+
+
+def is_current(path):
+    # Whether the store of a merged result exists and covers all its particles
+    path = Path(path)
+    try:
+        with (path / store_dir / 'store.json').open('r') as fp:
+            meta = json.load(fp)
+        with (path / 'header.json').open('r') as fp:
+            header = json.load(fp)
+    except (OSError, ValueError):
+        return False
+    return meta.get('version') == store_version and meta['num_particles'] == header['num_particles']
+
+
+def build_store(path, *, memory_budget_mb=256):
+    # Build the store of a merged result (written next to it and moved in place at the end)
+    path = Path(path)
+    columns, num_rows = _merged_columns(path)
+    for kk in ['s', 'at_element', 'at_turn']:
+        if kk not in columns:
+            raise ValueError(f"Merged particles_dict {path} has no column {kk}!")
+    tmp = path / f'{store_dir}.tmp'
+    if tmp.exists():
+        shutil.rmtree(tmp)
+    tmp.mkdir()
+    idx_dtype = _index_dtype(num_rows)
+
+    # Order by s, and by element at equal s (stable sorts, so the job order is kept within an element)
+    order = np.argsort(columns['at_element'], kind='stable').astype(idx_dtype)
+    order = order[np.argsort(columns['s'][order], kind='stable')]
+
+    chunk_rows = max(1, int(memory_budget_mb * 1024**2) // max(1, sum(vv.itemsize for vv in columns.values())))
+    for kk, vv in columns.items():
+        out = np.lib.format.open_memmap(tmp / f'{kk}.npy', mode='w+', dtype=vv.dtype, shape=(num_rows,))
+        for start in range(0, num_rows, chunk_rows):
+            rows = order[start:start + chunk_rows]
+            # Sorted reads are much faster on a mapped file; the values are put back in the s order
+            sorted_rows = np.argsort(rows)
+            out[start:start + len(rows)][sorted_rows] = vv[rows[sorted_rows]]
+        out.flush()
+        del out
+    del order
+    sorted_columns = {kk: np.load(tmp / f'{kk}.npy', mmap_mode='r') for kk in columns}
+
+    # Rows of every element: a range of rows when they are contiguous (the usual case, as the
+    # losses of an element are in its s range), else a list of rows
+    element_order = np.argsort(sorted_columns['at_element'], kind='stable').astype(idx_dtype)
+    elements, starts = np.unique(sorted_columns['at_element'][element_order], return_index=True)
+    ends = np.append(starts[1:], num_rows)
+    first = element_order[starts] if num_rows else np.zeros(0, dtype=idx_dtype)
+    last = element_order[ends - 1] if num_rows else np.zeros(0, dtype=idx_dtype)
+    contiguous = (last - first + 1) == (ends - starts)
+    np.save(tmp / 'element_order.npy', element_order)
+    np.savez(tmp / 'elements.npz', element=elements, first=first, stop=last + 1, contiguous=contiguous,
+             offset=starts, end=ends)
+    del element_order
+
+    # Rows of every turn, in the s order within the turn
+    by_turn = np.argsort(sorted_columns['at_turn'], kind='stable').astype(idx_dtype)
+    turns, turn_starts = np.unique(sorted_columns['at_turn'][by_turn], return_index=True)
+    np.save(tmp / 'by_turn.npy', by_turn)
+    np.savez(tmp / 'turns.npz', turn=turns, start=turn_starts, end=np.append(turn_starts[1:], num_rows))
+    del by_turn, sorted_columns
+
+    with (tmp / 'store.json').open('w') as fp:
+        json.dump({'version': store_version, 'num_particles': num_rows,
+                   'columns': {kk: str(vv.dtype) for kk, vv in columns.items()}, 'sorted_by': ['s', 'at_element']},
+                  fp, indent=1)
+    if (path / store_dir).exists():
+        shutil.rmtree(path / store_dir)
+    tmp.rename(path / store_dir)
+
+
+class LossStore:
+    def __init__(self, path):
+        # path is a merged result (with a store/) or the store directory itself
+        path = Path(path)
+        if (path / store_dir).is_dir():
+            path = path / store_dir
+        with (path / 'store.json').open('r') as fp:
+            self.meta = json.load(fp)
+        self.path = path
+        self.columns = {kk: np.load(path / f'{kk}.npy', mmap_mode='r') for kk in self.meta['columns']}
+        self.by_turn = np.load(path / 'by_turn.npy', mmap_mode='r')
+        self.element_order = np.load(path / 'element_order.npy', mmap_mode='r')
+        with np.load(path / 'turns.npz') as data:
+            self.turns = {kk: data[kk] for kk in data.files}
+        with np.load(path / 'elements.npz') as data:
+            self.elements = {kk: data[kk] for kk in data.files}
+
+    def __len__(self):
+        return self.meta['num_particles']
+
+    def s_rows(self, s_min=None, s_max=None):
+        # Slice of the rows with s_min <= s <= s_max
+        s = self.columns['s']
+        start = 0 if s_min is None else int(np.searchsorted(s, s_min, side='left'))
+        stop = len(self) if s_max is None else int(np.searchsorted(s, s_max, side='right'))
+        return slice(start, max(start, stop))
+
+    def element_rows(self, element):
+        # Slice (or array, when not contiguous) of the rows lost at an element (at_element)
+        ii = int(np.searchsorted(self.elements['element'], element))
+        if ii == len(self.elements['element']) or self.elements['element'][ii] != element:
+            return slice(0, 0)
+        if self.elements['contiguous'][ii]:
+            return slice(int(self.elements['first'][ii]), int(self.elements['stop'][ii]))
+        return self.element_order[self.elements['offset'][ii]:self.elements['end'][ii]]
+
+    def turn_rows(self, turn_min, turn_max=None):
+        # Rows (a view of the turn index, in s order per turn) lost in turn_min <= at_turn <= turn_max
+        turn_max = turn_min if turn_max is None else turn_max
+        lo = int(np.searchsorted(self.turns['turn'], turn_min, side='left'))
+        hi = int(np.searchsorted(self.turns['turn'], turn_max, side='right'))
+        if hi <= lo:
+            return self.by_turn[0:0]
+        return self.by_turn[self.turns['start'][lo]:self.turns['end'][hi - 1]]
+
+    @staticmethod
+    def _state_mask(state, values):
+        if state == 'lost':
+            return values < 1
+        if state == 'alive':
+            return values > 0
+        return np.isin(values, np.atleast_1d(state))
+
+    def query(self, *, s=None, element=None, turns=None, state=None, columns=None):
+        # Columns of the particles with s in [s[0], s[1]], lost at element, in turns (an int or an
+        # inclusive range) and with a state ('lost', 'alive', a state or a list of states). Selections
+        # by s and element only are views of the mapped columns; the others are copies of the
+        # selected rows only.
+        rows = slice(0, len(self)) if s is None else self.s_rows(*s)
+        if element is not None:
+            er = self.element_rows(element)
+            if isinstance(er, slice):
+                rows = slice(max(rows.start, er.start), max(max(rows.start, er.start), min(rows.stop, er.stop)))
+            else:
+                rows = np.asarray(er)[(er >= rows.start) & (er < rows.stop)]
+        if turns is not None:
+            turn_min, turn_max = (turns, turns) if np.isscalar(turns) else turns
+            if isinstance(rows, slice):
+                tr = self.turn_rows(turn_min, turn_max)
+                if rows.stop - rows.start <= len(tr):
+                    at_turn = self.columns['at_turn'][rows]
+                    rows = rows.start + np.flatnonzero((at_turn >= turn_min) & (at_turn <= turn_max))
+                else:
+                    rows = np.sort(tr[(tr >= rows.start) & (tr < rows.stop)])
+            else:
+                at_turn = self.columns['at_turn'][rows]
+                rows = rows[(at_turn >= turn_min) & (at_turn <= turn_max)]
+        if state is not None:
+            mask = self._state_mask(state, self.columns['state'][rows])
+            rows = (rows.start + np.flatnonzero(mask)) if isinstance(rows, slice) else rows[mask]
+        return {kk: self.columns[kk][rows] for kk in (columns or self.columns)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Indexed, memory-mapped store of a merged particles_dict.")
+    sub = parser.add_subparsers(dest='command', required=True)
+    p_build = sub.add_parser('build', help="Build the store of a merged particles_dict.")
+    p_build.add_argument('path', help="Merged particles_dict directory.")
+    p_build.add_argument('--memory-budget-mb', type=float, default=256, help="Buffer of the permutation (default: 256).")
+    p_query = sub.add_parser('query', help="Count and summarise the particles of a selection.")
+    p_query.add_argument('path', help="Merged particles_dict directory.")
+    p_query.add_argument('--s', nargs=2, type=float, default=None, metavar=('S_MIN', 'S_MAX'))
+    p_query.add_argument('--element', type=int, default=None)
+    p_query.add_argument('--turns', nargs=2, type=int, default=None, metavar=('TURN_MIN', 'TURN_MAX'))
+    p_query.add_argument('--state', default=None, help="'lost', 'alive', or a state.")
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        build_store(args.path, memory_budget_mb=args.memory_budget_mb)
+        print(f"Store of {args.path} built")
+    else:
+        if not is_current(args.path):
+            print(f"No current store for {args.path}, build it first!")
+            sys.exit(1)
+        state = args.state if args.state in [None, 'lost', 'alive'] else int(args.state)
+        data = LossStore(args.path).query(s=args.s, element=args.element, turns=args.turns, state=state)
+        num = len(data['s'])
+        print(f"{num} particles")
+        if num and 'energy' in data:
+            print(f"energy: {float(np.sum(data['energy'])):.6e}  s: [{float(data['s'].min()):.3f}, "
+                  f"{float(data['s'].max()):.3f}]  turns: [{int(data['at_turn'].min())}, {int(data['at_turn'].max())}]")
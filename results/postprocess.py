@@ -1,18 +1,387 @@
+import os
 import sys
 import json
+import shutil
 import numpy as np
 from pathlib import Path
 
 import matplotlib
 matplotlib.use("Agg")  # headless, no Tk, to avoid issues with parallellisation
 
-import xobjects as xo
 import xtrack as xt
 import xcoll as xc
 
+import particle_store
 
-def combine_lossmaps(study_path, output_name=None, *, result_path=None, plot_path=None, verbose=True):
-    # Combine loss map files and plot
+
+# Index of the job outputs of a case
+# ==================================
+#
+# One os.scandir walk over the job_* directories of a case gives every output file with its size
+# and modification time, grouped per output type (lossmap_*, particles_dict_* or timing), and is
+# shared by all combiners (and by the manifests of the incremental mode). The index is saved in
+# the case directory with the modification time of every job directory; a later run only rescans
+# the job directories whose modification time changed (a file was added, removed or renamed into
+# place), which is one stat per directory instead of listing all of them. Use refresh=True (or
+# --refresh-index) after files were rewritten in place.
+
+index_file = 'file_index.json'
+index_version = 1
+
+
+def output_type(name):
+    # Output type of a file in a job directory, or None for other files
+    stem, suffix = os.path.splitext(name)
+    if name.startswith('lossmap_') and suffix == '.json':
+        return stem
+    if name.startswith('particles_dict_') and suffix in ['.npz', '.json']:
+        return stem
+    if name == 'timing.json':
+        return 'timing'
+    return None
+
+
+def _scan_job(path):
+    # {file name: [size, mtime_ns]} of the outputs in a job directory
+    outputs = {}
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if output_type(entry.name) is not None and entry.is_file():
+                st = entry.stat()
+                outputs[entry.name] = [st.st_size, st.st_mtime_ns]
+    return outputs
+
+
+def study_index(study_path, *, refresh=False, save=True):
+    # Returns {output type: {file relative to the case: [size, mtime_ns]}} of a case
+    study_path = Path(study_path).resolve()
+    saved = None if refresh else _load_manifest(study_path / index_file)
+    saved_jobs = saved['jobs'] if saved and saved.get('version') == index_version else {}
+    jobs = {}
+    changed = False
+    with os.scandir(study_path) as entries:
+        for entry in entries:
+            if not entry.name.startswith('job_') or not entry.is_dir():
+                continue
+            mtime = entry.stat().st_mtime_ns
+            job = saved_jobs.get(entry.name)
+            if job is None or job['mtime'] != mtime:
+                job = {'mtime': mtime, 'files': _scan_job(entry.path)}
+                changed = True
+            jobs[entry.name] = job
+    if save and (changed or len(jobs) != len(saved_jobs)):
+        tmp = study_path / f'{index_file}.tmp'
+        with tmp.open('w') as fp:
+            json.dump({'version': index_version, 'jobs': jobs}, fp)
+        tmp.replace(study_path / index_file)
+    index = {}
+    for job_name in sorted(jobs):
+        for name, stat in sorted(jobs[job_name]['files'].items()):
+            index.setdefault(output_type(name), {})[f'{job_name}/{name}'] = stat
+    return index
+
+
+def _files(study_path, index, prefix):
+    # Files of the output types starting with prefix, as {type: [paths]}
+    study_path = Path(study_path).resolve()
+    if index is None:
+        index = study_index(study_path)
+    return {kk: [study_path / ff for ff in vv] for kk, vv in index.items() if kk.startswith(prefix)}
+
+
+def lossmap_files(study_path, index=None):
+    # Lossmap files of a case per lossmap type (the file stem, like lossmap_B1H)
+    return _files(study_path, index, 'lossmap_')
+
+
+# Streaming lossmap merge
+# =======================
+#
+# A lossmap JSON file (LossMap.to_json) has a 'collimator' and an 'aperture' section with one row
+# per collimator and per aperture bin, as lists of equal length ('name', 's', 'length', ...), of
+# which the loss counts ('n', and 'e' for the energy) are additive. The rest (machine length,
+# interpolation, momentum, cold and warm regions, ...) describes the line and is the same for all
+# jobs of a case. LossMapAccumulator sums the counts of one file at a time into arrays with one
+# entry per row seen so far, so its memory depends on the number of collimators and bins and not
+# on the number of jobs. Its state is a valid lossmap at any point (lossmap(), to_json()), which
+# LossMap.from_json reads back as usual (to_lossmap()).
+
+lossmap_sections = ['collimator', 'aperture']
+lossmap_counts = ['n', 'e']
+# Fields identifying a row (the name of a collimator, the position of an aperture bin)
+lossmap_keys = ['name', 's']
+# Must be the same in all files
+lossmap_compatible = ['machine_length', 'interpolation', 'reversed', 'momentum']
+
+
+class LossMapAccumulator:
+    def __init__(self):
+        self.meta = None
+        self.num_files = 0
+        self.rows = {sec: {} for sec in lossmap_sections}   # row key -> row
+        self.info = {sec: {} for sec in lossmap_sections}   # field -> list of the per-row values
+        self.counts = {sec: {} for sec in lossmap_sections}  # count -> array (with spare capacity)
+
+    def num_rows(self, section):
+        return len(self.rows[section])
+
+    def _grow(self, section, size):
+        for kk, vv in self.counts[section].items():
+            if len(vv) < size:
+                grown = np.zeros(max(size, 2 * len(vv)), dtype=vv.dtype)
+                grown[:len(vv)] = vv
+                self.counts[section][kk] = grown
+
+    def add(self, lossmap, file=None):
+        # Add a lossmap dict. Returns {section: (rows of the file in the accumulated arrays,
+        # {count: values})}, for statistics over the files.
+        if self.meta is None:
+            self.meta = {kk: vv for kk, vv in lossmap.items() if kk not in lossmap_sections}
+        else:
+            for kk in lossmap_compatible:
+                if kk in self.meta and lossmap.get(kk) != self.meta[kk]:
+                    raise ValueError(f"Lossmap {file or ''} has another {kk} ({lossmap.get(kk)}) than the "
+                                     + f"accumulated ones ({self.meta[kk]})!")
+        added = {}
+        for sec in lossmap_sections:
+            data = lossmap.get(sec)
+            if not data:
+                continue
+            keys = [kk for kk in lossmap_keys if kk in data]
+            length = len(data[keys[0]]) if keys else 0
+            aligned = [kk for kk, vv in data.items() if isinstance(vv, list) and len(vv) == length]
+            rows = np.empty(length, dtype=np.int64)
+            known = self.rows[sec]
+            for ii, key in enumerate(zip(*(data[kk] for kk in keys))):
+                row = known.get(key)
+                if row is None:
+                    row = known[key] = len(known)
+                    for kk in aligned:
+                        if kk not in lossmap_counts:
+                            self.info[sec].setdefault(kk, []).append(data[kk][ii])
+                rows[ii] = row
+            values = {}
+            for kk in lossmap_counts:
+                if kk not in aligned:
+                    continue
+                vv = np.asarray(data[kk])
+                if kk not in self.counts[sec]:
+                    dtype = np.int64 if vv.dtype.kind in 'iub' else np.float64
+                    self.counts[sec][kk] = np.zeros(len(known), dtype=dtype)
+                self._grow(sec, len(known))
+                np.add.at(self.counts[sec][kk], rows, vv)
+                values[kk] = vv
+            added[sec] = (rows, values)
+        self.num_files += 1
+        return added
+
+    def add_file(self, file):
+        with Path(file).open('r') as fp:
+            return self.add(json.load(fp), file=file)
+
+    def lossmap(self):
+        # The accumulated lossmap, in the format of LossMap.to_json
+        if self.meta is None:
+            raise ValueError("No lossmaps accumulated!")
+        lossmap = dict(self.meta)
+        for sec in lossmap_sections:
+            if not self.rows[sec]:
+                continue
+            num_rows = self.num_rows(sec)
+            lossmap[sec] = {kk: list(vv) for kk, vv in self.info[sec].items()}
+            for kk, vv in self.counts[sec].items():
+                lossmap[sec][kk] = vv[:num_rows].tolist()
+        return lossmap
+
+    def to_json(self, file):
+        # Written to a temporary file first, such that readers never see a partial file
+        file = Path(file)
+        tmp = file.with_name(f'{file.name}.tmp')
+        with tmp.open('w') as fp:
+            json.dump(self.lossmap(), fp)
+        tmp.replace(file)
+
+    def to_lossmap(self, file):
+        # A LossMap of the accumulated state (written to file, which LossMap reads)
+        self.to_json(file)
+        return xc.LossMap.from_json(file)
+
+
+# Statistics over the jobs
+# ========================
+#
+# The spread of the losses between jobs tells whether a study has enough jobs. LossMapStatistics
+# follows the accumulator and keeps, per collimator and per aperture bin, the running mean and sum
+# of squared deviations (Welford) of the loss fraction of every job (its losses there over all its
+# losses), updated for all rows at once with every job. The same is kept for the fractions of all
+# collimators, of the cold aperture (in the cold regions of the lossmap) and of the warm aperture.
+# States of separate merges combine exactly (Chan et al.), which the merge tree uses. The table
+# has the standard error and 95% confidence interval of every fraction, and the number of jobs
+# needed to reach the requested relative precision (standard error over mean). The adaptive
+# studies (submission_scripts/adaptive_study.py) stop once the relative errors of the rows of
+# convergence() are below their target.
+
+stats_totals = ['all collimators', 'cold', 'warm']
+
+
+def _welford_merge(na, mean_a, m2_a, nb, mean_b, m2_b):
+    # Combined mean and sum of squared deviations of two sets of na and nb samples (in place in a)
+    num = na + nb
+    if num == 0:
+        return
+    delta = mean_b - mean_a
+    mean_a += delta * nb / num
+    m2_a += m2_b + delta**2 * na * nb / num
+
+
+class LossMapStatistics:
+    def __init__(self, acc):
+        self.acc = acc
+        self.num_jobs = 0
+        self.mean = {sec: np.zeros(0) for sec in lossmap_sections}
+        self.m2 = {sec: np.zeros(0) for sec in lossmap_sections}
+        self.total_mean = np.zeros(len(stats_totals))
+        self.total_m2 = np.zeros(len(stats_totals))
+
+    def _grow(self):
+        # Rows that appear now had a fraction of 0 in all earlier jobs, so their mean and m2 are 0
+        for sec in lossmap_sections:
+            size = self.acc.num_rows(sec)
+            for arrays in [self.mean, self.m2]:
+                if len(arrays[sec]) < size:
+                    arrays[sec] = np.concatenate([arrays[sec], np.zeros(size - len(arrays[sec]))])
+
+    def cold(self):
+        # Mask of the cold aperture bins
+        s = np.array(self.acc.info['aperture'].get('s', []), dtype=float)
+        mask = np.zeros(len(s), dtype=bool)
+        for start, end in (self.acc.meta or {}).get('cold_regions') or []:
+            mask |= (s >= start) & (s <= end)
+        return mask
+
+    def add(self, added):
+        # Add one job, from the return value of LossMapAccumulator.add
+        self._grow()
+        self.num_jobs += 1
+        total = sum(float(np.sum(values['n'])) for _, values in added.values() if 'n' in values)
+        fractions = {}
+        for sec in lossmap_sections:
+            fractions[sec] = np.zeros(len(self.mean[sec]))
+            if sec in added and 'n' in added[sec][1] and total > 0:
+                rows, values = added[sec]
+                np.add.at(fractions[sec], rows, values['n'] / total)
+        cold = self.cold()
+        totals = np.array([fractions['collimator'].sum(), fractions['aperture'][cold].sum(),
+                           fractions['aperture'][~cold].sum()])
+        for mean, m2, xx in [*[(self.mean[sec], self.m2[sec], fractions[sec]) for sec in lossmap_sections],
+                             (self.total_mean, self.total_m2, totals)]:
+            delta = xx - mean
+            mean += delta / self.num_jobs
+            m2 += delta * (xx - mean)
+
+    def state(self):
+        return {'num_jobs': self.num_jobs,
+                'rows': {sec: [list(key) for key in self.acc.rows[sec]] for sec in lossmap_sections},
+                'mean': {sec: self.mean[sec].tolist() for sec in lossmap_sections},
+                'm2': {sec: self.m2[sec].tolist() for sec in lossmap_sections},
+                'total_mean': self.total_mean.tolist(), 'total_m2': self.total_m2.tolist()}
+
+    def merge_state(self, state):
+        # Combine with the state of the statistics of other jobs, whose rows must be in the accumulator
+        self._grow()
+        nb = state['num_jobs']
+        for sec in lossmap_sections:
+            rows = np.array([self.acc.rows[sec][tuple(key)] for key in state['rows'][sec]], dtype=np.int64)
+            mean_b = np.zeros(len(self.mean[sec]))
+            m2_b = np.zeros(len(self.m2[sec]))
+            mean_b[rows] = state['mean'][sec]
+            m2_b[rows] = state['m2'][sec]
+            _welford_merge(self.num_jobs, self.mean[sec], self.m2[sec], nb, mean_b, m2_b)
+        _welford_merge(self.num_jobs, self.total_mean, self.total_m2, nb, np.array(state['total_mean']),
+                       np.array(state['total_m2']))
+        self.num_jobs += nb
+
+    def table(self, precision=0.1):
+        # Rows of (name, s, mean, std) for the totals, the peak cold and warm bins, and the collimators
+        entries = [(name, None, self.total_mean[ii], self.total_m2[ii]) for ii, name in enumerate(stats_totals)]
+        cold = self.cold()
+        for label, mask in [('peak cold', cold), ('peak warm', ~cold)]:
+            if np.any(mask):
+                row = np.flatnonzero(mask)[np.argmax(self.mean['aperture'][mask])]
+                entries.append((label, self.acc.info['aperture']['s'][row], self.mean['aperture'][row],
+                                self.m2['aperture'][row]))
+        info = self.acc.info['collimator']
+        for row in np.argsort(-self.mean['collimator']):
+            if self.mean['collimator'][row] > 0:
+                entries.append((info['name'][row], info['s'][row] if 's' in info else None,
+                                self.mean['collimator'][row], self.m2['collimator'][row]))
+        table = []
+        for name, s, mean, m2 in entries:
+            std = np.sqrt(m2 / (self.num_jobs - 1)) if self.num_jobs > 1 else float('nan')
+            stderr = std / np.sqrt(self.num_jobs) if self.num_jobs > 0 else float('nan')
+            needed = int(np.ceil((std / (precision * mean))**2)) if mean > 0 and np.isfinite(std) else None
+            table.append({'name': name, 's': s, 'mean': float(mean), 'std': float(std), 'stderr': float(stderr),
+                          'ci95': [float(mean - 1.96 * stderr), float(mean + 1.96 * stderr)],
+                          'rel_err': float(stderr / mean) if mean > 0 else None, 'jobs_needed': needed})
+        return table
+
+    def convergence(self, min_fraction=0.01):
+        # The rows of the table that decide whether there are enough jobs: the peak cold and warm
+        # bins (when they have losses), and the collimators with at least min_fraction of the losses
+        # on all collimators
+        table = self.table()
+        total = table[0]['mean']
+        return [row for row in table[len(stats_totals):] if row['mean'] > 0
+                and (row['name'] in ['peak cold', 'peak warm'] or row['mean'] >= min_fraction * total)]
+
+    def worst_rel_err(self, min_fraction=0.01):
+        # Largest relative error of the rows of convergence() (inf while it cannot be estimated)
+        rows = self.convergence(min_fraction)
+        if not rows or self.num_jobs < 2:
+            return float('inf')
+        return max(float('inf') if row['rel_err'] is None else row['rel_err'] for row in rows)
+
+    def write(self, path, precision=0.1):
+        # <path>.out with the table, <path>.json with the table and the state (to continue from)
+        path = Path(path)
+        table = self.table(precision)
+        with path.with_name(f'{path.name}.json').open('w') as fp:
+            json.dump({'num_jobs': self.num_jobs, 'precision': precision, 'table': table, 'state': self.state()}, fp)
+        with path.with_name(f'{path.name}.out').open('w') as fp:
+            fp.write(f"Loss fractions over {self.num_jobs} jobs (jobs needed for a relative standard error of "
+                     f"{precision:.0%})\n")
+            fp.write(f"{'name':<24}{'s':>12}{'mean':>12}{'stderr':>12}{'ci95 low':>12}{'ci95 high':>12}"
+                     f"{'rel. err.':>12}{'jobs needed':>14}\n")
+            for row in table:
+                s = f"{row['s']:12.2f}" if row['s'] is not None else ' ' * 12
+                rel_err = f"{row['rel_err']:12.3f}" if row['rel_err'] is not None else f"{'-':>12}"
+                needed = f"{row['jobs_needed']:14d}" if row['jobs_needed'] is not None else f"{'-':>14}"
+                fp.write(f"{row['name']:<24}{s}{row['mean']:12.4e}{row['stderr']:12.4e}{row['ci95'][0]:12.4e}"
+                         f"{row['ci95'][1]:12.4e}{rel_err}{needed}\n")
+
+
+def accumulate_lossmaps(files, states=None):
+    # Accumulator and statistics of lossmap files: of jobs (every file is one job), or of merged
+    # results with the states of their statistics
+    acc = LossMapAccumulator()
+    job_stats = LossMapStatistics(acc)
+    for file in files:
+        added = acc.add_file(file)
+        if states is None:
+            job_stats.add(added)
+    for state in states or []:
+        job_stats.merge_state(state)
+    return acc, job_stats
+
+
+def combine_lossmaps(study_path, output_name=None, *, result_path=None, plot_path=None, types=None, incremental=False,
+                     index=None, partial_every=1000, precision=0.1, verbose=True):
+    # Combine loss map files and plot (only the lossmap types in types, when given), one file at a
+    # time (see LossMapAccumulator). Every partial_every files, the lossmap merged so far is written
+    # to <output>.partial.json, to follow a long merge. The statistics over the jobs are written to
+    # <output>.stats.out (see LossMapStatistics, with the jobs needed for the given precision). When
+    # incremental, only the files that are not in the manifest of the merged result are added to it.
+    # The files are taken from index (see study_index), which is built when not given.
     study_path = Path(study_path).resolve()
     if result_path is None:
         result_path = study_path.parents[2] / 'results'
@@ -25,28 +394,382 @@ def combine_lossmaps(study_path, output_name=None, *, result_path=None, plot_pat
     else:
         output_name = output_name + '_'
 
-    files = np.array(list(study_path.glob(f'job_*/lossmap_*.json')))
+    if index is None:
+        index = study_index(study_path)
+    files = lossmap_files(study_path, index)
+    if types is not None:
+        files = {kk: vv for kk, vv in files.items() if kk in types}
     if len(files) == 0:
         if verbose:
             print('No lossmap files found!')
         return
     if verbose:
-        print(f'Found {len(files)} lossmap files')
-    lossmap_types = np.unique([f.stem for f in files])
+        print(f'Found {sum(len(vv) for vv in files.values())} lossmap files')
+    lossmap_types = sorted(files)
     if verbose:
         print(f"Lossmap types: {', '.join(lossmap_types)}")
 
     for lm_type in lossmap_types:
         if verbose:
             print(f'  -> Processing lossmap type: {lm_type}')
-        lm = xc.LossMap.from_json(study_path.glob(f'job_*/{lm_type}.json'))
+        merged = result_path / f'{output_name}{lm_type}.json'
+        manifest_file = result_path / f'{output_name}{lm_type}.manifest.json'
+        stats = index[lm_type]
+        new = _new_files(_load_manifest(manifest_file), stats) if incremental and merged.exists() else None
+        saved = _load_manifest(result_path / f'{output_name}{lm_type}.stats.json') if new is not None else None
+        if saved is None:
+            new = None  # The statistics over the merged jobs are needed to continue them
+        if new is not None and len(new) == 0:
+            if verbose:
+                print(f'     Up to date ({len(stats)} files)')
+            continue
+        if manifest_file.exists():
+            manifest_file.unlink()  # Until the new merged result is written
+        acc = LossMapAccumulator()
+        job_stats = LossMapStatistics(acc)
+        if new is None:
+            to_add = files[lm_type]
+        else:
+            if verbose:
+                print(f'     Adding {len(new)} new files to the {len(stats) - len(new)} merged ones')
+            acc.add_file(merged)
+            job_stats.merge_state(saved['state'])
+            to_add = [study_path / ff for ff in new]
+        partial = result_path / f'{output_name}{lm_type}.partial.json'
+        for ii, file in enumerate(to_add):
+            job_stats.add(acc.add_file(file))
+            if partial_every and (ii + 1) % partial_every == 0 and ii + 1 < len(to_add):
+                acc.to_json(partial)
+        lm = acc.to_lossmap(merged)
         lm.save_summary(result_path / f'{output_name}{lm_type}.out')
-        lm.to_json(result_path / f'{output_name}{lm_type}.json')
         lm.plot(show=False, savefig=plot_path / f'{output_name}{lm_type}.pdf')
+        job_stats.write(result_path / f'{output_name}{lm_type}.stats', precision)
+        if partial.exists():
+            partial.unlink()
+        _save_manifest(manifest_file, stats)
+
+
+def read_particle_dict(file, mmap_mode=None, columns=None):
+    # Read a particles_dict as a dict of arrays: a job output (.npz, or .json from older studies)
+    # or a merged result (a directory with one .npy per column, which can be memory-mapped).
+    # Only the given columns are read when possible (not for .json).
+    file = Path(file)
+    if file.is_dir():
+        with (file / 'header.json').open('r') as fp:
+            header = json.load(fp)
+        return {kk: np.load(file / f'{kk}.npy', mmap_mode=mmap_mode) for kk in header['columns']
+                if columns is None or kk in columns}
+    if file.suffix == '.npz':
+        with np.load(file) as data:
+            return {kk: data[kk] for kk in data.files if columns is None or kk in columns}
+    with file.open('r') as fp:
+        data = json.load(fp)
+    return {kk: np.array(vv) for kk, vv in data.items() if columns is None or kk in columns}
+
+
+def write_particle_dict(path, data):
+    # Merged result: one .npy per column and a small header, such that single columns can be
+    # read (and memory-mapped) without loading the rest
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    for kk, vv in data.items():
+        np.save(path / f'{kk}.npy', vv)
+    with (path / 'header.json').open('w') as fp:
+        json.dump({'columns': {kk: str(vv.dtype) for kk, vv in data.items()},
+                   'num_particles': len(next(iter(data.values()))) if data else 0}, fp, indent=1)
+
+
+def _surviving(data, file):
+    if 'state' not in data:
+        raise ValueError(f"Invalid particles_dict file {file} (missing 'state')!")
+    return data['state'] > xt.particles.LAST_INVALID_STATE
 
 
-def combine_particle_dict(study_path, output_name=None, *, result_path=None, verbose=True):
-    # Combine particle dict files
+# Loss histograms
+# ===============
+#
+# Time-resolved loss plots need the losses per turn and per element or s bin, not the particles.
+# LossHistograms sums the energy and the number of the lost particles (state < 1) of the merged
+# rows over (at_turn, at_element) and over (at_turn, s bin), as sparse (COO) arrays: only the
+# occupied cells are kept, as turn and index columns with the summed energy and count. Partial
+# histograms (per chunk of rows, per job, or of a previous merge) are combined by addition. They
+# are saved in the merged particles_dict directory as hist_at_element.npz and hist_s.npz (see
+# read_loss_histogram), which are kilobytes instead of the full particle set.
+
+histogram_kinds = ['at_element', 's']
+histogram_columns = ['state', 'at_turn', 'at_element', 's', 'energy']
+_histogram_pending = 1_000_000  # Lost particles collected between reductions
+
+
+def _cell_key(turn, index):
+    # One int64 per (turn, index) cell, ordered by turn first
+    return (turn.astype(np.int64) << 32) + (index.astype(np.int64) + 2**31)
+
+
+class LossHistograms:
+    def __init__(self, s_bin=1.0):
+        self.s_bin = s_bin
+        self.num_particles = 0  # Rows added (lost or not), to check against the merged result
+        self.cells = {kind: (np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0, dtype=np.int64))
+                      for kind in histogram_kinds}
+        self.pending = {kind: [] for kind in histogram_kinds}
+        self.num_pending = 0
+
+    def add(self, data):
+        # Add rows (a dict with the histogram_columns)
+        missing = [kk for kk in histogram_columns if kk not in data]
+        if missing:
+            raise ValueError(f"Loss histograms need the columns {', '.join(missing)}!")
+        self.num_particles += len(data['state'])
+        lost = np.asarray(data['state']) < 1
+        turn = np.asarray(data['at_turn'])[lost]
+        energy = np.asarray(data['energy'], dtype=np.float64)[lost]
+        count = np.ones(len(turn), dtype=np.int64)
+        index = {'at_element': np.asarray(data['at_element'])[lost],
+                 's': np.floor(np.asarray(data['s'])[lost] / self.s_bin)}
+        for kind in histogram_kinds:
+            self.pending[kind].append((_cell_key(turn, index[kind]), energy, count))
+        self.num_pending += len(turn)
+        if self.num_pending >= _histogram_pending:
+            self._reduce()
+
+    def merge(self, other):
+        # Add the cells of other histograms (with the same s bin)
+        if other.s_bin != self.s_bin:
+            raise ValueError(f"Cannot add loss histograms with an s bin of {other.s_bin} to ones of {self.s_bin}!")
+        other._reduce()
+        for kind in histogram_kinds:
+            self.pending[kind].append(other.cells[kind])
+            self.num_pending += len(other.cells[kind][0])
+        self.num_particles += other.num_particles
+        self._reduce()
+
+    def _reduce(self):
+        for kind in histogram_kinds:
+            if not self.pending[kind]:
+                continue
+            keys, energy, count = (np.concatenate(vv) for vv in zip(self.cells[kind], *self.pending[kind]))
+            keys, inverse = np.unique(keys, return_inverse=True)
+            self.cells[kind] = (keys, np.bincount(inverse, weights=energy, minlength=len(keys)),
+                                np.bincount(inverse, weights=count, minlength=len(keys)).astype(np.int64))
+            self.pending[kind] = []
+        self.num_pending = 0
+
+    def save(self, path):
+        self._reduce()
+        for kind in histogram_kinds:
+            keys, energy, count = self.cells[kind]
+            tmp = Path(path) / f'hist_{kind}.tmp.npz'
+            np.savez(tmp, turn=keys >> 32, index=(keys & 0xffffffff) - 2**31, energy=energy, count=count,
+                     s_bin=self.s_bin, num_particles=self.num_particles)
+            tmp.replace(Path(path) / f'hist_{kind}.npz')
+
+    @classmethod
+    def load(cls, path):
+        # The histograms saved in a merged result, or None when there are none
+        try:
+            data = {kind: read_loss_histogram(path, kind) for kind in histogram_kinds}
+        except FileNotFoundError:
+            return None
+        hist = cls(float(data['s']['s_bin']))
+        hist.num_particles = int(data['s']['num_particles'])
+        for kind, dd in data.items():
+            hist.cells[kind] = (_cell_key(dd['turn'], dd['index']), dd['energy'], dd['count'])
+        return hist
+
+
+def read_loss_histogram(path, kind='at_element'):
+    # Loss histogram of a merged particles_dict as a dict with the occupied cells ('turn', 'index',
+    # 'energy', 'count', sorted by turn and index), the 's_bin' (index is floor(s / s_bin) for the
+    # 's' histogram) and the 'num_particles' it covers
+    with np.load(Path(path) / f'hist_{kind}.npz') as data:
+        return {kk: data[kk] for kk in data.files}
+
+
+def _histograms_of(path, num_particles, s_bin, memory_budget_mb=256):
+    # Loss histograms of the first num_particles rows of a merged result
+    hist = LossHistograms(s_bin)
+    data = read_particle_dict(path, mmap_mode='r', columns=histogram_columns)
+    chunk_rows = max(1, int(memory_budget_mb * 1024**2) // max(1, sum(vv.itemsize for vv in data.values())))
+    for start in range(0, num_particles, chunk_rows):
+        hist.add({kk: vv[start:min(start + chunk_rows, num_particles)] for kk, vv in data.items()})
+    return hist
+
+
+def _stream_rows(files, fids, dtypes, memory_budget_mb, histograms=None):
+    # Append the surviving particles of the files to the open column files, buffering at most
+    # memory_budget_mb between writes (and add them to the histograms, when given). Returns the
+    # number of particles written.
+    budget = int(memory_budget_mb * 1024**2)
+    buffer = {kk: [] for kk in dtypes}
+    buffered = 0
+    written = 0
+    def flush():
+        for kk, parts in buffer.items():
+            for part in parts:
+                fids[kk].write(np.ascontiguousarray(part, dtype=dtypes[kk]).tobytes())
+            parts.clear()
+    # Merged results (directories, like the partial merges of merge_tree.py) are memory-mapped and
+    # copied in chunks of rows, such that they never need to fit in memory
+    chunk_rows = max(1, budget // max(1, sum(dt.itemsize for dt in dtypes.values())))
+    for file in files:
+        data = read_particle_dict(file, mmap_mode='r')
+        if set(data) != set(dtypes):
+            raise ValueError(f"Particles_dict file {file} has other columns ({', '.join(sorted(data))}) than "
+                             + f"the merged result ({', '.join(sorted(dtypes))})!")
+        num_rows = len(next(iter(data.values()))) if data else 0
+        for start in range(0, num_rows, chunk_rows):
+            chunk = {kk: vv[start:start + chunk_rows] for kk, vv in data.items()}
+            mask = _surviving(chunk, file)
+            for kk in dtypes:
+                buffer[kk].append(chunk[kk][mask])
+                buffered += buffer[kk][-1].nbytes
+            written += int(np.count_nonzero(mask))
+            if histograms is not None:
+                histograms.add({kk: buffer[kk][-1] for kk in histogram_columns if kk in buffer})
+            if buffered >= budget:
+                flush()
+                buffered = 0
+        del data
+    flush()
+    return written
+
+
+def merge_particle_dicts(files, path, *, memory_budget_mb=256, s_bin=None):
+    # Streaming merge into the per-column format of write_particle_dict. A first pass counts the
+    # surviving particles of every file (reading only the state column), such that the .npy headers
+    # can be written upfront. A second pass appends the data of the files to the column files,
+    # buffering at most memory_budget_mb between writes. This is linear in the number of files,
+    # and the memory is bounded by the budget plus the largest single file. With an s_bin, the loss
+    # histograms are built in the same pass (see LossHistograms).
+    path = Path(path)
+    counts = [int(np.count_nonzero(_surviving(read_particle_dict(ff, mmap_mode='r', columns=['state']), ff)))
+              for ff in files]
+    dtypes = {kk: vv.dtype for kk, vv in read_particle_dict(files[0], mmap_mode='r').items()}
+    total = sum(counts)
+
+    # Written next to the final result and moved in place at the end, such that an interrupted
+    # merge never leaves a truncated result
+    tmp = path.with_name(f'{path.name}.tmp')
+    if tmp.exists():
+        shutil.rmtree(tmp)
+    tmp.mkdir(parents=True)
+    fids = {kk: (tmp / f'{kk}.npy').open('wb') for kk in dtypes}
+    try:
+        for kk, dt in dtypes.items():
+            np.lib.format.write_array_header_1_0(fids[kk], {'descr': np.lib.format.dtype_to_descr(dt),
+                                                            'fortran_order': False, 'shape': (total,)})
+        histograms = LossHistograms(s_bin) if s_bin else None
+        written = _stream_rows([ff for ff, cc in zip(files, counts) if cc > 0], fids, dtypes, memory_budget_mb,
+                               histograms)
+    finally:
+        for fid in fids.values():
+            fid.close()
+    if written != total:
+        raise RuntimeError(f"Particles_dict files changed during the merge into {path}!")
+    if histograms is not None:
+        histograms.save(tmp)
+    with (tmp / 'header.json').open('w') as fp:
+        json.dump({'columns': {kk: str(dt) for kk, dt in dtypes.items()}, 'num_particles': total}, fp, indent=1)
+    if path.exists():
+        shutil.rmtree(path)
+    tmp.rename(path)
+
+
+def _set_npy_length(file, length):
+    # Set the length of a 1D .npy file in place: the data is truncated to it, and the shape in the
+    # header is rewritten (numpy pads the header, such that a longer shape fits)
+    with open(file, 'r+b') as fid:
+        version = np.lib.format.read_magic(fid)
+        if version == (1, 0):
+            _, fortran_order, dtype = np.lib.format.read_array_header_1_0(fid)
+            prefix = 10
+        else:
+            _, fortran_order, dtype = np.lib.format.read_array_header_2_0(fid)
+            prefix = 12
+        offset = fid.tell()
+        header = repr({'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': fortran_order,
+                       'shape': (length,)})
+        header = header[:-1] + ', }'
+        if len(header) + 1 > offset - prefix:
+            raise ValueError(f"No room in the header of {file} for a length of {length}!")
+        fid.seek(prefix)
+        fid.write((header + ' ' * (offset - prefix - len(header) - 1) + '\n').encode('latin1'))
+        fid.truncate(offset + length * dtype.itemsize)
+
+
+def append_particle_dicts(files, path, num_particles, *, memory_budget_mb=256, s_bin=None):
+    # Append the surviving particles of files to a merged result that has num_particles particles
+    # (from the manifest, see combine_particle_dict). The columns are first set back to that
+    # length, which undoes a previous append that was interrupted before the manifest was updated.
+    # With an s_bin, the loss histograms of the new particles are added to the saved ones (which are
+    # rebuilt from the merged particles when they do not cover exactly the num_particles).
+    path = Path(path)
+    with (path / 'header.json').open('r') as fp:
+        dtypes = {kk: np.dtype(dt) for kk, dt in json.load(fp)['columns'].items()}
+    for kk in dtypes:
+        _set_npy_length(path / f'{kk}.npy', num_particles)
+    histograms = None
+    if s_bin:
+        histograms = LossHistograms.load(path)
+        if histograms is None or histograms.num_particles != num_particles or histograms.s_bin != s_bin:
+            histograms = _histograms_of(path, num_particles, s_bin, memory_budget_mb)
+    fids = {kk: (path / f'{kk}.npy').open('ab') for kk in dtypes}
+    try:
+        written = _stream_rows(files, fids, dtypes, memory_budget_mb, histograms)
+    finally:
+        for fid in fids.values():
+            fid.close()
+    total = num_particles + written
+    if histograms is not None:
+        histograms.save(path)
+    for kk in dtypes:
+        _set_npy_length(path / f'{kk}.npy', total)
+    with (path / 'header.json').open('w') as fp:
+        json.dump({'columns': {kk: str(dt) for kk, dt in dtypes.items()}, 'num_particles': total}, fp, indent=1)
+    return total
+
+
+def _load_manifest(path):
+    try:
+        with Path(path).open('r') as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_manifest(path, stats, **extra):
+    tmp = Path(path).with_name(f'{Path(path).name}.tmp')
+    with tmp.open('w') as fp:
+        json.dump({**extra, 'files': stats}, fp)
+    tmp.replace(path)
+
+
+def _new_files(manifest, stats):
+    # The files to fold into the merged result, or None when files were changed or removed since
+    # (their contribution cannot be taken out of the merged result, so it has to be redone)
+    if manifest is None:
+        return None
+    merged = manifest['files']
+    if any(ff not in stats or stats[ff] != vv for ff, vv in merged.items()):
+        return None
+    return [ff for ff in stats if ff not in merged]
+
+
+def particle_dict_files(study_path, index=None):
+    # Particles_dict files of a case per particles_dict type (the file stem, like particles_dict_B1H_ph0)
+    return _files(study_path, index, 'particles_dict_')
+
+
+def combine_particle_dict(study_path, output_name=None, *, result_path=None, types=None, memory_budget_mb=256,
+                          incremental=False, index=None, histograms=False, s_bin=1.0, store=False, verbose=True):
+    # Combine particle dict files (only the particles_dict types in types, when given), streaming
+    # with at most memory_budget_mb of buffered data (see merge_particle_dicts). When incremental,
+    # only the files that are not in the manifest of the merged result are appended to it. The
+    # files are taken from index (see study_index), which is built when not given. With histograms,
+    # the loss histograms over turns and elements and over turns and s bins of s_bin metres are
+    # saved with the merged result (see LossHistograms). With store, the indexed query store of
+    # the merged result is (re)built (see particle_store.py).
     study_path = Path(study_path).resolve()
     if result_path is None:
         result_path = study_path.parents[2] / 'results'
@@ -56,36 +779,107 @@ def combine_particle_dict(study_path, output_name=None, *, result_path=None, ver
     else:
         output_name = output_name + '_'
 
-    files = np.array(list(study_path.glob(f'job_*/particles_dict_*.json')))
+    if index is None:
+        index = study_index(study_path)
+    files = particle_dict_files(study_path, index)
+    if types is not None:
+        files = {kk: vv for kk, vv in files.items() if kk in types}
     if len(files) == 0:
         if verbose:
             print('No particles_dict files found!')
         return
     if verbose:
-        print(f'Found {len(files)} particles_dict files')
-    particles_dict_types = np.unique([f.stem for f in files])
+        print(f'Found {sum(len(vv) for vv in files.values())} particles_dict files')
+    particles_dict_types = sorted(files)
     if verbose:
         print(f"Particles_dict types: {', '.join(particles_dict_types)}")
 
     for pd_type in particles_dict_types:
         if verbose:
             print(f'  -> Processing particles_dict type: {pd_type}')
-        final_data = None
-        for file in study_path.glob(f'job_*/{pd_type}.json'):
-            with file.open('r') as fp:
-                data = json.load(fp)
-            if 'state' not in data:
-                raise ValueError("Invalid particles_dict file (missing 'state')!")
-            data = {kk: np.array(vv) for kk, vv in data.items()}
-            mask = data['state'] > xt.particles.LAST_INVALID_STATE
-            data = {kk: vv[mask] for kk, vv in data.items()}
-            if final_data is None:
-                final_data = data
-            else:
-                for kk, vv in data.items():
-                    final_data[kk] = np.concatenate([final_data[kk], vv])
-        with (result_path / f'{output_name}{pd_type}.json').open('w') as fp:
-            json.dump(final_data, fp, cls=xo.JEncoder)
+        merged = result_path / f'{output_name}{pd_type}'
+        manifest_file = result_path / f'{output_name}{pd_type}.manifest.json'
+        stats = index[pd_type]
+        manifest = _load_manifest(manifest_file) if incremental and merged.is_dir() else None
+        new = _new_files(manifest, stats)
+        if histograms and new == [] and not (merged / f'hist_{histogram_kinds[0]}.npz').exists():
+            new = None  # Merged before without histograms
+        if new is not None and len(new) == 0:
+            if verbose:
+                print(f'     Up to date ({len(stats)} files)')
+            if store and not particle_store.is_current(merged):
+                particle_store.build_store(merged, memory_budget_mb=memory_budget_mb)
+            continue
+        if new is None:
+            if manifest_file.exists():
+                manifest_file.unlink()  # Until the new merged result is written
+            merge_particle_dicts(files[pd_type], merged, memory_budget_mb=memory_budget_mb,
+                                 s_bin=s_bin if histograms else None)
+            with (merged / 'header.json').open('r') as fp:
+                num_particles = json.load(fp)['num_particles']
+        else:
+            if verbose:
+                print(f'     Appending {len(new)} new files to the {len(stats) - len(new)} merged ones')
+            num_particles = append_particle_dicts([study_path / ff for ff in new], merged, manifest['num_particles'],
+                                                  memory_budget_mb=memory_budget_mb,
+                                                  s_bin=s_bin if histograms else None)
+        if store:
+            particle_store.build_store(merged, memory_budget_mb=memory_budget_mb)
+        _save_manifest(manifest_file, stats, num_particles=num_particles)
+
+
+timing_percentiles = [50, 90, 99]
+
+
+def combine_timings(study_path, output_name=None, *, result_path=None, index=None, verbose=True):
+    # Aggregate the per-task timing records (timing.json, see scripts/timing.py) into a table with
+    # the mean and percentiles of every phase, the total and the peak memory, per script and engine
+    study_path = Path(study_path).resolve()
+    if result_path is None:
+        result_path = study_path.parents[2] / 'results'
+    result_path = Path(result_path).resolve()
+    if output_name is None:
+        output_name = ''
+    else:
+        output_name = output_name + '_'
+
+    if index is None:
+        index = study_index(study_path)
+    files = [study_path / ff for ff in index.get('timing', {})]
+    if len(files) == 0:
+        if verbose:
+            print('No timing files found!')
+        return
+    if verbose:
+        print(f'Found {len(files)} timing files')
+    groups = {}
+    for file in files:
+        with file.open('r') as fp:
+            record = json.load(fp)
+        values = {**record['phases'], 'total': record['total'], 'peak_rss_mb': record['peak_rss_mb'],
+                  'peak_rss_children_mb': record['peak_rss_children_mb']}
+        group = groups.setdefault(f"{record.get('script', '?')}_{record.get('engine', '?')}", {})
+        for kk, vv in values.items():
+            group.setdefault(kk, []).append(vv)
+
+    # Setup phases only appear in some records (the first task of a bundle), so every row has its own count
+    tables = {}
+    for name, group in groups.items():
+        tables[name] = {kk: {'count': len(vv), 'mean': float(np.mean(vv)),
+                             **{f'p{pp}': float(np.percentile(vv, pp)) for pp in timing_percentiles},
+                             'max': float(np.max(vv))}
+                        for kk, vv in group.items()}
+    with (result_path / f'{output_name}timing.json').open('w') as fp:
+        json.dump(tables, fp, indent=1)
+    columns = ['count', 'mean', *[f'p{pp}' for pp in timing_percentiles], 'max']
+    with (result_path / f'{output_name}timing.out').open('w') as fp:
+        for name, table in tables.items():
+            fp.write(f"{name}\n{'phase':<24}" + ''.join(f'{cc:>12}' for cc in columns) + '\n')
+            for kk, row in table.items():
+                fp.write(f'{kk:<24}{row["count"]:>12d}' + ''.join(f'{row[cc]:>12.2f}' for cc in columns[1:]) + '\n')
+            fp.write('\n')
+    if verbose:
+        print(f"Timing tables written to {result_path / f'{output_name}timing.out'}")
 
 
 if __name__=="__main__":
@@ -94,5 +888,16 @@ if __name__=="__main__":
     study_path = Path.cwd().parent / 'studies' / study / case
     print(f'Processing {study_path}')
     output_name = f'{study}_{case}'
-    combine_lossmaps(study_path, output_name, result_path=None, plot_path=None, verbose=True)
-    combine_particle_dict(study_path, output_name, result_path=None, verbose=True)
+    # With --incremental, only job outputs that are new since the previous run are merged
+    incremental = '--incremental' in sys.argv[3:]
+    # With --refresh-index, all job directories are rescanned (after outputs were rewritten in place)
+    index = study_index(study_path, refresh='--refresh-index' in sys.argv[3:])
+    # With --histograms, the loss histograms (see LossHistograms, in s bins of 1m) are saved with the particles_dicts
+    histograms = '--histograms' in sys.argv[3:]
+    # With --store, the indexed query store of the merged particles_dicts is built (see particle_store.py)
+    store = '--store' in sys.argv[3:]
+    combine_lossmaps(study_path, output_name, result_path=None, plot_path=None, incremental=incremental, index=index,
+                     verbose=True)
+    combine_particle_dict(study_path, output_name, result_path=None, incremental=incremental, index=index,
+                          histograms=histograms, store=store, verbose=True)
+    combine_timings(study_path, output_name, result_path=None, index=index, verbose=True)
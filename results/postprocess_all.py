@@ -0,0 +1,166 @@
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import traceback
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import postprocess
+
+
+# Parallel postprocessing of many studies and cases
+# =================================================
+#
+# Usage: python postprocess_all.py [--studies double_phase ...] [--cases case ...] [--workers 8]
+#                                  [--memory-gb 16] [--root ..]
+#
+# Every lossmap type and every particles_dict type of every case is an independent merge unit (as
+# are the timing tables of a case). The units are run on a process pool, largest (most files)
+# first. Every worker has a memory limit (on its heap, not on memory-mapped files): a unit that
+# exceeds it fails with a MemoryError instead of the kernel killing a random process of the node.
+# The default limit is the memory of the node divided over the workers. Failed units are listed at
+# the end and in postprocess_report.json in the results directory, and the exit code is then 1.
+
+unit_kinds = ['lossmap', 'particles_dict', 'timing']
+
+
+def default_workers():
+    return max(1, len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1)
+
+
+def node_memory_gb():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024**3
+
+
+def limit_memory(memory_gb):
+    # RLIMIT_DATA counts the heap and anonymous mappings (so all numpy arrays), but not file mappings
+    if memory_gb:
+        limit = int(memory_gb * 1024**3)
+        resource.setrlimit(resource.RLIMIT_DATA, (limit, limit))
+
+
+def find_units(root, studies=None, cases=None, kinds=unit_kinds, refresh_index=False):
+    # Returns (study, case, kind, type, number of files) for every merge unit, and the file index
+    # of every case (one walk per case, see postprocess.study_index)
+    units = []
+    indices = {}
+    studies_path = Path(root) / 'studies'
+    for study_dir in sorted(pp for pp in studies_path.iterdir() if pp.is_dir()):
+        if studies and study_dir.name not in studies:
+            continue
+        for case_dir in sorted(pp for pp in study_dir.iterdir() if pp.is_dir()):
+            if cases and case_dir.name not in cases:
+                continue
+            index = postprocess.study_index(case_dir, refresh=refresh_index)
+            indices[study_dir.name, case_dir.name] = index
+            if 'lossmap' in kinds:
+                for lm_type, files in postprocess.lossmap_files(case_dir, index).items():
+                    units.append((study_dir.name, case_dir.name, 'lossmap', lm_type, len(files)))
+            if 'particles_dict' in kinds:
+                for pd_type, files in postprocess.particle_dict_files(case_dir, index).items():
+                    units.append((study_dir.name, case_dir.name, 'particles_dict', pd_type, len(files)))
+            if 'timing' in kinds and index.get('timing'):
+                units.append((study_dir.name, case_dir.name, 'timing', 'timing', len(index['timing'])))
+    return units, indices
+
+
+def run_unit(root, unit, memory_gb, index, incremental=False, s_bin=None, store=False):
+    # Returns (unit, seconds, error), with error None on success. The index only needs the type of the unit.
+    study, case, kind, unit_type, _ = unit
+    study_path = Path(root) / 'studies' / study / case
+    output_name = f'{study}_{case}'
+    start = time.time()
+    try:
+        if kind == 'lossmap':
+            postprocess.combine_lossmaps(study_path, output_name, types=[unit_type], incremental=incremental,
+                                         index=index, verbose=False)
+        elif kind == 'particles_dict':
+            # A quarter of the worker memory for the merge buffer, the rest is for reading the files
+            budget = memory_gb * 1024 / 4 if memory_gb else 1024
+            postprocess.combine_particle_dict(study_path, output_name, types=[unit_type], memory_budget_mb=budget,
+                                              incremental=incremental, index=index, histograms=bool(s_bin),
+                                              s_bin=s_bin, store=store, verbose=False)
+        elif kind == 'timing':
+            postprocess.combine_timings(study_path, output_name, index=index, verbose=False)
+    except MemoryError:
+        return unit, time.time() - start, 'MemoryError (over the memory limit of the worker)'
+    except Exception:
+        return unit, time.time() - start, traceback.format_exc()
+    return unit, time.time() - start, None
+
+
+def run_all(root, units, indices, workers, memory_gb, incremental=False, s_bin=None, store=False):
+    results = []
+    # Largest units first, such that the pool does not end with one long unit on a single core
+    units = sorted(units, key=lambda uu: -uu[4])
+    with ProcessPoolExecutor(max_workers=workers, initializer=limit_memory, initargs=(memory_gb,)) as pool:
+        futures = {pool.submit(run_unit, root, unit, memory_gb, {unit[3]: indices[unit[:2]][unit[3]]}, incremental,
+                               s_bin, store): unit
+                   for unit in units}
+        for future in as_completed(futures):
+            unit = futures[future]
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                # A worker was killed (by the kernel OOM killer or a signal); this breaks the pool,
+                # so all units that did not finish are reported as failed
+                result = (unit, 0., 'Worker process died (killed?), rerun with fewer workers')
+            results.append(result)
+            unit, seconds, error = result
+            print(f"{'FAILED' if error else 'done':<7}{unit[0]}/{unit[1]} {unit[2]} {unit[3]} "
+                  f"({unit[4]} files) in {seconds:.1f}s", flush=True)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge the results of many studies and cases in parallel.")
+    parser.add_argument('--root', default=str(Path.cwd().parent),
+                        help="Directory containing studies/, results/ and plots/ (default: ..).")
+    parser.add_argument('--studies', nargs='+', default=None, help="Studies to process (default: all).")
+    parser.add_argument('--cases', nargs='+', default=None, help="Cases to process (default: all).")
+    parser.add_argument('--kinds', nargs='+', default=unit_kinds, choices=unit_kinds,
+                        help="What to merge (default: everything).")
+    parser.add_argument('--workers', type=int, default=default_workers(),
+                        help="Number of worker processes (default: the number of cores).")
+    parser.add_argument('--memory-gb', type=float, default=None,
+                        help="Memory limit per worker in GB (default: the node memory divided over the "
+                             "workers; 0 for no limit).")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Only merge the job outputs that are new since the previous run (see postprocess.py).")
+    parser.add_argument('--histograms', type=float, default=None, metavar='S_BIN',
+                        help="Also save the loss histograms of the particles_dicts, in s bins of S_BIN metres.")
+    parser.add_argument('--store', action='store_true',
+                        help="Also build the indexed query store of the particles_dicts (see particle_store.py).")
+    parser.add_argument('--refresh-index', action='store_true',
+                        help="Rescan all job directories instead of validating the saved file indices.")
+    args = parser.parse_args()
+
+    root = Path(args.root).resolve()
+    memory_gb = args.memory_gb if args.memory_gb is not None else node_memory_gb() / args.workers
+    units, indices = find_units(root, args.studies, args.cases, args.kinds, args.refresh_index)
+    if not units:
+        print("Nothing to process!")
+        sys.exit(0)
+    print(f"Processing {len(units)} units with {args.workers} workers"
+          + (f" of at most {memory_gb:.1f}GB each" if memory_gb else ""), flush=True)
+    (root / 'results').mkdir(exist_ok=True)
+    (root / 'plots').mkdir(exist_ok=True)
+    start = time.time()
+    results = run_all(root, units, indices, args.workers, memory_gb, args.incremental, args.histograms,
+                      args.store)
+
+    failed = [(unit, error) for unit, _, error in results if error]
+    report = {'units': len(results), 'failed': len(failed), 'seconds': round(time.time() - start, 1),
+              'results': [{'study': unit[0], 'case': unit[1], 'kind': unit[2], 'type': unit[3], 'files': unit[4],
+                           'seconds': round(seconds, 1), 'error': error} for unit, seconds, error in results]}
+    with (root / 'results' / 'postprocess_report.json').open('w') as fp:
+        json.dump(report, fp, indent=1)
+    print(f"\nProcessed {len(results)} units in {time.time()-start:.1f}s: {len(failed)} failed")
+    for unit, error in failed:
+        print(f"\n{unit[0]}/{unit[1]} {unit[2]} {unit[3]}:\n{error}")
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,77 @@
+import os
+import pickle
+import time
+from pathlib import Path
+
+import numpy as np
+import xtrack as xt
+
+
+# Eviction-safe tracking: track in chunks of turns and checkpoint the particles in between
+# ========================================================================================
+#
+# The tracking is split into chunks of CHECKPOINT_TURNS turns. After a chunk, when at least
+# CHECKPOINT_MINUTES passed since the last checkpoint, the full particle state (coordinates,
+# at_turn, which drives the exciters, blowups and RF sweep, and the per-particle random generator
+# state of Everest) and the NumPy random state are written to checkpoint.pkl in the output
+# directory. When an evicted job restarts and finds a checkpoint of the same task, tracking
+# continues from there. Note that the internal random state of the Geant4 and FLUKA engines cannot
+# be saved, so a resumed job is statistically equivalent but not identical to an uninterrupted one.
+
+CHECKPOINT_TURNS = int(os.environ.get('CHECKPOINT_TURNS', 50))
+CHECKPOINT_MINUTES = float(os.environ.get('CHECKPOINT_MINUTES', 10))
+checkpoint_file = 'checkpoint.pkl'
+
+
+def load(outdir, task):
+    # Returns (particles, turn) of a checkpoint of this task, or None
+    path = Path(outdir) / checkpoint_file
+    if not path.exists():
+        return None
+    try:
+        with path.open('rb') as fid:
+            data = pickle.load(fid)
+    except Exception as e:
+        print(f"Ignoring unreadable checkpoint {path}: {e}")
+        return None
+    if data.get('task') != task:
+        print(f"Ignoring checkpoint {path} of another task ({data.get('task')})")
+        return None
+    np.random.set_state(data['numpy_random_state'])
+    return xt.Particles.from_dict(data['particles']), data['turn']
+
+
+def save(outdir, task, part, turn):
+    path = Path(outdir) / checkpoint_file
+    tmp = path.with_name(f'{checkpoint_file}.tmp')
+    with tmp.open('wb') as fid:
+        pickle.dump({'task': task, 'turn': turn, 'particles': part.to_dict(),
+                     'numpy_random_state': np.random.get_state()}, fid, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+
+def remove(outdir):
+    path = Path(outdir) / checkpoint_file
+    if path.exists():
+        path.unlink()
+
+
+def track(line, part, num_turns, task, outdir='.', **kwargs):
+    # Returns the (possibly restored) particles and the tracking time. The task (a dict of the
+    # task arguments and seed) identifies the checkpoint, such that another task never resumes it.
+    turn = 0
+    restored = load(outdir, task)
+    if restored is not None:
+        part, turn = restored
+        print(f"Resuming from checkpoint at turn {turn}/{num_turns}")
+    tracking_time = 0.
+    last_save = time.time()
+    while turn < num_turns:
+        chunk = min(CHECKPOINT_TURNS, num_turns - turn) if CHECKPOINT_TURNS > 0 else num_turns - turn
+        line.track(part, num_turns=chunk, time=True, **kwargs)
+        tracking_time += line.time_last_track
+        turn += chunk
+        if turn < num_turns and time.time() - last_save >= CHECKPOINT_MINUTES * 60:
+            save(outdir, task, part, turn)
+            last_save = time.time()
+    return part, tracking_time
@@ -1,5 +1,4 @@
 import sys
-import json
 import numpy as np
 from pathlib import Path
 import time
@@ -10,81 +9,31 @@ import xtrack as xt
 import xpart as xp
 import xcoll as xc
 
+import prepared_line
+import checkpoint
+import timing
+import_seconds = time.time() - start_time
+
 
 # Fast-instability lossmap script, specialised for FCC-ee
 # =======================================================
+#
+# Usage: python scripts/fast_instability.py machine colldb plane phase [engine] [seed]
+#
+# The line and engine are set up once in setup(), after which run_task() can be called for many
+# tasks (see worker.py); running the script directly does a single task.
 
 num_part = 5000
-
-machine = sys.argv[1]
-colldb = sys.argv[2]
-beam = 1
-plane = sys.argv[3].upper()
-phase = int(sys.argv[4])
-if len(sys.argv) > 5:
-    engine = sys.argv[5]
-else:
-    engine = 'geant4'  # Default
-
 phi = 0
 sigma_z  = 16.21e-3
+beam = 1
 
-if plane not in ['H', 'V']:
-    raise ValueError("Incorrect plane!")
-if phase not in [0, 30, 60, 90]:
-    raise ValueError("Incorrect phase!")
-if engine not in ['everest', 'fluka', 'geant4', 'black']:
-    raise ValueError("Incorrect engine!")
-
-
-class NullProgressIndicator(xt.progress_indicator.DefaultProgressIndicator):
-    """A simple empty class to not show any progress bar."""
-
-    def __next__(self):
-        try:
-            return next(self._iterator)
-        except StopIteration:
-            raise
-xt.progress_indicator.set_default_indicator(NullProgressIndicator)
-
-
-# Load machine and collimator database
-env = xt.load(machine)
-line = env.lines['fccee_p_ring']
-colldb = xc.CollimatorDatabase.from_yaml(colldb)
-
-
-# Install collimators into line
-aperture = xt.LimitEllipse(a=0.03, b=0.03)
-if engine == 'everest':
-    colldb.install_everest_collimators(line=line, verbose=True, apertures=aperture)
-elif engine == 'fluka':
-    colldb.install_fluka_collimators(line=line, verbose=True, apertures=aperture)
-elif engine == 'geant4':
-    colldb.install_geant4_collimators(line=line, verbose=True, apertures=aperture)
-elif engine == 'black':
-    colldb.install_black_absorbers(line=line, verbose=True, apertures=aperture)
-
-
-# Configure collimators
-tw = line.twiss()
-line.collimators.assign_optics(twiss=tw)
-
-
-# Connect engine
-if engine == 'fluka':
-    capacity = 10*num_part
-    xc.fluka.engine.capacity = capacity
-    xc.fluka.engine.relative_capacity = 50
-    xc.fluka.engine.start(line=line, cwd='.', clean=True, verbose=True)
-elif engine == 'geant4':
-    capacity = 10*num_part
-    xc.geant4.engine.start(line=line, cwd='.', clean=True, verbose=True)
-else:
-    capacity = None
-
+# Arguments of a task, and those of them that need their own setup (the exciters and their
+# bounding apertures are part of the line, so all tasks of a setup share the plane and phase)
+TASK_ARGS = ['plane', 'phase']
+SETUP_ARGS = ['plane', 'phase']
 
-# Install exciters
+# Exciter settings per plane and phase
 settings = {
     'H': {
         0: {'kick_amplitude': 5e-14, 'rise_time_nturns': 5, 'n_turns': 100},
@@ -99,106 +48,238 @@ settings = {
         90: {'kick_amplitude': 3e-13, 'rise_time_nturns': 10, 'n_turns': 100}
     }
 }
-f_rev = 1 / tw.T_rev0
-f_samp = f_rev
-rise_time = settings[plane][phase]['rise_time_nturns'] * tw.T_rev0
-total_time = settings[plane][phase]['n_turns'] / f_rev
-time_ = np.arange(0, total_time, 1 / f_samp)
-if plane == 'H':
-    knl = settings[plane][phase]['kick_amplitude']
-    ksl = 0
-elif plane == 'V':
-    knl = 0
-    ksl = settings[plane][phase]['kick_amplitude']
-f_ex = tw.qx * f_rev if plane == 'H' else tw.qy * f_rev
-tt_sigmas = tw.get_beam_covariance(nemitt_x=colldb.nemitt_x, nemitt_y=colldb.nemitt_y)
-tt = line.get_table()
-names = tt.rows[f'fast_instability_marker.{plane.lower()}.{phase}.*'].name
-if len(names) == 0:
-    raise ValueError("No exciter markers found in the line!")
-exciter_aper_placements = []
-for nn in names:
-    exciter_name = nn.replace("marker", "kicker")
-    sigma = tt_sigmas['sigma_x', nn] if plane == 'H' else tt_sigmas['sigma_y', nn]
-    samples = 1 / sigma * np.cos(2 * np.pi * f_ex * time_ + phi) * np.exp(time_ / rise_time)
-    env.elements[exciter_name] = xt.Exciter(
-        samples=samples,
-        sampling_frequency=f_samp,
-        frev=f_rev,
-        start_turn=0,
-        knl=[knl],
-        ksl=[ksl]
-    )
-    line.replace(nn, exciter_name)
-
-    # Define exciter bounding apertures
-    aper_name = f'{exciter_name}_aper'
-    env.elements[aper_name] = aperture
-    env.new(aper_name + '..0', aper_name, mode='replica')
-    exciter_aper_placements.append(env.place(f'{aper_name}..0', at=f'{exciter_name}@start'))
-    env.new(aper_name + '..1', aper_name, mode='replica')
-    exciter_aper_placements.append(env.place(f'{aper_name}..1', at=f'{exciter_name}@end'))
-line.insert(exciter_aper_placements)
-
-
-# Create particles
-x_norm = np.random.normal(size=num_part)
-px_norm = np.random.normal(size=num_part)
-y_norm = np.random.normal(size=num_part)
-py_norm = np.random.normal(size=num_part)
-zeta, delta = xp.generate_longitudinal_coordinates(num_particles=num_part, particle_ref=line.particle_ref, line=line, sigma_z=sigma_z)
-part = line.build_particles(x_norm=x_norm, px_norm=px_norm, y_norm=y_norm, py_norm=py_norm, zeta=zeta, delta=delta,
-                            nemitt_x=colldb.nemitt_x, nemitt_y=colldb.nemitt_y, _capacity=capacity)
-
-
-# # Move the line to an OpenMP context to be able to use all cores
-# import xobjects as xo
-# line.discard_tracker()
-# line.build_tracker(_context=xo.ContextCpu(omp_num_threads=12))
-
-
-# Switch on radiation
-line.configure_radiation(model='quantum')
-
-
-# Track!
-line.scattering.enable()
-line.track(part, num_turns=settings[plane][phase]['n_turns'], time=True, with_progress=5)
-line.scattering.disable()
-print(f"Done tracking in {line.time_last_track:.1f}s.")
-
-
-# Switch off radiation
-line.configure_radiation(model=None)
-
-
-# # Move the line back to the default context to be able to use all prebuilt kernels for the aperture interpolation
-# line.discard_tracker()
-# line.build_tracker(_context=xo.ContextCpu())
-
-
-# Make lossmap
-start_interp = time.time()
-ThisLM = xc.LossMap(line, line_is_reversed=False, part=part)
-ThisLM.to_json(file=f'lossmap_B{beam}{plane}_ph{phase}.json')
-print(f"Done interpolating in {time.time()-start_interp:.1f}s")
-
-# Save a summary of the collimator losses to a text file
-ThisLM.save_summary(file=f'coll_summary_B{beam}{plane}_ph{phase}.out')
-print(ThisLM.summary)
-
-# Save losses distribution over time
-mask = part.state > xt.particles.LAST_INVALID_STATE
-with open(f'particles_dict_B{beam}{plane}_ph{phase}.json', 'w') as fid:
-    json.dump({
-        'state': part.state[mask], 'at_turn': part.at_turn[mask],
-        'at_element': part.at_element[mask], 's': part.s[mask],
-        'energy': part.energy[mask]
-    }, fid, indent=4, cls=xo.JEncoder)
-
-
-if engine == 'fluka':
-    xc.fluka.engine.stop(clean=True)
-elif engine == 'geant4':
-    xc.geant4.engine.stop(clean=True)
-print(f"Total calculation time {time.time()-start_time}s")
+
+
+def parse_args(argv):
+    args = {'machine': argv[0], 'colldb': argv[1], 'plane': argv[2].upper(), 'phase': int(argv[3])}
+    if len(argv) > 4:
+        args['engine'] = argv[4]
+    else:
+        args['engine'] = 'geant4'  # Default
+    if len(argv) > 5:
+        args['seed'] = int(argv[5])
+    else:
+        args['seed'] = None  # Not reproducible
+    check_task(args['plane'], args['phase'])
+    if args['engine'] not in ['everest', 'fluka', 'geant4', 'black']:
+        raise ValueError("Incorrect engine!")
+    if args['seed'] is not None and args['seed'] <= 0:
+        raise ValueError("Incorrect seed!")
+    return args
+
+
+def check_task(plane, phase):
+    if plane not in ['H', 'V']:
+        raise ValueError("Incorrect plane!")
+    if phase not in [0, 30, 60, 90]:
+        raise ValueError("Incorrect phase!")
+
+
+class NullProgressIndicator(xt.progress_indicator.DefaultProgressIndicator):
+    """A simple empty class to not show any progress bar."""
+
+    def __next__(self):
+        try:
+            return next(self._iterator)
+        except StopIteration:
+            raise
+xt.progress_indicator.set_default_indicator(NullProgressIndicator)
+
+
+def install_exciters(env, line, tw, colldb, plane, phase, aperture):
+    # Returns the exciter names with their kick (knl, ksl), such that they can be switched off
+    # while tracking another plane or phase
+    f_rev = 1 / tw.T_rev0
+    f_samp = f_rev
+    rise_time = settings[plane][phase]['rise_time_nturns'] * tw.T_rev0
+    total_time = settings[plane][phase]['n_turns'] / f_rev
+    time_ = np.arange(0, total_time, 1 / f_samp)
+    if plane == 'H':
+        knl = settings[plane][phase]['kick_amplitude']
+        ksl = 0
+    elif plane == 'V':
+        knl = 0
+        ksl = settings[plane][phase]['kick_amplitude']
+    f_ex = tw.qx * f_rev if plane == 'H' else tw.qy * f_rev
+    tt_sigmas = tw.get_beam_covariance(nemitt_x=colldb.nemitt_x, nemitt_y=colldb.nemitt_y)
+    tt = line.get_table()
+    names = tt.rows[f'fast_instability_marker.{plane.lower()}.{phase}.*'].name
+    if len(names) == 0:
+        raise ValueError("No exciter markers found in the line!")
+    exciters = []
+    exciter_aper_placements = []
+    for nn in names:
+        exciter_name = nn.replace("marker", "kicker")
+        sigma = tt_sigmas['sigma_x', nn] if plane == 'H' else tt_sigmas['sigma_y', nn]
+        samples = 1 / sigma * np.cos(2 * np.pi * f_ex * time_ + phi) * np.exp(time_ / rise_time)
+        env.elements[exciter_name] = xt.Exciter(
+            samples=samples,
+            sampling_frequency=f_samp,
+            frev=f_rev,
+            start_turn=0,
+            knl=[knl],
+            ksl=[ksl]
+        )
+        line.replace(nn, exciter_name)
+        exciters.append((exciter_name, knl, ksl))
+
+        # Define exciter bounding apertures
+        aper_name = f'{exciter_name}_aper'
+        env.elements[aper_name] = aperture
+        env.new(aper_name + '..0', aper_name, mode='replica')
+        exciter_aper_placements.append(env.place(f'{aper_name}..0', at=f'{exciter_name}@start'))
+        env.new(aper_name + '..1', aper_name, mode='replica')
+        exciter_aper_placements.append(env.place(f'{aper_name}..1', at=f'{exciter_name}@end'))
+    line.insert(exciter_aper_placements)
+    return exciters
+
+
+def setup(machine, colldb, engine, tasks, seed=None):
+    # Load machine with the collimators installed and their optics assigned (from the cache made
+    # by prepared_line.py when it is there, otherwise built here)
+    timings = timing.Timings()
+    timings.add('imports', import_seconds)
+    env, line, colldb, tw = prepared_line.load(machine, colldb, engine, timings=timings)
+    aperture = xt.LimitEllipse(a=0.03, b=0.03)
+
+    capacity = 10*num_part if engine in ['fluka', 'geant4'] else None
+
+    # Install exciters, for the plane and phase of the tasks (the same for all, see SETUP_ARGS)
+    planes_phases = {(task['plane'], task['phase']) for task in tasks}
+    if len(planes_phases) != 1:
+        raise ValueError("All tasks of a setup need the same plane and phase!")
+    plane, phase = planes_phases.pop()
+    with timings.phase('exciter_install'):
+        exciters = install_exciters(env, line, tw, colldb, plane, phase, aperture)
+
+    # Number of OpenMP threads for the tracking
+    omp_threads = prepared_line.omp_threads()
+    print(f"OpenMP threads: {omp_threads}")
+    omp_context = xo.ContextCpu(omp_num_threads=omp_threads) if omp_threads > 1 else None
+
+    state = {'omp_context': omp_context, 'env': env, 'line': line, 'colldb': colldb, 'tw': tw, 'engine': engine,
+            'capacity': capacity, 'plane': plane, 'phase': phase, 'exciters': exciters, 'setup_timings': timings}
+
+    # Connect engine
+    start_engine(state, seed)
+    return state
+
+
+def run_task(state, plane, phase, seed=None, outdir='.'):
+    line = state['line']
+    colldb = state['colldb']
+    outdir = Path(outdir)
+    # The first task carries the setup phases (see timing.py)
+    timings = state.pop('setup_timings', None) or timing.Timings()
+
+    if (plane, phase) != (state['plane'], state['phase']):
+        raise ValueError(f"The line is set up for plane {state['plane']} and phase {state['phase']}!")
+
+    # Seed NumPy, which is used for the initial distribution and to initialise the Everest random generator
+    with timings.phase('particle_generation'):
+        if seed is not None:
+            np.random.seed(seed)
+
+        # Create particles
+        x_norm = np.random.normal(size=num_part)
+        px_norm = np.random.normal(size=num_part)
+        y_norm = np.random.normal(size=num_part)
+        py_norm = np.random.normal(size=num_part)
+        zeta, delta = xp.generate_longitudinal_coordinates(num_particles=num_part, particle_ref=line.particle_ref, line=line, sigma_z=sigma_z)
+        part = line.build_particles(x_norm=x_norm, px_norm=px_norm, y_norm=y_norm, py_norm=py_norm, zeta=zeta, delta=delta,
+                                    nemitt_x=colldb.nemitt_x, nemitt_y=colldb.nemitt_y, _capacity=state['capacity'])
+
+
+    # Move the line to an OpenMP context to be able to use all cores
+    with timings.phase('tracker_build'):
+        if state['omp_context'] is not None:
+            prepared_line.use_context(line, state['omp_context'])
+
+
+    # Switch on radiation
+    line.configure_radiation(model='quantum')
+
+
+    # Track!
+    # (in chunks of turns, checkpointing in between, such that an evicted job can resume)
+    task = {'script': 'fast_instability', 'plane': plane, 'phase': phase, 'engine': state['engine'], 'seed': seed}
+    line.scattering.enable()
+    with timings.phase('tracking'):
+        part, tracking_time = checkpoint.track(line, part, settings[plane][phase]['n_turns'], task, outdir=outdir,
+                                               with_progress=5)
+    line.scattering.disable()
+    print(f"Done tracking in {tracking_time:.1f}s.")
+
+
+    # Switch off radiation
+    line.configure_radiation(model=None)
+
+
+    # Move the line back to the default context to be able to use all prebuilt kernels for the aperture interpolation
+    with timings.phase('tracker_build'):
+        if state['omp_context'] is not None:
+            prepared_line.use_context(line, xo.ContextCpu())
+
+
+    # Make lossmap
+    with timings.phase('interpolation'):
+        ThisLM = xc.LossMap(line, line_is_reversed=False, part=part)
+    print(f"Done interpolating in {timings.phases['interpolation']:.1f}s")
+
+    # Write the outputs
+    with timings.phase('output_writing'):
+        ThisLM.to_json(file=str(outdir / f'lossmap_B{beam}{plane}_ph{phase}.json'))
+
+        # Save a summary of the collimator losses to a text file
+        ThisLM.save_summary(file=str(outdir / f'coll_summary_B{beam}{plane}_ph{phase}.out'))
+
+        # Save losses distribution over time, as compressed binary columns
+        mask = part.state > xt.particles.LAST_INVALID_STATE
+        np.savez_compressed(outdir / f'particles_dict_B{beam}{plane}_ph{phase}.npz',
+            state=part.state[mask], at_turn=part.at_turn[mask],
+            at_element=part.at_element[mask], s=part.s[mask],
+            energy=part.energy[mask]
+        )
+    checkpoint.remove(outdir)
+    timings.write(outdir / timing.timing_file, script='fast_instability', plane=plane, phase=phase,
+                  engine=state['engine'], seed=seed)
+    state['task_timings'] = timings  # The engine stop is added in teardown
+    print(ThisLM.summary)
+
+
+def start_engine(state, seed=None):
+    # Connect engine (the FLUKA and Geant4 engines take the seed when they start). Part of setup(),
+    # and used by worker.py to restart the engine on the same line for a task with another seed.
+    timings = state.setdefault('setup_timings', timing.Timings())
+    with timings.phase('engine_start'):
+        if state['engine'] == 'fluka':
+            xc.fluka.engine.capacity = state['capacity']
+            xc.fluka.engine.relative_capacity = 50
+            xc.fluka.engine.start(line=state['line'], cwd='.', clean=True, verbose=True, seed=seed)
+        elif state['engine'] == 'geant4':
+            xc.geant4.engine.start(line=state['line'], cwd='.', clean=True, verbose=True, seed=seed)
+    state['engine_seed'] = seed
+
+
+def stop_engine(state):
+    # The engine stop is added to the timings of the last task
+    timings = state.pop('task_timings', None) or timing.Timings()
+    with timings.phase('engine_stop'):
+        if state['engine'] == 'fluka':
+            xc.fluka.engine.stop(clean=True)
+        elif state['engine'] == 'geant4':
+            xc.geant4.engine.stop(clean=True)
+    timings.rewrite()
+
+
+def teardown(state):
+    stop_engine(state)
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    state = setup(args['machine'], args['colldb'], args['engine'],
+                  [{'plane': args['plane'], 'phase': args['phase']}], seed=args['seed'])
+    run_task(state, args['plane'], args['phase'], seed=args['seed'])
+    teardown(state)
+    print(f"Total calculation time {time.time()-start_time}s")
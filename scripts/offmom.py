@@ -4,37 +4,57 @@ from pathlib import Path
 import time
 start_time = time.time()
 
+import xobjects as xo
 import xtrack as xt
 import xpart as xp
 import xcoll as xc
 
+import prepared_line
+import checkpoint
+import timing
+import_seconds = time.time() - start_time
+
 
 # Off-momentum lossmap script, specialised for FCC-ee
 # ===================================================
+#
+# Usage: python scripts/offmom.py machine colldb plane [engine] [seed]   (plane is DPpos or DPneg)
+#
+# The line and engine are set up once in setup(), after which run_task() can be called for many
+# tasks (see worker.py); running the script directly does a single task.
 
 
 num_turns = 1500
 num_part  = 1000
 sweep_hz  = 300
 sigma_z  = 16.21e-3
-
-machine = sys.argv[1]
-colldb = sys.argv[2]
 beam = 1
-plane = sys.argv[3]
-if len(sys.argv) > 4:
-    engine = sys.argv[4]
-else:
-    engine = 'geant4'  # Default
-
-if plane == 'DPpos':
-    sweep = -sweep_hz
-elif plane == 'DPneg':
-    sweep = sweep_hz
-else:
-    raise ValueError("Incorrect plane!")
-if engine not in ['everest', 'fluka', 'geant4', 'black']:
-    raise ValueError("Incorrect engine!")
+
+# Arguments that can differ between the tasks of one setup
+TASK_ARGS = ['plane']
+
+
+def parse_args(argv):
+    args = {'machine': argv[0], 'colldb': argv[1], 'plane': argv[2]}
+    if len(argv) > 3:
+        args['engine'] = argv[3]
+    else:
+        args['engine'] = 'geant4'  # Default
+    if len(argv) > 4:
+        args['seed'] = int(argv[4])
+    else:
+        args['seed'] = None  # Not reproducible
+    check_task(args['plane'])
+    if args['engine'] not in ['everest', 'fluka', 'geant4', 'black']:
+        raise ValueError("Incorrect engine!")
+    if args['seed'] is not None and args['seed'] <= 0:
+        raise ValueError("Incorrect seed!")
+    return args
+
+
+def check_task(plane):
+    if plane not in ['DPpos', 'DPneg']:
+        raise ValueError("Incorrect plane!")
 
 
 class NullProgressIndicator(xt.progress_indicator.DefaultProgressIndicator):
@@ -48,106 +68,150 @@ class NullProgressIndicator(xt.progress_indicator.DefaultProgressIndicator):
 xt.progress_indicator.set_default_indicator(NullProgressIndicator)
 
 
-# Load machine and collimator database
-env = xt.load(machine)
-line = env.lines['fccee_p_ring']
-colldb = xc.CollimatorDatabase.from_yaml(colldb)
-
-
-# Install collimators into line
-aperture = xt.LimitEllipse(a=0.03, b=0.03)
-if engine == 'everest':
-    colldb.install_everest_collimators(line=line, verbose=True, apertures=aperture)
-elif engine == 'fluka':
-    colldb.install_fluka_collimators(line=line, verbose=True, apertures=aperture)
-elif engine == 'geant4':
-    colldb.install_geant4_collimators(line=line, verbose=True, apertures=aperture)
-elif engine == 'black':
-    colldb.install_black_absorbers(line=line, verbose=True, apertures=aperture)
-
-
-# Configure collimators
-tw = line.twiss()
-line.collimators.assign_optics(twiss=tw)
-
-
-# Connect engine
-if engine == 'fluka':
-    capacity = 10*num_part
-    xc.fluka.engine.capacity = capacity
-    xc.fluka.engine.relative_capacity = 50
-    xc.fluka.engine.start(line=line, cwd='.', clean=True, verbose=True)
-elif engine == 'geant4':
-    capacity = 10*num_part
-    xc.geant4.engine.start(line=line, cwd='.', clean=True, verbose=True)
-else:
-    capacity = None
-
-
-# Create particles
-x_norm = np.random.normal(size=num_part)
-px_norm = np.random.normal(size=num_part)
-y_norm = np.random.normal(size=num_part)
-py_norm = np.random.normal(size=num_part)
-zeta, delta = xp.generate_longitudinal_coordinates(num_particles=num_part, particle_ref=line.particle_ref, line=line, sigma_z=sigma_z)
-part = line.build_particles(x_norm=x_norm, px_norm=px_norm, y_norm=y_norm, py_norm=py_norm, zeta=zeta, delta=delta,
-                            nemitt_x=colldb.nemitt_x, nemitt_y=colldb.nemitt_y, _capacity=capacity)
-
-
-# Print some info of the RF sweep
-rf_sweep = xc.RFSweep(line)
-rf_sweep.prepare(sweep_per_turn=sweep/num_turns)
-rf_sweep.info()
-
-
-# # Move the line to an OpenMP context to be able to use all cores
-# import xobjects as xo
-# line.discard_tracker()
-# line.build_tracker(_context=xo.ContextCpu(omp_num_threads=12))
-
-
-# Switch on radiation
-line.configure_radiation(model='quantum')
-
-
-# Track!
-line.scattering.enable()
-line.track(part, num_turns=num_turns, time=True, with_progress=5)
-line.scattering.disable()
-print(f"Done sweeping RF in {line.time_last_track:.1f}s.")
-
-
-# Switch off radiation
-line.configure_radiation(model=None)
-
-
-# # Move the line back to the default context to be able to use all prebuilt kernels for the aperture interpolation
-# line.discard_tracker()
-# line.build_tracker(_context=xo.ContextCpu())
+def setup(machine, colldb, engine, tasks, seed=None):
+    # Load machine with the collimators installed and their optics assigned (from the cache made
+    # by prepared_line.py when it is there, otherwise built here)
+    timings = timing.Timings()
+    timings.add('imports', import_seconds)
+    env, line, colldb, tw = prepared_line.load(machine, colldb, engine, timings=timings)
 
+    capacity = 10*num_part if engine in ['fluka', 'geant4'] else None
 
-# Make lossmap
-start_interp = time.time()
-ThisLM = xc.LossMap(line, line_is_reversed=False, part=part)
-ThisLM.to_json(file=f'lossmap_B{beam}{plane}.json')
-print(f"Done interpolating in {time.time()-start_interp:.1f}s")
+    # Number of OpenMP threads for the tracking
+    omp_threads = prepared_line.omp_threads()
+    print(f"OpenMP threads: {omp_threads}")
+    omp_context = xo.ContextCpu(omp_num_threads=omp_threads) if omp_threads > 1 else None
 
-# Save a summary of the collimator losses to a text file
-ThisLM.save_summary(file=f'coll_summary_B{beam}{plane}.out')
-print(ThisLM.summary)
+    state = {'omp_context': omp_context, 'env': env, 'line': line, 'colldb': colldb, 'tw': tw, 'engine': engine,
+            'capacity': capacity, 'rf_sweep': xc.RFSweep(line), 'setup_timings': timings}
 
+    # Connect engine
+    start_engine(state, seed)
+    return state
+
+
+def run_task(state, plane, seed=None, outdir='.'):
+    line = state['line']
+    colldb = state['colldb']
+    outdir = Path(outdir)
+    # The first task carries the setup phases (see timing.py)
+    timings = state.pop('setup_timings', None) or timing.Timings()
+    if plane == 'DPpos':
+        sweep = -sweep_hz
+    else:
+        sweep = sweep_hz
+
+    # Seed NumPy, which is used for the initial distribution and to initialise the Everest random generator
+    with timings.phase('particle_generation'):
+        if seed is not None:
+            np.random.seed(seed)
+
+        # Create particles
+        x_norm = np.random.normal(size=num_part)
+        px_norm = np.random.normal(size=num_part)
+        y_norm = np.random.normal(size=num_part)
+        py_norm = np.random.normal(size=num_part)
+        zeta, delta = xp.generate_longitudinal_coordinates(num_particles=num_part, particle_ref=line.particle_ref, line=line, sigma_z=sigma_z)
+        part = line.build_particles(x_norm=x_norm, px_norm=px_norm, y_norm=y_norm, py_norm=py_norm, zeta=zeta, delta=delta,
+                                    nemitt_x=colldb.nemitt_x, nemitt_y=colldb.nemitt_y, _capacity=state['capacity'])
+
+
+    # Print some info of the RF sweep (prepared for every task, as the sweep direction depends on the plane)
+    rf_sweep = state['rf_sweep']
+    rf_sweep.prepare(sweep_per_turn=sweep/num_turns)
+    rf_sweep.info()
+
+
+    # Move the line to an OpenMP context to be able to use all cores
+    with timings.phase('tracker_build'):
+        if state['omp_context'] is not None:
+            prepared_line.use_context(line, state['omp_context'])
+
+
+    # Switch on radiation
+    line.configure_radiation(model='quantum')
+
+
+    # Track!
+    # (in chunks of turns, checkpointing in between, such that an evicted job can resume; the RF sweep
+    # follows the turn number of the particles, so it continues where the checkpoint left off)
+    task = {'script': 'offmom', 'plane': plane, 'engine': state['engine'], 'seed': seed}
+    line.scattering.enable()
+    with timings.phase('tracking'):
+        part, tracking_time = checkpoint.track(line, part, num_turns, task, outdir=outdir, with_progress=5)
+    line.scattering.disable()
+    print(f"Done sweeping RF in {tracking_time:.1f}s.")
+
+
+    # Switch off radiation
+    line.configure_radiation(model=None)
+
+
+    # Move the line back to the default context to be able to use all prebuilt kernels for the aperture interpolation
+    with timings.phase('tracker_build'):
+        if state['omp_context'] is not None:
+            prepared_line.use_context(line, xo.ContextCpu())
+
+
+    # Make lossmap
+    with timings.phase('interpolation'):
+        ThisLM = xc.LossMap(line, line_is_reversed=False, part=part)
+    print(f"Done interpolating in {timings.phases['interpolation']:.1f}s")
+
+    # Write the outputs
+    with timings.phase('output_writing'):
+        ThisLM.to_json(file=str(outdir / f'lossmap_B{beam}{plane}.json'))
+
+        # Save a summary of the collimator losses to a text file
+        ThisLM.save_summary(file=str(outdir / f'coll_summary_B{beam}{plane}.out'))
+    checkpoint.remove(outdir)
+    timings.write(outdir / timing.timing_file, script='offmom', plane=plane,
+                  engine=state['engine'], seed=seed)
+    state['task_timings'] = timings  # The engine stop is added in teardown
+    print(ThisLM.summary)
+
+
+    # turns, counts = np.unique(part.at_turn, return_counts=True)
+    # print(turns, counts)
+    # for turn in turns:
+    #     mask = part.at_turn == turn
+    #     print(f"Turn {turn}:")
+    #     ss, cnts = np.unique(part.s[mask], return_counts=True)
+    #     print(f"  {ss}, {cnts}")
+
+
+def start_engine(state, seed=None):
+    # Connect engine (the FLUKA and Geant4 engines take the seed when they start). Part of setup(),
+    # and used by worker.py to restart the engine on the same line for a task with another seed.
+    timings = state.setdefault('setup_timings', timing.Timings())
+    with timings.phase('engine_start'):
+        if state['engine'] == 'fluka':
+            xc.fluka.engine.capacity = state['capacity']
+            xc.fluka.engine.relative_capacity = 50
+            xc.fluka.engine.start(line=state['line'], cwd='.', clean=True, verbose=True, seed=seed)
+        elif state['engine'] == 'geant4':
+            xc.geant4.engine.start(line=state['line'], cwd='.', clean=True, verbose=True, seed=seed)
+    state['engine_seed'] = seed
+
+
+def stop_engine(state):
+    # The engine stop is added to the timings of the last task
+    timings = state.pop('task_timings', None) or timing.Timings()
+    with timings.phase('engine_stop'):
+        if state['engine'] == 'fluka':
+            xc.fluka.engine.stop(clean=True)
+        elif state['engine'] == 'geant4':
+            xc.geant4.engine.stop(clean=True)
+    timings.rewrite()
 
-if engine == 'fluka':
-    xc.fluka.engine.stop(clean=True)
-elif engine == 'geant4':
-    xc.geant4.engine.stop(clean=True)
-print(f"Total calculation time {time.time()-start_time}s")
+
+def teardown(state):
+    stop_engine(state)
 
 
-# turns, counts = np.unique(part.at_turn, return_counts=True)
-# print(turns, counts)
-# for turn in turns:
-#     mask = part.at_turn == turn
-#     print(f"Turn {turn}:")
-#     ss, cnts = np.unique(part.s[mask], return_counts=True)
-#     print(f"  {ss}, {cnts}")
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    state = setup(args['machine'], args['colldb'], args['engine'], [{'plane': args['plane']}], seed=args['seed'])
+    run_task(state, args['plane'], seed=args['seed'])
+    teardown(state)
+    print(f"Total calculation time {time.time()-start_time}s")
@@ -4,32 +4,55 @@ from pathlib import Path
 import time
 start_time = time.time()
 
+import xobjects as xo
 import xtrack as xt
 import xcoll as xc
 
+import prepared_line
+import checkpoint
+import timing
+import_seconds = time.time() - start_time
+
 
 # Pencil lossmap script, specialised for FCC-ee
 # =============================================
+#
+# Usage: python scripts/pencil.py machine colldb plane [engine] [seed]
+#
+# The line and engine are set up once in setup(), after which run_task() can be called for many
+# tasks (see worker.py); running the script directly does a single task.
 
 
 num_turns = 200
 # num_part = automatic: 50000 for Everest and 5000 for FLUKA and Geant4
 sigma_z  = 16.21e-3
-
-machine = sys.argv[1]
-colldb = sys.argv[2]
 beam = 1
-plane = sys.argv[3].upper()
-if len(sys.argv) > 4:
-    engine = sys.argv[4]
-else:
-    engine = 'geant4'  # Default
+
+# Arguments that can differ between the tasks of one setup
+TASK_ARGS = ['plane']
+
+
+def parse_args(argv):
+    args = {'machine': argv[0], 'colldb': argv[1], 'plane': argv[2].upper()}
+    if len(argv) > 3:
+        args['engine'] = argv[3]
+    else:
+        args['engine'] = 'geant4'  # Default
+    if len(argv) > 4:
+        args['seed'] = int(argv[4])
+    else:
+        args['seed'] = None  # Not reproducible
+    if args['engine'] not in ['everest', 'fluka', 'geant4', 'black']:
+        raise ValueError("Incorrect engine!")
+    if args['seed'] is not None and args['seed'] <= 0:
+        raise ValueError("Incorrect seed!")
+    check_task(args['plane'])
+    return args
 
 
-if plane not in ['H', 'V']:
-    raise ValueError("Incorrect plane!")
-if engine not in ['everest', 'fluka', 'geant4', 'black']:
-    raise ValueError("Incorrect engine!")
+def check_task(plane):
+    if plane not in ['H', 'V']:
+        raise ValueError("Incorrect plane!")
 
 
 class NullProgressIndicator(xt.progress_indicator.DefaultProgressIndicator):
@@ -43,90 +66,129 @@ class NullProgressIndicator(xt.progress_indicator.DefaultProgressIndicator):
 xt.progress_indicator.set_default_indicator(NullProgressIndicator)
 
 
-# Load machine and collimator database
-env = xt.load(machine)
-line = env.lines['fccee_p_ring']
-colldb = xc.CollimatorDatabase.from_yaml(colldb)
+def setup(machine, colldb, engine, tasks, seed=None):
+    # Load machine with the collimators installed and their optics assigned (from the cache made
+    # by prepared_line.py when it is there, otherwise built here)
+    timings = timing.Timings()
+    timings.add('imports', import_seconds)
+    env, line, colldb, tw = prepared_line.load(machine, colldb, engine, timings=timings)
+
+    if engine in ['fluka', 'geant4']:
+        num_part  = 5000
+        capacity = 10*num_part
+    else:
+        num_part  = 50000
+        capacity = None
+
+    # Number of OpenMP threads for the tracking
+    omp_threads = prepared_line.omp_threads()
+    print(f"OpenMP threads: {omp_threads}")
+    omp_context = xo.ContextCpu(omp_num_threads=omp_threads) if omp_threads > 1 else None
+
+    state = {'omp_context': omp_context, 'env': env, 'line': line, 'colldb': colldb, 'tw': tw, 'engine': engine,
+            'num_part': num_part, 'capacity': capacity, 'setup_timings': timings}
+
+    # Connect engine
+    start_engine(state, seed)
+    return state
+
+
+def run_task(state, plane, seed=None, outdir='.'):
+    line = state['line']
+    outdir = Path(outdir)
+    # The first task carries the setup phases (see timing.py)
+    timings = state.pop('setup_timings', None) or timing.Timings()
 
+    # Seed NumPy, which is used for the initial distribution and to initialise the Everest random generator
+    with timings.phase('particle_generation'):
+        if seed is not None:
+            np.random.seed(seed)
 
-# Install collimators into line
-aperture = xt.LimitEllipse(a=0.03, b=0.03)
-if engine == 'everest':
-    colldb.install_everest_collimators(line=line, verbose=True, apertures=aperture)
-elif engine == 'fluka':
-    colldb.install_fluka_collimators(line=line, verbose=True, apertures=aperture)
-elif engine == 'geant4':
-    colldb.install_geant4_collimators(line=line, verbose=True, apertures=aperture)
-elif engine == 'black':
-    colldb.install_black_absorbers(line=line, verbose=True, apertures=aperture)
+        # Generate initial pencil distribution on horizontal collimator
+        tcp  = f"tcp.{plane.lower()}.b{beam}"
+        part = line[tcp].generate_pencil(state['num_part'], sigma_z=sigma_z, _capacity=state['capacity'])
 
 
-# Configure collimators
-tw = line.twiss()
-line.collimators.assign_optics(twiss=tw)
+    # Move the line to an OpenMP context to be able to use all cores
+    with timings.phase('tracker_build'):
+        if state['omp_context'] is not None:
+            prepared_line.use_context(line, state['omp_context'])
 
 
-# Connect engine
-if engine == 'fluka':
-    num_part  = 5000
-    capacity = 10*num_part
-    xc.fluka.engine.capacity = capacity
-    xc.fluka.engine.relative_capacity = 50
-    xc.fluka.engine.start(line=line, cwd='.', clean=True, verbose=True)
-elif engine == 'geant4':
-    num_part  = 5000
-    capacity = 10*num_part
-    xc.geant4.engine.start(line=line, cwd='.', clean=True, verbose=True)
-else:
-    num_part  = 50000
-    capacity = None
+    # Switch on radiation
+    line.configure_radiation(model='quantum')
 
 
-# Generate initial pencil distribution on horizontal collimator
-tcp  = f"tcp.{plane.lower()}.b{beam}"
-part = line[tcp].generate_pencil(num_part, sigma_z=sigma_z, _capacity=capacity)
+    # Track!
+    # (in chunks of turns, checkpointing in between, such that an evicted job can resume)
+    task = {'script': 'pencil', 'plane': plane, 'engine': state['engine'], 'seed': seed}
+    line.scattering.enable()
+    with timings.phase('tracking'):
+        part, tracking_time = checkpoint.track(line, part, num_turns, task, outdir=outdir, with_progress=5)
+    line.scattering.disable()
+    print(f"Done tracking in {tracking_time:.1f}s.")
 
 
-# # Move the line to an OpenMP context to be able to use all cores
-# import xobjects as xo
-# line.discard_tracker()
-# line.build_tracker(_context=xo.ContextCpu(omp_num_threads=12))
+    # Switch off radiation
+    line.configure_radiation(model=None)
 
 
-# Switch on radiation
-line.configure_radiation(model='quantum')
+    # Move the line back to the default context to be able to use all prebuilt kernels for the aperture interpolation
+    with timings.phase('tracker_build'):
+        if state['omp_context'] is not None:
+            prepared_line.use_context(line, xo.ContextCpu())
 
 
-# Track!
-line.scattering.enable()
-line.track(part, num_turns=num_turns, time=True, with_progress=5)
-line.scattering.disable()
-print(f"Done tracking in {line.time_last_track:.1f}s.")
+    # Make lossmap
+    with timings.phase('interpolation'):
+        ThisLM = xc.LossMap(line, line_is_reversed=False, part=part)
+    print(f"Done interpolating in {timings.phases['interpolation']:.1f}s")
 
+    # Write the outputs
+    with timings.phase('output_writing'):
+        ThisLM.to_json(file=str(outdir / f'lossmap_B{beam}{plane}.json'))
 
-# Switch off radiation
-line.configure_radiation(model=None)
+        # Save a summary of the collimator losses to a text file
+        ThisLM.save_summary(file=str(outdir / f'coll_summary_B{beam}{plane}.out'))
+    checkpoint.remove(outdir)
+    timings.write(outdir / timing.timing_file, script='pencil', plane=plane,
+                  engine=state['engine'], seed=seed)
+    state['task_timings'] = timings  # The engine stop is added in teardown
+    print(ThisLM.summary)
 
 
-# # Move the line back to the default context to be able to use all prebuilt kernels for the aperture interpolation
-# line.discard_tracker()
-# line.build_tracker(_context=xo.ContextCpu())
+def start_engine(state, seed=None):
+    # Connect engine (the FLUKA and Geant4 engines take the seed when they start). Part of setup(),
+    # and used by worker.py to restart the engine on the same line for a task with another seed.
+    timings = state.setdefault('setup_timings', timing.Timings())
+    with timings.phase('engine_start'):
+        if state['engine'] == 'fluka':
+            xc.fluka.engine.capacity = state['capacity']
+            xc.fluka.engine.relative_capacity = 50
+            xc.fluka.engine.start(line=state['line'], cwd='.', clean=True, verbose=True, seed=seed)
+        elif state['engine'] == 'geant4':
+            xc.geant4.engine.start(line=state['line'], cwd='.', clean=True, verbose=True, seed=seed)
+    state['engine_seed'] = seed
 
 
-# Make lossmap
-start_interp = time.time()
-ThisLM = xc.LossMap(line, line_is_reversed=False, part=part)
-ThisLM.to_json(file=f'lossmap_B{beam}{plane}.json')
-print(f"Done interpolating in {time.time()-start_interp:.1f}s")
+def stop_engine(state):
+    # The engine stop is added to the timings of the last task
+    timings = state.pop('task_timings', None) or timing.Timings()
+    with timings.phase('engine_stop'):
+        if state['engine'] == 'fluka':
+            xc.fluka.engine.stop(clean=True)
+        elif state['engine'] == 'geant4':
+            xc.geant4.engine.stop(clean=True)
+    timings.rewrite()
 
-# Save a summary of the collimator losses to a text file
-ThisLM.save_summary(file=f'coll_summary_B{beam}{plane}.out')
-print(ThisLM.summary)
 
+def teardown(state):
+    stop_engine(state)
 
-if engine == 'fluka':
-    xc.fluka.engine.stop(clean=True)
-elif engine == 'geant4':
-    xc.geant4.engine.stop(clean=True)
-print(f"Total calculation time {time.time()-start_time}s")
 
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    state = setup(args['machine'], args['colldb'], args['engine'], [{'plane': args['plane']}], seed=args['seed'])
+    run_task(state, args['plane'], seed=args['seed'])
+    teardown(state)
+    print(f"Total calculation time {time.time()-start_time}s")
@@ -0,0 +1,154 @@
+import os
+import sys
+import hashlib
+import numpy as np
+from pathlib import Path
+import time
+
+import xtrack as xt
+import xcoll as xc
+
+import timing
+
+
+# Prepared-line cache: the collimated machine, built once per study instead of once per job
+# =========================================================================================
+#
+# Usage: python scripts/prepared_line.py machine colldb engine [outdir]
+#
+# Loading the machine, installing the collimators, the twiss and assigning the collimator optics
+# are identical for all jobs that share a (machine, colldb, engine) triple. This stores the result
+# as <outdir>/<key>.json.gz (the environment with the collimated line) and <key>.optics.npz (the
+# twiss quantities and beam sizes the scripts need), with the key a hash of the content of the
+# machine and colldb files, the engine and the xtrack and xcoll versions (the serialised line and
+# the collimator installation change between them), such that a stale cache is never picked up.
+# The default outdir is data/prepared/ next to the machine file, where the scripts look for it.
+
+line_name = 'fccee_p_ring'
+aperture = xt.LimitEllipse(a=0.03, b=0.03)
+
+
+def cache_key(machine, colldb, engine):
+    h = hashlib.sha256()
+    for path in [machine, colldb]:
+        with open(path, 'rb') as fid:
+            for chunk in iter(lambda: fid.read(1 << 20), b''):
+                h.update(chunk)
+    h.update(engine.encode())
+    h.update(f'xtrack {xt.__version__} xcoll {xc.__version__}'.encode())
+    return h.hexdigest()[:24]
+
+
+def cache_dir(machine):
+    return Path(machine).parent / 'prepared'
+
+
+def build(machine, colldb, engine, timings=None):
+    # The same steps as the scripts used to do themselves
+    timings = timings or timing.Timings()
+    with timings.phase('xt_load'):
+        env = xt.load(machine)
+        line = env.lines[line_name]
+    with timings.phase('collimator_install'):
+        colldb = xc.CollimatorDatabase.from_yaml(colldb)
+        if engine == 'everest':
+            colldb.install_everest_collimators(line=line, verbose=True, apertures=aperture)
+        elif engine == 'fluka':
+            colldb.install_fluka_collimators(line=line, verbose=True, apertures=aperture)
+        elif engine == 'geant4':
+            colldb.install_geant4_collimators(line=line, verbose=True, apertures=aperture)
+        elif engine == 'black':
+            colldb.install_black_absorbers(line=line, verbose=True, apertures=aperture)
+    with timings.phase('twiss'):
+        tw = line.twiss()
+        line.collimators.assign_optics(twiss=tw)
+    return env, line, colldb, tw
+
+
+def prepare(machine, colldb, engine, outdir=None):
+    outdir = Path(outdir) if outdir else cache_dir(machine)
+    key = cache_key(machine, colldb, engine)
+    env_file = outdir / f'{key}.json.gz'
+    optics_file = outdir / f'{key}.optics.npz'
+    if env_file.exists() and optics_file.exists():
+        print(f"Prepared line for {Path(machine).name}, {Path(colldb).name}, {engine} already in {outdir}")
+        return env_file
+    env, line, colldb, tw = build(machine, colldb, engine)
+    sigmas = tw.get_beam_covariance(nemitt_x=colldb.nemitt_x, nemitt_y=colldb.nemitt_y)
+    outdir.mkdir(parents=True, exist_ok=True)
+    # Write to temporary files first, such that a failed preparation does not leave a broken cache
+    tmp_env = outdir / f'{key}.tmp.json.gz'
+    tmp_optics = outdir / f'{key}.tmp.optics.npz'
+    env.to_json(tmp_env)
+    np.savez_compressed(tmp_optics, T_rev0=tw.T_rev0, qx=tw.qx, qy=tw.qy, name=np.array(sigmas.name, dtype=str),
+                        sigma_x=sigmas.sigma_x, sigma_y=sigmas.sigma_y)
+    tmp_optics.rename(optics_file)
+    tmp_env.rename(env_file)
+    print(f"Prepared line for {Path(machine).name}, {Path(colldb).name}, {engine} written to {env_file}")
+    return env_file
+
+
+def omp_threads():
+    # OpenMP threads for the tracking: the cores HTCondor gave the job (request_cpus, see submission.sub)
+    return max(1, int(os.environ.get('OMP_NUM_THREADS', 1)))
+
+
+def use_context(line, context):
+    line.discard_tracker()
+    line.build_tracker(_context=context)
+
+
+class PreparedOptics:
+    # The part of the twiss the scripts use when the line comes from the cache
+    def __init__(self, data):
+        self.T_rev0 = float(data['T_rev0'])
+        self.qx = float(data['qx'])
+        self.qy = float(data['qy'])
+        self.sigmas = xt.Table({'name': data['name'].astype(object), 'sigma_x': data['sigma_x'],
+                                'sigma_y': data['sigma_y']})
+
+    def get_beam_covariance(self, **kwargs):
+        return self.sigmas
+
+
+def load(machine, colldb, engine, timings=None):
+    # Returns env, line, colldb and the twiss (a PreparedOptics when coming from the cache), with the
+    # collimators installed and their optics assigned. Falls back to building when there is no cache.
+    # The phases are added to timings (see timing.py) when given.
+    timings = timings or timing.Timings()
+    colldb_file = colldb
+    with timings.phase('collimator_install'):
+        colldb = xc.CollimatorDatabase.from_yaml(colldb_file)
+    outdir = cache_dir(machine)
+    if outdir.is_dir():
+        key = cache_key(machine, colldb_file, engine)
+        env_file = outdir / f'{key}.json.gz'
+        optics_file = outdir / f'{key}.optics.npz'
+        if env_file.exists() and optics_file.exists():
+            start = time.time()
+            with timings.phase('xt_load'):
+                env = xt.load(env_file)
+                line = env.lines[line_name]
+                with np.load(optics_file) as data:
+                    tw = PreparedOptics(data)
+            # Older xcoll versions do not serialise the assigned optics
+            colls, _ = line.get_elements_of_type(xc.BaseCollimator)
+            if not all(coll.optics_ready() for coll in colls):
+                print("Collimator optics not in the prepared line, assigning them again")
+                with timings.phase('twiss'):
+                    line.collimators.assign_optics(twiss=line.twiss())
+            print(f"Loaded prepared line {env_file.name} in {time.time()-start:.1f}s")
+            return env, line, colldb, tw
+    print("No prepared line found, building it")
+    env, line, _, tw = build(machine, colldb_file, engine, timings=timings)
+    return env, line, colldb, tw
+
+
+if __name__ == "__main__":
+    machine = sys.argv[1]
+    colldb = sys.argv[2]
+    engine = sys.argv[3]
+    outdir = sys.argv[4] if len(sys.argv) > 4 else None
+    if engine not in ['everest', 'fluka', 'geant4', 'black']:
+        raise ValueError("Incorrect engine!")
+    prepare(machine, colldb, engine, outdir)
@@ -0,0 +1,164 @@
+import os
+import sys
+import runpy
+import subprocess
+import time
+import traceback
+from pathlib import Path
+
+import worker
+
+
+# Runner for bundled jobs: executes many jobs.list lines inside a single HTCondor job
+# ==================================================================================
+#
+# Usage: python scripts/run_bundle.py runfile nargs step1 args1... step2 args2...
+#
+# Every task is executed in sequence in this same python process (such that all imports
+# and compiled kernels are shared), with its outputs written to bundle_out/job_<step>.
+# When the runfile supports it and all tasks share the machine, colldb and engine, the tasks
+# run through worker.py, such that the line is only set up once (once per group of tasks that
+# need the same line; the FLUKA and Geant4 engines are restarted for every seed).
+#
+# Finished steps are appended to bundle_out/bundle_<first step>.done. When the job is evicted,
+# HTCondor transfers bundle_out/ (the done file and the checkpoints of the running task, see
+# checkpoint.py) to the case directory; job.sh -k exports that directory as CHECKPOINT_URL, from
+# which the restarted bundle fetches them back, such that it skips the finished steps and resumes
+# the tracking of the interrupted one. The done file and the fetched checkpoints are removed once
+# the bundle ran to the end.
+
+output_dir = Path('bundle_out')
+
+
+def parse_tasks(argv):
+    runfile = argv[0]
+    nargs = int(argv[1])
+    rest = argv[2:]
+    if nargs < 0 or len(rest) % (nargs + 1) != 0:
+        raise ValueError(f"Malformed bundle: expected groups of one step and {nargs} arguments.")
+    tasks = []
+    for i in range(0, len(rest), nargs + 1):
+        tasks.append((int(rest[i]), rest[i+1:i+1+nargs]))
+    return runfile, tasks
+
+
+def resolve(arg):
+    # Arguments that point to files (machine, colldb, ...) are made absolute, as every task
+    # runs inside its own output directory
+    return str(Path(arg).resolve()) if Path(arg).exists() else arg
+
+
+def worker_module(runfile, tasks):
+    # The runfile as a module when all tasks can share one setup, otherwise None
+    module = worker.load_runfile(runfile)
+    if module is None:
+        return None
+    try:
+        setups = {tuple(module.parse_args(args)[key] for key in ['machine', 'colldb', 'engine']) for _, args in tasks}
+    except Exception:
+        # Let the tasks fail one by one
+        return None
+    return module if len(setups) == 1 else None
+
+
+def fetch(url, path):
+    # Copy a file from EOS, returns whether it was there
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    try:
+        result = subprocess.run(['xrdcp', '-s', '-f', url, str(path)], stderr=subprocess.DEVNULL)
+    except FileNotFoundError:
+        return False
+    if result.returncode != 0:
+        Path(path).unlink(missing_ok=True)
+        return False
+    return True
+
+
+def remove_remote(url, paths):
+    # Remove files (relative to url) from EOS, as job.sh does with the checkpoint of a single job
+    host, base = url.split('root://', 1)[-1].split('/', 1)
+    for path in paths:
+        try:
+            subprocess.run(['xrdfs', host, 'rm', f"/{base.rstrip('/')}/{path}"], stderr=subprocess.DEVNULL)
+        except FileNotFoundError:
+            return
+
+
+def resume(url, tasks, done_file):
+    # Fetch the done file and the checkpoints an evicted run of this bundle left on EOS. Returns
+    # the remote files that are stale once the bundle finished.
+    if not url or not fetch(f"{url}/{done_file.name}", done_file):
+        return []
+    done = worker.read_done(done_file)
+    print(f"Resuming bundle: {len(done)} of {len(tasks)} tasks done", flush=True)
+    stale = [done_file.name] + [f'job_{step}/checkpoint.pkl' for step, _ in tasks if step in done]
+    for step, _ in tasks:
+        checkpoint = f'job_{step}/checkpoint.pkl'
+        if step not in done and fetch(f"{url}/{checkpoint}", output_dir / checkpoint):
+            print(f"Fetched checkpoint of step {step}", flush=True)
+            stale.append(checkpoint)
+    return stale
+
+
+def run_task(runfile, step, args):
+    job_dir = output_dir / f'job_{step}'
+    job_dir.mkdir(parents=True, exist_ok=True)
+    old_cwd = Path.cwd()
+    old_argv = sys.argv
+    try:
+        os.chdir(job_dir)
+        sys.argv = [str(runfile), *args]
+        runpy.run_path(str(runfile), run_name='__main__')
+    finally:
+        sys.argv = old_argv
+        os.chdir(old_cwd)
+
+
+if __name__ == "__main__":
+    start_time = time.time()
+    runfile, tasks = parse_tasks(sys.argv[1:])
+    runfile = Path(runfile).resolve()
+    # Make the helper modules next to the runfile importable, as when running it directly
+    sys.path.insert(0, str(runfile.parent))
+    print(f"Running bundle of {len(tasks)} tasks of {runfile.name}", flush=True)
+
+    tasks = [(step, [resolve(arg) for arg in args]) for step, args in tasks]
+    output_dir.mkdir(parents=True, exist_ok=True)
+    done_file = output_dir / f'bundle_{tasks[0][0]}.done'
+    url = os.environ.get('CHECKPOINT_URL', '')
+    stale = resume(url, tasks, done_file)
+    # Created up front, such that an evicted run always leaves one
+    done_file.touch()
+    module = worker_module(runfile, tasks)
+    if module is not None:
+        failed = worker.run_tasks(module, tasks, outdir=output_dir, done_file=done_file)
+    else:
+        failed = []
+        done = worker.read_done(done_file)
+        for i, (step, args) in enumerate(tasks):
+            if step in done:
+                continue
+            print(f"\n=== Task {i+1}/{len(tasks)}: step {step}, args {' '.join(args)} ===", flush=True)
+            task_start = time.time()
+            try:
+                run_task(runfile, step, args)
+            except SystemExit as e:
+                if e.code not in (None, 0):
+                    print(f"Task exited with code {e.code}", flush=True)
+                    failed.append(step)
+            except Exception:
+                traceback.print_exc()
+                failed.append(step)
+            if step not in failed:
+                worker.mark_done(done_file, step)
+            print(f"=== Task {i+1}/{len(tasks)} finished in {time.time()-task_start:.1f}s ===", flush=True)
+
+    # The bundle ran to the end, so its resume files are stale (a later resubmission starts afresh)
+    done_file.unlink()
+    if url:
+        remove_remote(url, stale)
+
+    print(f"\nBundle done in {time.time()-start_time:.1f}s: {len(tasks)-len(failed)} succeeded, "
+          + f"{len(failed)} failed{' (steps ' + ', '.join(map(str, failed)) + ')' if failed else ''}.")
+    if failed:
+        sys.exit(1)
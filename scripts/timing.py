@@ -0,0 +1,62 @@
+import os
+import json
+import resource
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+
+# Per-phase timing records, written by every task next to its outputs
+# ===================================================================
+#
+# The scripts time their phases (imports, xt_load, collimator_install, twiss, engine_start,
+# particle_generation, tracker_build, tracking, interpolation, output_writing, engine_stop, and
+# script-specific ones like exciter_install) and write them to timing.json in the task output
+# directory, together with the peak RSS of the process and of its children (the scattering
+# engines run in a subprocess). In a bundle the setup phases are in the record of the first task
+# and the engine stop in the record of the last one, such that the records add up per shard.
+# results/postprocess.py aggregates the records of a case into percentile tables.
+
+timing_file = 'timing.json'
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux
+    return {'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'peak_rss_children_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024}
+
+
+class Timings:
+    def __init__(self):
+        self.phases = {}
+        self.path = None
+        self.info = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.) + seconds
+
+    def record(self):
+        return {**self.info, 'phases': {kk: round(vv, 4) for kk, vv in self.phases.items()},
+                'total': round(sum(self.phases.values()), 4), **peak_rss_mb()}
+
+    def write(self, path, **info):
+        # Written to a temporary file first, as a record can be rewritten (see rewrite)
+        self.path = Path(path)
+        self.info = info
+        tmp = self.path.with_name(f'{self.path.name}.tmp')
+        with tmp.open('w') as fid:
+            json.dump(self.record(), fid, indent=1)
+        os.replace(tmp, self.path)
+
+    def rewrite(self):
+        # Update a written record with the phases added since (like the engine stop)
+        if self.path is not None:
+            self.write(self.path, **self.info)
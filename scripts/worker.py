@@ -0,0 +1,142 @@
+import os
+import sys
+import importlib
+import time
+import traceback
+from pathlib import Path
+
+
+# Persistent worker: runs many tasks of a script with a single line and scattering engine
+# ======================================================================================
+#
+# Usage: python scripts/worker.py runfile queue [outdir]
+#
+# Every line in the queue file is 'step args...', with args the arguments the runfile would get
+# on the command line. All tasks need the same machine, colldb and engine; they can differ in the
+# task arguments of the runfile (TASK_ARGS, e.g. plane) and the seed. The line is loaded once per
+# group of tasks with the same arguments that change the line (the optional SETUP_ARGS of the
+# runfile, e.g. the exciters of fast_instability), after which every task only resets the
+# particles and writes its outputs to <outdir>/job_<step>/ (default outdir: bundle_out). The FLUKA
+# and Geant4 engines take the seed when they start, so they are restarted (on the same line, with
+# the start_engine and stop_engine of the runfile) for every task with another seed, such that a
+# task gives the same result as when it runs on its own. Finished steps are appended to
+# <queue>.done, such that a restarted worker skips them.
+
+output_dir = Path('bundle_out')
+
+# Engines that are seeded when they start (and not per task)
+seeded_engines = ['fluka', 'geant4']
+
+
+def load_runfile(runfile):
+    # Returns the runfile as a module, or None if it cannot run as a worker (no setup/run_task)
+    runfile = Path(runfile).resolve()
+    if str(runfile.parent) not in sys.path:
+        sys.path.insert(0, str(runfile.parent))
+    module = importlib.import_module(runfile.stem)
+    if not all(hasattr(module, name) for name in ['parse_args', 'setup', 'run_task', 'teardown', 'start_engine',
+                                                  'stop_engine', 'TASK_ARGS']):
+        return None
+    return module
+
+
+def read_queue(queue):
+    tasks = []
+    with open(queue, 'r') as fid:
+        for line in fid:
+            fields = line.split()
+            if fields:
+                tasks.append((int(fields[0]), fields[1:]))
+    return tasks
+
+
+def read_done(done_file):
+    if done_file is None or not Path(done_file).exists():
+        return set()
+    with open(done_file, 'r') as fid:
+        return {int(line) for line in fid if line.strip()}
+
+
+def mark_done(done_file, step):
+    # Synced, such that the step is in the file when the job is evicted right after
+    with open(done_file, 'a') as fid:
+        fid.write(f"{step}\n")
+        fid.flush()
+        os.fsync(fid.fileno())
+
+
+def run_tasks(module, tasks, outdir=output_dir, done_file=None):
+    # Returns the steps that failed
+    outdir = Path(outdir)
+    done = read_done(done_file)
+    tasks = [(step, args) for step, args in tasks if step not in done]
+    if not tasks:
+        print("No tasks left to run", flush=True)
+        return []
+    parsed = [(step, args, module.parse_args(args)) for step, args in tasks]
+    first = parsed[0][2]
+    for step, args, task in parsed:
+        if (task['machine'], task['colldb'], task['engine']) != (first['machine'], first['colldb'], first['engine']):
+            raise ValueError(f"Task {step} needs another machine, colldb or engine than the first task.")
+
+    # Tasks that can share a setup, in the order of the queue
+    groups = {}
+    for step, args, task in parsed:
+        key = tuple(task[name] for name in getattr(module, 'SETUP_ARGS', []))
+        groups.setdefault(key, []).append((step, args, task))
+
+    failed = []
+    i = 0
+    for group in groups.values():
+        group_first = group[0][2]
+        setup_start = time.time()
+        state = module.setup(first['machine'], first['colldb'], first['engine'],
+                             [{name: task[name] for name in module.TASK_ARGS} for _, _, task in group],
+                             seed=group_first['seed'])
+        setup_seconds = time.time() - setup_start
+        print(f"Set up line and engine in {setup_seconds:.1f}s", flush=True)
+        try:
+            for j, (step, args, task) in enumerate(group):
+                i += 1
+                # Same format as run_bundle.py, such that the cost model can be calibrated from the logs
+                print(f"\n=== Task {i}/{len(parsed)}: step {step}, args {' '.join(args)} ===", flush=True)
+                task_start = time.time()
+                job_dir = outdir / f'job_{step}'
+                job_dir.mkdir(parents=True, exist_ok=True)
+                try:
+                    if first['engine'] in seeded_engines and task['seed'] != state['engine_seed']:
+                        module.stop_engine(state)
+                        module.start_engine(state, task['seed'])
+                        print(f"Restarted engine with seed {task['seed']} in {time.time()-task_start:.1f}s",
+                              flush=True)
+                    module.run_task(state, **{name: task[name] for name in module.TASK_ARGS}, seed=task['seed'],
+                                    outdir=job_dir)
+                except Exception:
+                    traceback.print_exc()
+                    failed.append(step)
+                else:
+                    if done_file is not None:
+                        mark_done(done_file, step)
+                # The first task of a setup carries it, such that the times of all tasks add up to the total
+                print(f"Total calculation time {time.time()-task_start + (setup_seconds if j == 0 else 0)}s", flush=True)
+                print(f"=== Task {i}/{len(parsed)} finished in {time.time()-task_start:.1f}s ===", flush=True)
+        finally:
+            module.teardown(state)
+    return failed
+
+
+if __name__ == "__main__":
+    start_time = time.time()
+    runfile = sys.argv[1]
+    queue = sys.argv[2]
+    outdir = Path(sys.argv[3]) if len(sys.argv) > 3 else output_dir
+    module = load_runfile(runfile)
+    if module is None:
+        raise ValueError(f"{runfile} cannot run as a worker (it needs parse_args, setup, run_task and teardown).")
+    tasks = read_queue(queue)
+    print(f"Running worker for {len(tasks)} tasks of {Path(runfile).name}", flush=True)
+    failed = run_tasks(module, tasks, outdir=outdir, done_file=f'{queue}.done')
+    print(f"\nWorker done in {time.time()-start_time:.1f}s: {len(failed)} failed"
+          + f"{' (steps ' + ', '.join(map(str, failed)) + ')' if failed else ''}.")
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+import json
+import math
+import re
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from cost_model import CostModel
+from generate_jobs import (Job, bundle_jobs, iter_jobs, iter_missing_jobs, load_cases, max_steps_of,
+                           scan_study_outputs, validate_cases, write_sharded_jobs_list)
+from local_executor import read_index, run_local
+from manifest import ManifestWriter
+
+
+# Adaptive-statistics study controller
+# ====================================
+#
+# Instead of submitting all num_jobs steps of every case at once, steps are submitted in waves.
+# After every wave the new loss maps of each case are merged, one file at a time, with the
+# LossMapAccumulator of results/postprocess.py, and their LossMapStatistics (the per-job loss
+# fractions that combine_lossmaps reports in <output>.stats.out) are updated. The relative
+# statistical error of the mean fraction is checked (LossMapStatistics.convergence) for:
+#   - the losses on every collimator that takes at least --min-fraction of all collimator losses
+#   - the highest loss peak in the cold and in the warm regions
+# Only the steps whose jobs all finished are added. The steps with missing outputs (failed or
+# evicted jobs) are submitted again with the next wave, up to --max-retries times, and do not use
+# up the step budget. A case stops once all of these are below --target, or when its step budget
+# (the largest num_jobs of its entries, or --max-steps) is used up. The merged loss maps, the
+# state of their statistics and the progress are kept in studies/<study>/adaptive_state.json, such
+# that the controller can be restarted. The final results are made with results/postprocess.py as
+# usual.
+
+STATE_FILE = "adaptive_state.json"
+_cluster_re = re.compile(r"submitted to cluster (\d+)")
+
+
+def _postprocess():
+    # results/postprocess.py (imported when needed, as it needs xsuite)
+    results_dir = Path(__file__).resolve().parents[1] / "results"
+    if str(results_dir) not in sys.path:
+        sys.path.insert(0, str(results_dir))
+    import postprocess
+    return postprocess
+
+
+def load_state(study_dir: Path) -> Dict[str, Any]:
+    path = study_dir / STATE_FILE
+    if path.exists():
+        with path.open("r") as fid:
+            return json.load(fid)
+    return {"wave": 0, "cases": {}}
+
+
+def save_state(study_dir: Path, state: Dict[str, Any]) -> None:
+    study_dir.mkdir(parents=True, exist_ok=True)
+    tmp = study_dir / f"{STATE_FILE}.tmp"
+    with tmp.open("w") as fid:
+        json.dump(state, fid, indent=1)
+    tmp.replace(study_dir / STATE_FILE)
+
+
+def fold_wave(study_dir: Path, case: str, steps: Iterable[int], case_state: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+    # Add the loss maps of the (finished) steps to the merged loss map and the statistics of every
+    # loss map type (e.g. lossmap_B1H) of the case. Returns the number of loss maps added and the
+    # statistics per type.
+    pp = _postprocess()
+    lossmaps = case_state.setdefault("lossmaps", {})
+    saved = case_state.setdefault("stats", {})
+    stats = {}
+    for lm_type in lossmaps:
+        acc = pp.LossMapAccumulator()
+        acc.add(lossmaps[lm_type])
+        stats[lm_type] = pp.LossMapStatistics(acc)
+        stats[lm_type].merge_state(saved[lm_type])
+    num = 0
+    for step in steps:
+        job_dir = study_dir / case / f"job_{step}"
+        if not job_dir.is_dir():
+            continue
+        for path in sorted(job_dir.glob("lossmap_*.json")):
+            if path.stem not in stats:
+                stats[path.stem] = pp.LossMapStatistics(pp.LossMapAccumulator())
+            try:
+                added = stats[path.stem].acc.add_file(path)
+            except (OSError, ValueError):
+                continue
+            stats[path.stem].add(added)
+            num += 1
+    for lm_type, st in stats.items():
+        if st.num_jobs > 0:
+            lossmaps[lm_type] = st.acc.lossmap()
+            saved[lm_type] = st.state()
+    return num, {lm_type: st for lm_type, st in stats.items() if st.num_jobs > 0}
+
+
+def wave_jobs(cases, case_order, wave_steps: Dict[str, List[int]], model: Optional[CostModel] = None,
+              found: Optional[Dict[Tuple[str, int], Dict[str, int]]] = None) -> Iterable[Job]:
+    # The jobs of the steps of a wave whose outputs are not there (yet)
+    step_ranges = OrderedDict((case, (min(steps), max(steps) + 1)) for case, steps in wave_steps.items() if steps)
+    wanted = {case: set(steps) for case, steps in wave_steps.items()}
+    jobs = iter_jobs(cases, case_order, step_ranges=step_ranges, model=model)
+    jobs = (job for job in jobs if job.step in wanted[job.case])
+    return iter_missing_jobs(jobs, found if found is not None else {})
+
+
+def write_wave(cases, case_order, wave_steps: Dict[str, List[int]], study_dir: Path, wave_dir: Path,
+               model: CostModel, shard_size: int, longest_first: bool) -> Dict[str, Any]:
+    wave_dir.mkdir(parents=True, exist_ok=True)
+    # Do not rerun steps that are already there (e.g. after restarting the controller)
+    found = scan_study_outputs(study_dir, list(wave_steps))
+    jobs = bundle_jobs(wave_jobs(cases, case_order, wave_steps, model, found))
+    return write_sharded_jobs_list(jobs, wave_dir / "jobs.list", shard_size=shard_size,
+                                   manifest=ManifestWriter(cases, case_order), longest_first=longest_first)
+
+
+def run_wave_condor(wave_dir: Path, index: Dict[str, Any], study_name: str, study_path: Path,
+                    env_list: str, poll: float) -> None:
+    # Same submission as submit.sh, followed by waiting until all clusters of the wave are done
+    for name in ["job.sh", "submission.sub"]:
+        (wave_dir / name).write_bytes((Path(__file__).parent / name).read_bytes())
+    clusters = []
+    for shard in index["shards"]:
+        cmd = ["condor_submit", f"NAME={study_name}", f"PATH={study_path}"]
+        if env_list:
+            cmd.append(f"ENV_LIST={env_list}")
+        cmd += [f"{k}={v}" for k, v in shard["macros"].items()] + ["submission.sub"]
+        out = subprocess.run(cmd, cwd=wave_dir, check=True, capture_output=True, text=True).stdout
+        print(out.strip())
+        match = _cluster_re.search(out)
+        if match is None:
+            raise RuntimeError(f"Could not find the cluster ID in the condor_submit output:\n{out}")
+        clusters.append(match.group(1))
+    for cluster in clusters:
+        log = wave_dir / f"submission.{study_name}.{cluster}.log"
+        while subprocess.call(["condor_wait", "-wait", str(int(poll)), str(log)], cwd=wave_dir,
+                              stdout=subprocess.DEVNULL) != 0:
+            print(f"  waiting for cluster {cluster}...", flush=True)
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Run a study in waves until the loss maps are converged.")
+    ap.add_argument("--spec", required=True, help="YAML spec file")
+    ap.add_argument("--study-name", required=True, help="Study name, outputs go to studies/<study-name>")
+    ap.add_argument("--study-path", default=".", help="Directory containing scripts/, data/ and studies/ (default: .)")
+    ap.add_argument("--wave-steps", type=int, default=200, help="Steps per case per wave (default: 200)")
+    ap.add_argument("--min-steps", type=int, default=0,
+                    help="Steps to run before checking for convergence (default: one wave)")
+    ap.add_argument("--max-steps", type=int, default=0,
+                    help="Step budget per case (default: the largest num_jobs of its entries)")
+    ap.add_argument("--target", type=float, default=0.05,
+                    help="Target relative statistical error on the losses (default: 0.05)")
+    ap.add_argument("--min-fraction", type=float, default=0.01,
+                    help="Only check collimators with at least this fraction of the collimator losses (default: 0.01)")
+    ap.add_argument("--executor", choices=["local", "condor"], default="condor", help="How to run the waves")
+    ap.add_argument("--workers", type=int, default=0, help="Parallel jobs for --executor local (default: all cores)")
+    ap.add_argument("--submit-dir", default="", help="Where the wave job lists go (default: <study-name>/adaptive)")
+    ap.add_argument("--env-list", default="", help="Environments passed to job.sh, as ENV_LIST in submit.sh")
+    ap.add_argument("--cost-db", default="", help="Measured runtimes for the cost model (see cost_model.py)")
+    ap.add_argument("--shard-size", type=int, default=50000, help="Maximum number of jobs per cluster")
+    ap.add_argument("--max-retries", type=int, default=2,
+                    help="Times a step with missing outputs is submitted again before it is given up (default: 2)")
+    ap.add_argument("--longest-first", action="store_true",
+                    help="Order the jobs of every cluster by predicted runtime, longest first (see generate_jobs.py)")
+    ap.add_argument("--poll", type=float, default=300, help="Seconds between checks on running clusters")
+    args = ap.parse_args()
+
+    cases = load_cases(args.spec)
+    validate_cases(cases)
+    case_order = list(cases.keys())
+    study_path = Path(args.study_path).resolve()
+    study_dir = study_path / "studies" / args.study_name
+    submit_dir = Path(args.submit_dir) if args.submit_dir else study_path / args.study_name / "adaptive"
+    model = CostModel.from_json(args.cost_db) if args.cost_db else CostModel()
+    min_steps = args.min_steps or args.wave_steps
+
+    state = load_state(study_dir)
+    for case in case_order:
+        budget = args.max_steps or max_steps_of(cases, [case])
+        state["cases"].setdefault(case, {"next_step": 0, "num_steps": 0, "retries": {}, "given_up": 0,
+                                          "budget": budget, "done": False, "reason": ""})
+
+    while True:
+        active = [case for case in case_order if not state["cases"][case]["done"]]
+        if not active:
+            break
+        # The steps to retry and the next new steps of every case
+        wave_steps = OrderedDict()
+        new_steps = {}
+        for case in active:
+            cs = state["cases"][case]
+            new_steps[case] = (cs["next_step"], min(cs["next_step"] + args.wave_steps, cs["budget"]))
+            wave_steps[case] = sorted(int(step) for step in cs["retries"]) + list(range(*new_steps[case]))
+        wave = state["wave"]
+        print(f"\n=== Wave {wave}: " + ", ".join(
+            f"{case} " + " + ".join(([f"steps {lo}..{hi-1}"] if hi > lo else [])
+                                    + ([f"{len(wave_steps[case]) - (hi - lo)} retried"]
+                                       if len(wave_steps[case]) > hi - lo else []))
+            for case, (lo, hi) in new_steps.items()) + " ===", flush=True)
+        wave_dir = submit_dir / f"wave_{wave:03d}"
+        index = write_wave(cases, case_order, wave_steps, study_dir, wave_dir, model, args.shard_size,
+                           args.longest_first)
+        print(f"Wave {wave}: {index['total_lines']} lines ({index['total_tasks']} jobs)", flush=True)
+
+        start = time.time()
+        if index["total_lines"] > 0:
+            if args.executor == "local":
+                done, failed = run_local(read_index(wave_dir / "jobs.index.json"), study_path, args.study_name,
+                                         args.workers or None)
+                if failed:
+                    print(f"  {len(failed)} jobs failed, their steps are submitted again with the next wave")
+            else:
+                run_wave_condor(wave_dir, index, args.study_name, study_path, args.env_list, args.poll)
+        print(f"Wave {wave} ran in {time.time()-start:.0f}s", flush=True)
+
+        # Steps with an output still missing are not added, but retried
+        found = scan_study_outputs(study_dir, list(wave_steps))
+        incomplete = {(job.case, job.step) for job in wave_jobs(cases, case_order, wave_steps, found=found)}
+        for case, (lo, hi) in new_steps.items():
+            cs = state["cases"][case]
+            retries = cs["retries"]
+            finished = [step for step in wave_steps[case] if (case, step) not in incomplete]
+            num, stats = fold_wave(study_dir, case, finished, cs)
+            for step in finished:
+                retries.pop(str(step), None)
+            for step in wave_steps[case]:
+                if (case, step) in incomplete:
+                    retries[str(step)] = retries.get(str(step), -1) + 1
+                    if retries[str(step)] > args.max_retries:
+                        print(f"  [{case}] giving up on step {step} after {args.max_retries} retries")
+                        del retries[str(step)]
+                        cs["given_up"] += 1
+            cs["next_step"] = hi
+            cs["num_steps"] += len(finished)
+            cs["errors"] = {lm_type: {row["name"]: row["rel_err"] for row in st.convergence(args.min_fraction)}
+                            for lm_type, st in stats.items()}
+            worst = max((st.worst_rel_err(args.min_fraction) for st in stats.values()), default=math.inf)
+            print(f"  [{case}] +{num} loss maps, {cs['num_steps']} steps done, {len(retries)} to retry, "
+                  f"worst relative error {worst:.3g}")
+            if cs["num_steps"] >= min_steps and stats and worst <= args.target:
+                cs["done"], cs["reason"] = True, f"converged after {cs['num_steps']} steps"
+            elif hi >= cs["budget"] and not retries:
+                cs["done"], cs["reason"] = True, f"step budget of {cs['budget']} used up"
+            if cs["done"]:
+                print(f"  [{case}] done: {cs['reason']}")
+        state["wave"] = wave + 1
+        save_state(study_dir, state)
+
+    print("\nAll cases done:")
+    for case in case_order:
+        cs = state["cases"][case]
+        print(f"  [{case}] {cs['reason']}")
+
+
+if __name__ == "__main__":
+    main()
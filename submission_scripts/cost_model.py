@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import re
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from runfiles import engine_of, runfile_info
+
+
+# Rough single-core defaults for the FCC-ee lattice; these only seed the model and are
+# superseded by measured runtimes as soon as a cost database is calibrated.
+# Tracking time per particle per turn, per engine (in seconds)
+SECONDS_PER_PARTICLE_TURN = {
+    "everest": 4.0e-3,
+    "black":   3.5e-3,
+    "geant4":  6.0e-3,
+    "fluka":   8.0e-3,
+}
+# Time spent in the script before tracking (loading, installing, twiss, engine start)
+SCRIPT_OVERHEAD = {
+    "everest": 60.,
+    "black":   60.,
+    "geant4":  180.,
+    "fluka":   360.,
+}
+# Time spent in job.sh before the script starts (waiting for cvmfs, unpacking the environment)
+JOB_OVERHEAD = 120.
+# Assumed runtime for scripts we know nothing about
+UNKNOWN_RUNFILE_SECONDS = 3600.
+
+# HTCondor job flavours at CERN and their maximum wall time (in seconds)
+FLAVOURS: List[Tuple[str, float]] = [
+    ("espresso",     20*60),
+    ("microcentury", 60*60),
+    ("longlunch",    2*3600),
+    ("workday",      8*3600),
+    ("tomorrow",     24*3600),
+    ("testmatch",    3*24*3600),
+    ("nextweek",     7*24*3600),
+]
+# Flavour of jobs whose runtime is not calibrated with measurements (the default of submission.sub),
+# as the rough defaults above can be far off and a job that runs over its flavour is killed
+DEFAULT_FLAVOUR = "tomorrow"
+
+_command_re = re.compile(r"Using command:\s*python3?\s+(\S+)\s*(.*)$")
+_task_re    = re.compile(r"=== Task \d+/\d+: step \d+, args (.*) ===$")
+_total_re   = re.compile(r"Total calculation time ([0-9.eE+-]+)s")
+_threads_re = re.compile(r"OpenMP threads: (\d+)")
+
+
+def choose_flavour(seconds: float, margin: float = 1.5, calibrated: bool = True) -> str:
+    # Smallest flavour that fits the (longest) job with some safety margin. Predictions that are not
+    # calibrated never go below DEFAULT_FLAVOUR.
+    lowest = 0 if calibrated else [name for name, _ in FLAVOURS].index(DEFAULT_FLAVOUR)
+    for name, limit in FLAVOURS[lowest:]:
+        if seconds * margin <= limit:
+            return name
+    return FLAVOURS[-1][0]
+
+
+class CostModel:
+    # Predicts the runtime of a single job from its runfile and arguments. Predictions are
+    # seeded from num_part/num_turns of the runfile and refined with measured runtimes,
+    # stored per (runfile, engine, OpenMP threads) in a JSON database.
+
+    def __init__(self, measured: Optional[Dict[str, Dict[str, float]]] = None):
+        self.measured = measured if measured is not None else {}
+        self._cache: Dict[Tuple[str, str, int], float] = {}
+
+    @classmethod
+    def from_json(cls, path) -> "CostModel":
+        path = Path(path)
+        if not path.exists():
+            return cls()
+        with path.open("r") as fid:
+            return cls(json.load(fid).get("measured", {}))
+
+    def to_json(self, path) -> None:
+        with Path(path).open("w") as fid:
+            json.dump({"measured": self.measured}, fid, indent=2, sort_keys=True)
+
+    @staticmethod
+    def _key(runfile: str, engine: str, threads: int = 1) -> str:
+        key = f"{os.path.basename(runfile)}:{engine}"
+        return key if threads == 1 else f"{key}:omp{threads}"
+
+    def seeded_seconds(self, runfile: str, engine: str, threads: int = 1) -> float:
+        # Assumes the tracking scales perfectly with the number of OpenMP threads
+        info = runfile_info(runfile)
+        if info is None or "num_part" not in info:
+            return UNKNOWN_RUNFILE_SECONDS
+        num_part = info["num_part"]
+        if isinstance(num_part, dict):
+            num_part = num_part.get(engine, num_part["default"])
+        tracking = SECONDS_PER_PARTICLE_TURN[engine] * num_part * info["num_turns"]
+        return SCRIPT_OVERHEAD[engine] + tracking / threads
+
+    def is_measured(self, runfile: str, engine: str, threads: int = 1) -> bool:
+        # Whether the runtime of the runfile with this engine and number of threads is calibrated
+        measured = self.measured.get(self._key(runfile, engine, threads))
+        return measured is not None and measured["n"] > 0
+
+    def script_seconds(self, runfile: str, engine: str, threads: int = 1) -> float:
+        key = (runfile, engine, threads)
+        if key not in self._cache:
+            measured = self.measured.get(self._key(runfile, engine, threads))
+            single = self.measured.get(self._key(runfile, engine))
+            if measured is not None and measured["n"] > 0:
+                self._cache[key] = measured["mean"]
+            elif threads > 1 and single is not None and single["n"] > 0:
+                # Only measured on a single core: scale everything but the script overhead
+                overhead = min(SCRIPT_OVERHEAD[engine], single["mean"])
+                self._cache[key] = overhead + (single["mean"] - overhead) / threads
+            else:
+                self._cache[key] = self.seeded_seconds(runfile, engine, threads)
+        return self._cache[key]
+
+    def task_seconds(self, runfile: str, args: Sequence[str], threads: int = 1) -> float:
+        # Time of the script itself, without the job bootstrap
+        return self.script_seconds(runfile, engine_of(runfile, args), threads)
+
+    def task_measured(self, runfile: str, args: Sequence[str], threads: int = 1) -> bool:
+        return self.is_measured(runfile, engine_of(runfile, args), threads)
+
+    def job_seconds(self, tasks: Iterable[Tuple[str, Sequence[str]]], threads: int = 1) -> float:
+        # A job (or a bundle of jobs) pays the bootstrap once
+        return JOB_OVERHEAD + sum(self.task_seconds(runfile, args, threads) for runfile, args in tasks)
+
+    def add_measurement(self, runfile: str, engine: str, seconds: float, threads: int = 1) -> None:
+        entry = self.measured.setdefault(self._key(runfile, engine, threads), {"n": 0, "mean": 0.})
+        entry["n"] += 1
+        entry["mean"] += (seconds - entry["mean"]) / entry["n"]
+        self._cache.clear()
+
+    def calibrate_from_logs(self, paths: Iterable[Path]) -> int:
+        # Parse the job stdout files (<cluster>__job<process>.out) for the command that was run
+        # and the 'Total calculation time' the script printed (once per task for bundles), with
+        # the number of OpenMP threads the script reported
+        num = 0
+        for path in paths:
+            runfile, args, threads = None, None, 1
+            with Path(path).open("r", errors="replace") as fid:
+                for line in fid:
+                    line = line.rstrip()
+                    match = _command_re.search(line)
+                    if match:
+                        runfile, args = match.group(1), match.group(2).split()
+                        if Path(runfile).name == "run_bundle.py":
+                            runfile, args = args[0], None
+                        continue
+                    match = _task_re.search(line)
+                    if match:
+                        args = match.group(1).split()
+                        continue
+                    match = _threads_re.search(line)
+                    if match:
+                        threads = int(match.group(1))
+                        continue
+                    match = _total_re.search(line)
+                    if match and runfile is not None and args is not None:
+                        self.add_measurement(runfile, engine_of(runfile, args), float(match.group(1)), threads)
+                        num += 1
+        return num
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Calibrate the job runtime cost model from earlier studies.")
+    ap.add_argument("--db", default="cost_model.json", help="Cost database (default: cost_model.json)")
+    ap.add_argument(
+        "--calibrate",
+        nargs="+",
+        default=[],
+        metavar="DIR",
+        help="Submission directories (or .out files) of earlier studies to take measured runtimes from",
+    )
+    args = ap.parse_args()
+
+    model = CostModel.from_json(args.db)
+    files: List[Path] = []
+    for path in map(Path, args.calibrate):
+        files.extend(sorted(path.glob("*.out")) if path.is_dir() else [path])
+    if files:
+        num = model.calibrate_from_logs(files)
+        print(f"Added {num} measured runtimes from {len(files)} files")
+        model.to_json(args.db)
+        print(f"Wrote: {args.db}")
+
+    for key, entry in sorted(model.measured.items()):
+        print(f"  {key}: {entry['mean']:.1f}s (n={entry['n']})")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,16 +2,32 @@
 from __future__ import annotations
 
 import io
+import json
 import argparse
 import itertools
 import math
+import os
 from collections import OrderedDict
 from pathlib import Path
-from typing import Any, Dict, Iterable, List, Tuple
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
 
 from ruamel.yaml import YAML
 yaml = YAML(typ='safe')
 
+from cost_model import JOB_OVERHEAD, CostModel, choose_flavour
+from manifest import ManifestWriter, manifest_path
+from result_cache import ResultCache, job_seed
+from runfiles import arg_template, expected_outputs, fill_args
+
+# Runner used to execute bundled lines (relative to the unpacked job sandbox)
+BUNDLE_RUNNER = "scripts/run_bundle.py"
+
+# Number of lines collected in memory before writing them to disk in one go
+WRITE_CHUNK_LINES = 65536
+
+# Lines of a shard without a size limit that are ordered longest-first together
+LONGEST_FIRST_WINDOW = 50000
+
 
 def load_cases(file):
     if isinstance(file, io.IOBase):
@@ -56,19 +72,33 @@ def validate_cases(cases: "OrderedDict[str, List[Dict[str, Any]]]") -> None:
                 raise ValueError(f"Case '{case}' entry #{i}: 'args' must be a list of lists")
             if any(["$JOBID" in [str(xx).upper() for xx in x] and len(x) > 1 for x in e["args"]]):
                 raise ValueError(f"Case '{case}' entry #{i}: $JobID must be the only element in an args list")
+            if any(["$SEED" in [str(xx).upper() for xx in x] and len(x) > 1 for x in e["args"]]):
+                raise ValueError(f"Case '{case}' entry #{i}: $Seed must be the only element in an args list")
             nj = int(e["num_jobs"])
             if nj <= 0:
                 raise ValueError(f"Case '{case}' entry #{i}: num_jobs must be > 0")
+            if int(e.get("bundle_size", 1)) <= 0:
+                raise ValueError(f"Case '{case}' entry #{i}: bundle_size must be > 0")
+            if int(e.get("omp_threads", 1)) <= 0:
+                raise ValueError(f"Case '{case}' entry #{i}: omp_threads must be > 0")
 
 
-def summarise(cases: "OrderedDict[str, List[Dict[str, Any]]]", case_order: List[str]) -> Dict[str, Any]:
+def summarise(
+    cases: "OrderedDict[str, List[Dict[str, Any]]]",
+    case_order: List[str],
+    model: CostModel,
+) -> Dict[str, Any]:
     per_case = {}
     total_lines = 0
+    total_queue_items = 0
+    total_seconds = 0.
     max_steps = 0
 
     for case in case_order:
         entries = cases[case]
         case_lines = 0
+        case_queue_items = 0
+        case_seconds = 0.
         case_steps = 0
 
         entry_summaries = []
@@ -76,7 +106,17 @@ def summarise(cases: "OrderedDict[str, List[Dict[str, Any]]]", case_order: List[
             nj = int(e["num_jobs"])
             ncomb = product_count(e["args"])
             lines = nj * ncomb
+            bundle_size = int(e.get("bundle_size", 1))
+            threads = int(e.get("omp_threads", 1))
+            queue_items = math.ceil(lines / bundle_size)
+            runfile = str(e["runfile"])
+            seconds = nj * sum(model.task_seconds(runfile, [str(x) for x in combo], threads)
+                               for combo in iter_combos(e["args"]))
+            # Wall time, and every job occupies all of its cores
+            seconds = (seconds + queue_items * JOB_OVERHEAD) * threads
             case_lines += lines
+            case_queue_items += queue_items
+            case_seconds += seconds
             case_steps = max(case_steps, nj)
             entry_summaries.append(
                 {
@@ -84,6 +124,10 @@ def summarise(cases: "OrderedDict[str, List[Dict[str, Any]]]", case_order: List[
                     "num_jobs": nj,
                     "combos_per_step": ncomb,
                     "lines": lines,
+                    "bundle_size": bundle_size,
+                    "omp_threads": threads,
+                    "queue_items": queue_items,
+                    "cpu_hours": seconds / 3600,
                 }
             )
 
@@ -92,36 +136,367 @@ def summarise(cases: "OrderedDict[str, List[Dict[str, Any]]]", case_order: List[
             "num_steps": case_steps,
             "entries": entry_summaries,
             "lines": case_lines,
+            "queue_items": case_queue_items,
+            "cpu_hours": case_seconds / 3600,
         }
         total_lines += case_lines
+        total_queue_items += case_queue_items
+        total_seconds += case_seconds
         max_steps = max(max_steps, case_steps)
 
-    return {"per_case": per_case, "total_lines": total_lines, "max_steps": max_steps}
+    return {
+        "per_case": per_case,
+        "total_lines": total_lines,
+        "total_queue_items": total_queue_items,
+        "total_cpu_hours": total_seconds / 3600,
+        "max_steps": max_steps,
+    }
 
 
-def write_jobs_list(
-    cases: "OrderedDict[str, List[Dict[str, Any]]]",
-    case_order: List[str],
-    out_path: Path,
-) -> None:
-    # Interleave by step, then by case, then by entry, then by cartesian combo
+def max_steps_of(cases: "OrderedDict[str, List[Dict[str, Any]]]", case_order: List[str]) -> int:
     max_steps = 0
     for case in case_order:
         for e in cases[case]:
             max_steps = max(max_steps, int(e["num_jobs"]))
+    return max_steps
 
-    with out_path.open("w") as out:
-        for step in range(max_steps):
-            for case in case_order:
-                for e in cases[case]:
-                    nj = int(e["num_jobs"])
-                    if step >= nj:
-                        continue
-                    runfile = str(e["runfile"])
-                    for combo in iter_combos(e["args"]):
-                        fields = [case, str(step), runfile, *map(str, combo)]
-                        fields = [str(step) if f.upper() == '$JOBID' else f for f in fields]
-                        out.write(" ".join(fields) + "\n")
+
+class Job(NamedTuple):
+    case: str
+    step: int
+    entry: Dict[str, Any]
+    fields: List[str]
+    steps: Tuple[int, ...]
+    bundled: bool
+    seconds: float = 0.
+    entry_index: int = 0
+    combos: Tuple[int, ...] = ()
+    threads: int = 1
+    measured: bool = False  # Whether seconds comes from calibrated runtimes
+
+
+def iter_jobs(
+    cases: "OrderedDict[str, List[Dict[str, Any]]]",
+    case_order: List[str],
+    step_ranges: Optional[Dict[str, Tuple[int, int]]] = None,
+    model: Optional[CostModel] = None,
+) -> Iterable[Job]:
+    # Interleave by step, then by case, then by entry, then by cartesian combo. With step_ranges,
+    # only the steps in [first, stop) of the cases in it are generated. With a model, the predicted
+    # runtime (including the job bootstrap) is attached to every job.
+    if step_ranges is None:
+        first_step, max_steps = 0, max_steps_of(cases, case_order)
+    else:
+        case_order = [case for case in case_order if case in step_ranges]
+        if not case_order:
+            return
+        first_step = min(step_ranges[case][0] for case in case_order)
+        max_steps = max(step_ranges[case][1] for case in case_order)
+
+    # The argument template (see runfiles.arg_template) and runtime of every combo of every entry,
+    # made once, such that a line only needs its step filled in
+    entries = {}
+    for case in case_order:
+        entries[case] = []
+        for entry_index, e in enumerate(cases[case]):
+            runfile = str(e["runfile"])
+            threads = int(e.get("omp_threads", 1))
+            combos = []
+            for combo_index, combo in enumerate(iter_combos(e["args"])):
+                template = arg_template(case, runfile, tuple(combo))
+                seconds, measured = 0., False
+                if model is not None:
+                    # The engine (and so the runtime) does not depend on the step
+                    args = fill_args(template, first_step)
+                    seconds = JOB_OVERHEAD + model.task_seconds(runfile, args, threads)
+                    measured = model.task_measured(runfile, args, threads)
+                combos.append((combo_index, template, seconds, measured))
+            entries[case].append((entry_index, e, runfile, threads, int(e["num_jobs"]), combos))
+
+    for step in range(first_step, max_steps):
+        step_str = str(step)
+        steps = (step,)
+        for case in case_order:
+            if step_ranges is not None and not step_ranges[case][0] <= step < step_ranges[case][1]:
+                continue
+            for entry_index, e, runfile, threads, nj, combos in entries[case]:
+                if step >= nj:
+                    continue
+                for combo_index, template, seconds, measured in combos:
+                    fields = [case, step_str, runfile, *fill_args(template, step)]
+                    yield Job(case, step, e, fields, steps, False, seconds, entry_index, (combo_index,), threads,
+                              measured)
+
+
+def bundle_jobs(jobs: Iterable[Job]) -> Iterable[Job]:
+    # Pack bundle_size consecutive (step, combo) lines of the same entry into a single line,
+    # which is executed by scripts/run_bundle.py:
+    #    case first_step scripts/run_bundle.py runfile nargs step1 args1... step2 args2...
+    pending: Dict[int, List[Job]] = {}
+
+    def _make_bundle(bundle: List[Job]) -> Job:
+        first = bundle[0]
+        nargs = len(first.fields) - 3
+        fields = [first.case, str(first.step), BUNDLE_RUNNER, first.fields[2], str(nargs)]
+        for job in bundle:
+            fields += [str(job.step), *job.fields[3:]]
+        # The bundle pays the job bootstrap only once
+        seconds = JOB_OVERHEAD + sum(job.seconds - JOB_OVERHEAD for job in bundle)
+        return Job(first.case, first.step, first.entry, fields, tuple(job.step for job in bundle), True, seconds,
+                   entry_index=first.entry_index, combos=tuple(job.combos[0] for job in bundle), threads=first.threads,
+                   measured=all(job.measured for job in bundle))
+
+    for job in jobs:
+        bundle_size = int(job.entry.get("bundle_size", 1))
+        if bundle_size <= 1:
+            yield job
+            continue
+        bundle = pending.setdefault(id(job.entry), [])
+        bundle.append(job)
+        if len(bundle) >= bundle_size:
+            yield _make_bundle(bundle)
+            del pending[id(job.entry)]
+    for bundle in pending.values():
+        yield _make_bundle(bundle)
+
+
+def scan_study_outputs(study_dir: Path, case_order: List[str]) -> Dict[Tuple[str, int], Dict[str, int]]:
+    # Single scandir pass over studies/<study>/<case>/job_<step>/, mapping (case, step) to {file: size}
+    found = {}
+    for case in case_order:
+        case_dir = study_dir / case
+        if not case_dir.is_dir():
+            continue
+        with os.scandir(case_dir) as job_dirs:
+            for job_dir in job_dirs:
+                if not job_dir.name.startswith("job_") or not job_dir.is_dir():
+                    continue
+                try:
+                    step = int(job_dir.name[4:])
+                except ValueError:
+                    continue
+                with os.scandir(job_dir.path) as files:
+                    found[(case, step)] = {f.name: f.stat().st_size for f in files if f.is_file()}
+    return found
+
+
+def iter_missing_jobs(jobs: Iterable[Job], found: Dict[Tuple[str, int], Dict[str, int]]) -> Iterable[Job]:
+    # Only keep the jobs for which at least one expected output is missing or empty
+    for job in jobs:
+        present = found.get((job.case, job.step), {})
+        outputs = expected_outputs(job.fields[2], job.fields[3:], job.entry)
+        if all(present.get(name, 0) > 0 for name in outputs):
+            continue
+        yield job
+
+
+def iter_uncached_jobs(jobs: Iterable[Job], cache: ResultCache, study_dir: Path, hits: Dict[str, int]) -> Iterable[Job]:
+    # Leave out the jobs whose results are already in the result store, and put those
+    # results in the study tree instead
+    for job in jobs:
+        runfile, args = job.fields[2], job.fields[3:]
+        outputs = expected_outputs(runfile, args, job.entry)
+        result_dir = cache.lookup(cache.job_hash(runfile, args, job_seed(runfile, args, job.step)), outputs)
+        if result_dir is None:
+            yield job
+            continue
+        cache.restore(result_dir, study_dir / job.case / f"job_{job.step}", outputs)
+        hits[job.case] = hits.get(job.case, 0) + 1
+
+
+class _BufferedLines:
+    # Collects lines and writes them in bulk, which is much faster than one write per line
+    def __init__(self, fid, chunk_lines: int = WRITE_CHUNK_LINES):
+        self.fid = fid
+        self.chunk_lines = chunk_lines
+        self.buffer: List[str] = []
+
+    def add(self, line: str) -> None:
+        self.buffer.append(line)
+        if len(self.buffer) >= self.chunk_lines:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.buffer:
+            self.fid.write("\n".join(self.buffer) + "\n")
+            self.buffer.clear()
+
+
+def shard_path(out_path: Path, shard: int) -> Path:
+    return out_path.with_name(f"{out_path.stem}.{shard:03d}{out_path.suffix}")
+
+
+def index_path(out_path: Path) -> Path:
+    return out_path.with_name(f"{out_path.stem}.index.json")
+
+
+def shard_sizes(queue_items: Dict[Tuple[bool, int], int], num_shards: int) -> Dict[Tuple[bool, int], int]:
+    # Shard size per (bundled, threads) group that spreads num_shards shards over the groups in
+    # proportion to their lines. Every group needs a shard of its own, as its lines are submitted
+    # with other settings, so there are never fewer shards than groups.
+    queue_items = {key: num for key, num in queue_items.items() if num > 0}
+    total = sum(queue_items.values())
+    if not total:
+        return {}
+    exact = {key: num_shards * num / total for key, num in queue_items.items()}
+    counts = {key: max(1, int(exact[key])) for key in queue_items}
+    rest = num_shards - sum(counts.values())
+    for key in sorted(queue_items, key=lambda key: int(exact[key]) - exact[key])[:max(0, rest)]:
+        counts[key] += 1
+    return {key: math.ceil(num / counts[key]) for key, num in queue_items.items()}
+
+
+def write_sharded_jobs_list(
+    jobs: Iterable[Job],
+    out_path: Path,
+    shard_size: Union[int, Dict[Tuple[bool, int], int]] = 0,
+    manifest: Optional[ManifestWriter] = None,
+    longest_first: bool = False,
+) -> Dict[str, Any]:
+    # Split the job list into shards of at most shard_size lines (0 means no limit, and a dict gives
+    # the size per (bundled, threads) group, see shard_sizes), and write an index with the shards
+    # and the per-case line and step ranges. Bundled and unbundled lines, and lines with different
+    # numbers of OpenMP threads, go to separate shards, as they are submitted with different
+    # settings. The line ranges of a case are per shard, in lines of the shard file (which are the
+    # process numbers of its cluster). With longest_first, the lines of every shard are ordered by
+    # predicted runtime, longest first, such that the tail of its cluster is short; a shard is then
+    # kept in memory until it is full (or per LONGEST_FIRST_WINDOW lines, for shards without limit).
+    # A single resulting shard is written to the requested output file itself.
+    shards = []
+    cases_info: Dict[str, Dict[str, Any]] = OrderedDict()
+    # (bundled, threads) -> (file, buffered lines, shard info, jobs not written yet)
+    open_shards: Dict[Any, Tuple[Any, _BufferedLines, Dict[str, Any], List[Job]]] = {}
+
+    def _close_shard(key):
+        _flush_pending(key)
+        out, buf, _, _ = open_shards.pop(key)
+        buf.flush()
+        out.close()
+
+    # The case index is updated once per run of consecutive lines of the same case and shard
+    run: Dict[str, Any] = {}
+
+    def _flush_run():
+        if not run:
+            return
+        shard_info = run["shard_info"]
+        info = shard_info["cases"].setdefault(run["case"], {})
+        if "first_line" not in info:
+            info.update(first_line=run["first_line"], num_lines=0, num_tasks=0,
+                        first_step=run["first_step"], last_step=run["last_step"])
+        info["last_line"] = run["last_line"]
+        total = cases_info.setdefault(run["case"], {"shards": [], "num_lines": 0, "num_tasks": 0,
+                                                    "first_step": run["first_step"], "last_step": run["last_step"]})
+        if shard_info["shard"] not in total["shards"]:
+            total["shards"].append(shard_info["shard"])
+        for entry in (info, total):
+            entry["num_lines"] += run["num_lines"]
+            entry["num_tasks"] += run["num_tasks"]
+            entry["first_step"] = min(entry["first_step"], run["first_step"])
+            entry["last_step"] = max(entry["last_step"], run["last_step"])
+        run.clear()
+
+    def _write(buf, shard_info, job):
+        line_nr = shard_info["num_lines"]
+        buf.add(" ".join(job.fields))
+        if manifest is not None:
+            for step, combo in zip(job.steps, job.combos):
+                manifest.add(shard_info["shard"], line_nr, job.case, job.entry_index, step, combo)
+        shard_info["num_lines"] += 1
+        shard_info["num_tasks"] += len(job.steps)
+        shard_info["cpu_hours"] += job.seconds * job.threads / 3600
+        if job.seconds > shard_info["max_job_seconds"]:
+            shard_info["max_job_seconds"] = job.seconds
+        if not job.measured:
+            shard_info["calibrated"] = False
+        if run and run["case"] == job.case and run["shard_info"] is shard_info:
+            run["last_line"] = line_nr
+            run["num_lines"] += 1
+            run["num_tasks"] += len(job.steps)
+            # The steps of a bundle are increasing
+            if job.steps[0] < run["first_step"]:
+                run["first_step"] = job.steps[0]
+            if job.steps[-1] > run["last_step"]:
+                run["last_step"] = job.steps[-1]
+        else:
+            _flush_run()
+            run.update(case=job.case, shard_info=shard_info, first_line=line_nr, last_line=line_nr, num_lines=1,
+                       num_tasks=len(job.steps), first_step=job.steps[0], last_step=job.steps[-1])
+
+    def _flush_pending(key):
+        _, buf, shard_info, pending = open_shards[key]
+        pending.sort(key=lambda job: -job.seconds)
+        for job in pending:
+            _write(buf, shard_info, job)
+        pending.clear()
+
+    total_lines = 0
+    try:
+        for job in jobs:
+            key = (job.bundled, job.threads)
+            size = shard_size.get(key, 0) if isinstance(shard_size, dict) else shard_size
+            if key in open_shards and 0 < size <= open_shards[key][2]["num_lines"] + len(open_shards[key][3]):
+                _close_shard(key)
+            if key not in open_shards:
+                shard = len(shards)
+                path = shard_path(out_path, shard)
+                shard_info = {
+                    "shard": shard,
+                    "file": path.name,
+                    "bundled": job.bundled,
+                    "cpus": job.threads,
+                    "shard_size": size,
+                    "num_lines": 0,
+                    "num_tasks": 0,
+                    "cpu_hours": 0.,
+                    "max_job_seconds": 0.,
+                    "calibrated": True,
+                    "cases": OrderedDict(),
+                }
+                shards.append(shard_info)
+                out = path.open("w")
+                open_shards[key] = (out, _BufferedLines(out), shard_info, [])
+            _, buf, shard_info, pending = open_shards[key]
+            total_lines += 1
+            if not longest_first:
+                _write(buf, shard_info, job)
+                continue
+            pending.append(job)
+            if size == 0 and len(pending) >= LONGEST_FIRST_WINDOW:
+                _flush_pending(key)
+        for key in list(open_shards):
+            _close_shard(key)
+        _flush_run()
+    finally:
+        for key in list(open_shards):
+            out, _, _, _ = open_shards.pop(key)
+            out.close()
+
+    if len(shards) == 1:
+        shard_path(out_path, 0).replace(out_path)
+        shards[0]["file"] = out_path.name
+
+    index = {
+        "jobs_list": out_path.name,
+        "total_lines": total_lines,
+        "total_tasks": sum(shard["num_tasks"] for shard in shards),
+        "num_shards": len(shards),
+        "shards": shards,
+        "cases": cases_info,
+    }
+    for shard in shards:
+        # Only lowered below the default flavour when all runtimes of the shard are measured
+        shard["flavour"] = choose_flavour(shard["max_job_seconds"], calibrated=shard["calibrated"])
+        shard["macros"] = {"JOBSLIST": shard["file"], "FLAVOUR": shard["flavour"]}
+        if shard["bundled"]:
+            shard["macros"]["BUNDLED"] = 1
+        if shard["cpus"] > 1:
+            shard["macros"]["CPUS"] = shard["cpus"]
+    with index_path(out_path).open("w") as fid:
+        json.dump(index, fid, indent=2)
+    if manifest is not None:
+        manifest.write(manifest_path(out_path), {shard["shard"]: shard["file"] for shard in shards})
+    return index
 
 
 def head_tail(path: Path, n: int = 5) -> Tuple[List[str], List[str]]:
@@ -156,6 +531,53 @@ def main() -> None:
         default="",
         help="Comma-separated case order (default: YAML order)",
     )
+    shard_group = ap.add_mutually_exclusive_group()
+    shard_group.add_argument(
+        "--shard-size",
+        type=int,
+        default=0,
+        help="Maximum number of jobs per shard (default: 0, i.e. a single jobs list)",
+    )
+    shard_group.add_argument(
+        "--num-shards",
+        type=int,
+        default=0,
+        help="Split the jobs evenly over this many shards, spread over the groups of jobs that are submitted "
+             "with different settings (bundled or not, OpenMP threads), each of which needs at least one shard "
+             "(default: 0, i.e. a single jobs list)",
+    )
+    ap.add_argument(
+        "--resume",
+        default="",
+        metavar="STUDY_DIR",
+        help="Only write the jobs whose outputs are missing or empty in STUDY_DIR (i.e. studies/<study>)",
+    )
+    ap.add_argument(
+        "--result-store",
+        default="",
+        help="Result store: leave out jobs whose results are already there, and put those in --study-dir",
+    )
+    ap.add_argument(
+        "--study-dir",
+        default="",
+        help="Output directory of the study (studies/<study>), needed for --result-store",
+    )
+    ap.add_argument(
+        "--env-name",
+        default="",
+        help="Name of the environment tarball the jobs run in (part of the result hash)",
+    )
+    ap.add_argument(
+        "--cost-db",
+        default="",
+        help="Database with measured runtimes to refine the cost model (see cost_model.py)",
+    )
+    ap.add_argument(
+        "--longest-first",
+        action="store_true",
+        help="Order the jobs by predicted runtime, longest first, such that the tail of a study is short "
+             "(within every shard, or every 50000 jobs of a shard without size limit)",
+    )
     ap.add_argument(
         "--preview",
         action="store_true",
@@ -183,7 +605,8 @@ def main() -> None:
     else:
         case_order = list(cases.keys())
 
-    info = summarise(cases, case_order)
+    model = CostModel.from_json(args.cost_db) if args.cost_db else CostModel()
+    info = summarise(cases, case_order, model)
 
     # Pretty-ish summary
     print(f"Spec: {spec_path}")
@@ -192,19 +615,76 @@ def main() -> None:
         print(f"[{case}]")
         print(f"  steps: {cd['num_steps']} (0..{cd['max_step']})")
         for e in cd["entries"]:
+            bundled = f", bundle_size={e['bundle_size']}, queue_items={e['queue_items']}" if e["bundle_size"] > 1 else ""
             print(
                 f"  - {e['runfile']}: num_jobs={e['num_jobs']}, "
-                f"combos/step={e['combos_per_step']}, lines={e['lines']}"
+                f"combos/step={e['combos_per_step']}, lines={e['lines']}{bundled}"
             )
         print(f"  total lines for case: {cd['lines']}")
+        print(f"  predicted CPU time for case: {cd['cpu_hours']:.1f} h")
     print(f"TOTAL lines: {info['total_lines']}")
+    print(f"TOTAL predicted CPU time: {info['total_cpu_hours']:.1f} h")
+    if info["total_queue_items"] != info["total_lines"]:
+        print(f"TOTAL queue items (after bundling): {info['total_queue_items']}")
     print(f"Max steps across cases: {info['max_steps']}")
 
-    write_jobs_list(cases, case_order, out_path)
-    print(f"Wrote: {out_path}")
-
-    if args.preview:
-        h, t = head_tail(out_path, n=args.preview_lines)
+    # Queue items per (bundled, threads) group, which go to separate shards
+    queue_items: Dict[Tuple[bool, int], int] = {}
+    for cd in info["per_case"].values():
+        for e in cd["entries"]:
+            key = (e["bundle_size"] > 1, e["omp_threads"])
+            queue_items[key] = queue_items.get(key, 0) + e["queue_items"]
+    tasks = iter_jobs(cases, case_order, model=model)
+    if args.resume:
+        study_dir = Path(args.resume)
+        if not study_dir.is_dir():
+            raise SystemExit(f"Study directory for --resume not found: {study_dir}")
+        found = scan_study_outputs(study_dir, case_order)
+        print(f"Resume: scanned {len(found)} job directories in {study_dir}")
+        tasks = iter_missing_jobs(tasks, found)
+    hits: Dict[str, int] = {}
+    if args.result_store:
+        if not args.study_dir:
+            raise SystemExit("--result-store needs --study-dir")
+        cache = ResultCache(args.result_store, root=spec_path.resolve().parent, env_name=args.env_name)
+        tasks = iter_uncached_jobs(tasks, cache, Path(args.study_dir), hits)
+
+    if args.resume or args.result_store:
+        # Only a subset of the jobs is written, so collect them to know how many there are
+        remaining_jobs = list(bundle_jobs(tasks))
+
+        def jobs():
+            return iter(remaining_jobs)
+
+        remaining = OrderedDict((case, 0) for case in case_order)
+        for job in remaining_jobs:
+            remaining[job.case] += len(job.steps)
+        for case, num in remaining.items():
+            cached = f", {hits[case]} taken from the result store" if case in hits else ""
+            print(f"  [{case}] to submit: {num} of {info['per_case'][case]['lines']} lines{cached}")
+        queue_items = {}
+        for job in remaining_jobs:
+            queue_items[(job.bundled, job.threads)] = queue_items.get((job.bundled, job.threads), 0) + 1
+        print(f"TOTAL lines to submit: {sum(remaining.values())}")
+    else:
+        def jobs():
+            return bundle_jobs(tasks)
+
+    shard_size: Union[int, Dict[Tuple[bool, int], int]] = args.shard_size
+    if args.num_shards > 0:
+        shard_size = shard_sizes(queue_items, args.num_shards)
+    manifest = ManifestWriter(cases, case_order)
+    index = write_sharded_jobs_list(jobs(), out_path, shard_size=shard_size, manifest=manifest,
+                                    longest_first=args.longest_first)
+    for shard in index["shards"]:
+        print(f"Wrote: {out_path.parent / shard['file']} ({shard['num_lines']} lines, "
+              f"{shard['cpu_hours']:.1f} CPU hours, flavour {shard['flavour']})")
+    print(f"Wrote: {index_path(out_path)}")
+    print(f"Wrote: {manifest_path(out_path)}")
+
+    if args.preview and index["shards"]:
+        h, _ = head_tail(out_path.parent / index["shards"][0]["file"], n=args.preview_lines)
+        _, t = head_tail(out_path.parent / index["shards"][-1]["file"], n=args.preview_lines)
         print("\n--- HEAD ---")
         for line in h:
             print(line)
@@ -1,12 +1,18 @@
 #!/usr/bin/env bash
 
-# Usage: ./job.sh -p 834 -n TestRun -e geant4 -c python scripts/pencil_lossmap.py scriptargs
+# Usage: ./job.sh -p 834 -n TestRun -e geant4 [-k root://eosuser.cern.ch//path/to/job_dir] -c python scripts/pencil_lossmap.py scriptargs
+#
+# With -k, a tracking checkpoint left in the job output directory by an evicted run of this job is
+# fetched before running, such that the tracking resumes from there (see scripts/checkpoint.py).
+# The directory is exported as CHECKPOINT_URL, from which bundles fetch their done file and the
+# checkpoints of their tasks (see scripts/run_bundle.py).
 
 
 # Parse arguments
 set -euo pipefail
 processid=""
 studyname=""
+checkpointdir=""
 environments=()
 pycmd=()
 while [[ $# -gt 0 ]]
@@ -20,6 +26,10 @@ do
             processid="${2:?Missing value for $1}"
             shift 2
             ;;
+        -k|--checkpoint)   # Optional output directory (xrootd URL) to fetch a checkpoint of an evicted run from
+            checkpointdir="${2:?Missing value for $1}"
+            shift 2
+            ;;
         -e|--environment)  # Optional environment arguments to be passed to environment.sh (those cannot start with '-')
             shift
             while [[ $# -gt 0 && "$1" != -* ]]
@@ -101,6 +111,19 @@ source xsuite_env/bin/activate
 set -u
 
 
+# Fetch the checkpoint of an evicted run of this job, if there is one
+if [[ -n "$checkpointdir" ]]
+then
+    export CHECKPOINT_URL="$checkpointdir"
+    if xrdcp -s -f "${checkpointdir}/checkpoint.pkl" checkpoint.pkl 2>/dev/null
+    then
+        echo $( date )"    Fetched checkpoint from "${checkpointdir}
+    else
+        rm -f checkpoint.pkl
+    fi
+fi
+
+
 # Run the job
 echo $( date )"    Running "${studyname}" Process ID "${processid}"."
 echo $( date )"    Using command: "${pycmd[@]}
@@ -108,10 +131,16 @@ echo
 "${pycmd[@]}"
 echo
 echo $( date )"    Done"
+if [[ -n "$checkpointdir" ]]
+then
+    # The job finished, so a checkpoint transferred at eviction is stale
+    server="${checkpointdir#root://}"
+    xrdfs "${server%%/*}" rm "/${server#*/}/checkpoint.pkl" 2>/dev/null || true
+fi
 set +u
 deactivate
 set -u
-for f in files_${studyname}.tar.gz xsuite_env*.tar.gz xsuite_env data scripts environment.sh job.sh
+for f in files_${studyname}.tar.gz xsuite_env*.tar.gz xsuite_env data scripts results environment.sh job.sh
 do
     rm -r $f || true  # Do not fail if the file is not there
 done
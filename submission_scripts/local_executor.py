@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Tuple
+
+from runfiles import resolve_args
+
+
+# Local executor for jobs.list, without HTCondor
+# ==============================================
+#
+# Runs the lines of a (sharded) jobs list on a process pool, mimicking submission.sub and job.sh:
+# every line is 'case step pyargs', runs as 'python pyargs' in its own sandbox containing scripts/
+# and data/, and its outputs are moved to studies/<study>/<case>/job_<step>/ (or, for bundled
+# lines, the job_<step> directories in bundle_out/ are moved to studies/<study>/<case>/).
+# Logs are written as <cluster>__job<process>.out/.err, with the shard number as cluster ID.
+
+SANDBOX_INPUTS = ["scripts", "data"]
+
+
+class LocalJob(NamedTuple):
+    cluster: int
+    process: int
+    case: str
+    step: str
+    pyargs: List[str]
+    cpus: int = 1
+
+
+class JobResult(NamedTuple):
+    job: LocalJob
+    returncode: int
+    seconds: float
+
+
+def read_jobs(jobs_list: Path, cluster: int = 0, cpus: int = 1) -> List[LocalJob]:
+    jobs = []
+    with jobs_list.open("r") as fid:
+        for line in fid:
+            fields = line.split()
+            if not fields:
+                continue
+            case, step, pyargs = fields[0], fields[1], fields[2:]
+            # Same $JobID and $Seed substitution as generate_jobs.py, for hand-written job lists
+            if pyargs:
+                pyargs = [pyargs[0], *resolve_args(case, int(step), pyargs[0], pyargs[1:])]
+            jobs.append(LocalJob(cluster, len(jobs), case, step, pyargs, cpus))
+    return jobs
+
+
+def read_index(index_path: Path) -> List[LocalJob]:
+    with index_path.open("r") as fid:
+        index = json.load(fid)
+    jobs = []
+    for shard in index["shards"]:
+        jobs.extend(read_jobs(index_path.parent / shard["file"], cluster=shard["shard"], cpus=shard.get("cpus", 1)))
+    return jobs
+
+
+def _move_into(src: Path, dst: Path) -> None:
+    dst.mkdir(parents=True, exist_ok=True)
+    for item in src.iterdir():
+        target = dst / item.name
+        if item.is_dir() and target.is_dir():
+            _move_into(item, target)
+        else:
+            if target.is_file():
+                target.unlink()
+            shutil.move(str(item), str(target))
+
+
+def run_job(job: LocalJob, study_root: str, study_name: str, scratch: str, log_dir: str, python: str) -> JobResult:
+    study_root = Path(study_root)
+    sandbox = Path(scratch) / f"{job.cluster}.{job.process}"
+    if sandbox.exists():
+        shutil.rmtree(sandbox)
+    sandbox.mkdir(parents=True)
+    for name in SANDBOX_INPUTS:
+        (sandbox / name).symlink_to(study_root / name, target_is_directory=True)
+
+    log_stem = Path(log_dir) / f"{job.cluster}__job{job.process}"
+    env = dict(os.environ)
+    # As request_cpus in submission.sub (note that --workers counts jobs, not cores)
+    env["OMP_NUM_THREADS"] = str(job.cpus)
+    start = time.time()
+    with open(f"{log_stem}.out", "w") as out, open(f"{log_stem}.err", "w") as err:
+        # Same banner as job.sh, such that the logs can be used to calibrate the cost model
+        out.write(f"{time.ctime()}    Running {study_name} Process ID {job.cluster}.{job.process}.\n")
+        out.write(f"{time.ctime()}    Using command: python {' '.join(job.pyargs)}\n\n")
+        out.flush()
+        returncode = subprocess.call([python, *job.pyargs], cwd=sandbox, env=env, stdout=out, stderr=err)
+        out.write(f"\n{time.ctime()}    Done\n")
+    seconds = time.time() - start
+
+    # Transfer the outputs, as HTCondor does with output_destination
+    case_dir = study_root / "studies" / study_name / job.case
+    for name in SANDBOX_INPUTS:
+        (sandbox / name).unlink()
+    if (sandbox / "bundle_out").is_dir():
+        _move_into(sandbox / "bundle_out", case_dir)
+        shutil.rmtree(sandbox / "bundle_out")
+    _move_into(sandbox, case_dir / f"job_{job.step}")
+    shutil.rmtree(sandbox)
+    return JobResult(job, returncode, seconds)
+
+
+def run_local(
+    jobs: List[LocalJob],
+    study_root: Path,
+    study_name: str,
+    workers: int,
+    scratch: Optional[Path] = None,
+    log_dir: Optional[Path] = None,
+    python: str = sys.executable,
+) -> Tuple[List[JobResult], List[JobResult]]:
+    study_root = study_root.resolve()
+    scratch = (scratch or study_root / "local_scratch" / study_name).resolve()
+    log_dir = (log_dir or study_root / "local_logs" / study_name).resolve()
+    scratch.mkdir(parents=True, exist_ok=True)
+    log_dir.mkdir(parents=True, exist_ok=True)
+
+    done, failed = [], []
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_job, job, str(study_root), study_name, str(scratch), str(log_dir), python)
+                   for job in jobs]
+        for i, future in enumerate(as_completed(futures)):
+            result = future.result()
+            (done if result.returncode == 0 else failed).append(result)
+            if result.returncode != 0:
+                print(f"  Job {result.job.cluster}.{result.job.process} ({result.job.case} step {result.job.step}) "
+                      f"failed with code {result.returncode}", flush=True)
+            if (i + 1) % max(1, len(jobs) // 20) == 0 or i + 1 == len(jobs):
+                print(f"  {i+1}/{len(jobs)} jobs finished after {time.time()-start:.1f}s", flush=True)
+    return done, failed
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Run a jobs list locally on a process pool, without HTCondor.")
+    source = ap.add_mutually_exclusive_group(required=True)
+    source.add_argument("--jobs-list", help="Jobs list to run (e.g. jobs.list)")
+    source.add_argument("--index", help="Index of a sharded jobs list, to run all shards (e.g. jobs.index.json)")
+    ap.add_argument("--study-name", required=True, help="Study name, outputs go to studies/<study-name>")
+    ap.add_argument("--study-path", default=".", help="Directory containing scripts/ and data/ (default: .)")
+    ap.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of parallel jobs (default: all cores)")
+    ap.add_argument("--scratch", default="", help="Directory for the job sandboxes (default: local_scratch/<study>)")
+    ap.add_argument("--log-dir", default="", help="Directory for the job logs (default: local_logs/<study>)")
+    ap.add_argument("--python", default=sys.executable, help="Python executable for the jobs (default: this one)")
+    args = ap.parse_args()
+
+    if args.jobs_list:
+        jobs = read_jobs(Path(args.jobs_list))
+    else:
+        jobs = read_index(Path(args.index))
+    print(f"Running {len(jobs)} jobs with {args.workers} workers")
+    start = time.time()
+    done, failed = run_local(
+        jobs,
+        Path(args.study_path),
+        args.study_name,
+        args.workers,
+        scratch=Path(args.scratch) if args.scratch else None,
+        log_dir=Path(args.log_dir) if args.log_dir else None,
+        python=args.python,
+    )
+    cpu_time = sum(result.seconds for result in done + failed)
+    print(f"Done in {time.time()-start:.1f}s ({cpu_time:.1f}s summed job time): "
+          f"{len(done)} succeeded, {len(failed)} failed")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+import bisect
+import json
+import mmap
+import struct
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from runfiles import resolve_args
+
+
+# Compact binary manifest of a generated job list
+# ===============================================
+#
+# Layout (little endian):
+#   magic          8 bytes   b"HTCJMAN1"
+#   header size    uint32
+#   header         JSON      interned string table, cases, entries (runfile and argument values as
+#                            string ids), shards, and the offsets of the two tables below
+#   records        RECORD    one fixed-width record per job (per task for bundled lines), ordered
+#                            by (shard, process)
+#   case index     INDEX     record numbers sorted by (case, step)
+#
+# A job is looked up by (shard, process) in O(1) when no lines are bundled (and by a binary
+# search within the shard otherwise), and by (case, step) with a binary search in the index.
+
+MAGIC = b"HTCJMAN1"
+VERSION = 1
+# shard, case, entry, process, step, combo
+RECORD = struct.Struct("<HHHxxIII")
+# case, step, record
+INDEX = struct.Struct("<HxxII")
+
+
+class ManifestJob(NamedTuple):
+    case: str
+    step: int
+    runfile: str
+    args: List[str]
+    shard: int
+    process: int
+    entry: int
+    combo: int
+
+
+def manifest_path(out_path: Path) -> Path:
+    return out_path.with_name(f"{out_path.stem}.manifest")
+
+
+def combo_values(arg_lists: Sequence[Sequence[Any]], combo: int) -> List[Any]:
+    # Inverse of the enumeration of itertools.product: the last argument varies fastest
+    values = []
+    for lst in reversed(arg_lists):
+        combo, i = divmod(combo, len(lst))
+        values.append(lst[i])
+    return values[::-1]
+
+
+class ManifestWriter:
+    def __init__(self, cases: "Dict[str, List[Dict[str, Any]]]", case_order: List[str]):
+        self._strings: List[str] = []
+        self._string_ids: Dict[str, int] = {}
+        self.case_ids = {case: i for i, case in enumerate(case_order)}
+        self.cases = [self._intern(case) for case in case_order]
+        self.entries: List[Dict[str, Any]] = []
+        self.entry_ids: Dict[Tuple[str, int], int] = {}
+        for case in case_order:
+            for i, e in enumerate(cases[case]):
+                self.entry_ids[(case, i)] = len(self.entries)
+                self.entries.append({
+                    "case": self.case_ids[case],
+                    "runfile": self._intern(str(e["runfile"])),
+                    "args": [[self._intern(str(x)) for x in lst] for lst in e["args"]],
+                })
+        self._records: Dict[int, bytearray] = {}
+        self._counts: Dict[int, int] = {}
+        self._procs: Dict[int, int] = {}
+
+    def _intern(self, value: str) -> int:
+        if value not in self._string_ids:
+            self._string_ids[value] = len(self._strings)
+            self._strings.append(value)
+        return self._string_ids[value]
+
+    def add(self, shard: int, process: int, case: str, entry_index: int, step: int, combo: int) -> None:
+        records = self._records.get(shard)
+        if records is None:
+            records = self._records[shard] = bytearray()
+            self._counts[shard] = 0
+            self._procs[shard] = 0
+        records += RECORD.pack(shard, self.case_ids[case], self.entry_ids[(case, entry_index)], process, step, combo)
+        self._counts[shard] += 1
+        if process >= self._procs[shard]:
+            self._procs[shard] = process + 1
+
+    def write(self, path: Path, shard_files: Dict[int, str]) -> None:
+        shards = []
+        first = 0
+        for shard in sorted(self._records):
+            shards.append({
+                "file": shard_files.get(shard, ""),
+                "first_record": first,
+                "num_records": self._counts[shard],
+                "num_processes": self._procs[shard],
+            })
+            first += self._counts[shard]
+        num_records = first
+
+        # Secondary index on (case, step)
+        keys = []
+        rec = 0
+        for shard in sorted(self._records):
+            for _, case, _, _, step, _ in RECORD.iter_unpack(self._records[shard]):
+                keys.append((case, step, rec))
+                rec += 1
+        keys.sort()
+
+        header = {
+            "version": VERSION,
+            "strings": self._strings,
+            "cases": self.cases,
+            "entries": self.entries,
+            "shards": shards,
+            "num_records": num_records,
+        }
+        # The offsets depend on the header size, so iterate until they are stable
+        header.update(records_offset=0, index_offset=0)
+        while True:
+            blob = json.dumps(header, separators=(",", ":")).encode()
+            start = len(MAGIC) + 4 + len(blob)
+            if header["records_offset"] == start:
+                break
+            header["records_offset"] = start
+            header["index_offset"] = start + num_records * RECORD.size
+
+        with Path(path).open("wb") as fid:
+            fid.write(MAGIC)
+            fid.write(struct.pack("<I", len(blob)))
+            fid.write(blob)
+            for shard in sorted(self._records):
+                fid.write(self._records[shard])
+            index = bytearray(len(keys) * INDEX.size)
+            for i, key in enumerate(keys):
+                INDEX.pack_into(index, i * INDEX.size, *key)
+            fid.write(index)
+
+
+class _Column(Sequence):
+    # Lazy view on one field of a memory-mapped table, to be used with bisect
+    def __init__(self, manifest: "JobManifest", start: int, stop: int, key):
+        self.manifest, self.start, self.stop, self.key = manifest, start, stop, key
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, i):
+        return self.key(self.start + i)
+
+
+class JobManifest:
+    def __init__(self, path):
+        self.path = Path(path)
+        self._fid = self.path.open("rb")
+        self._mm = mmap.mmap(self._fid.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"Not a job manifest: {self.path}")
+        (size,) = struct.unpack_from("<I", self._mm, len(MAGIC))
+        start = len(MAGIC) + 4
+        header = json.loads(self._mm[start:start + size])
+        if header["version"] != VERSION:
+            raise ValueError(f"Unsupported manifest version {header['version']}")
+        self.header = header
+        self.strings: List[str] = header["strings"]
+        self.cases: List[str] = [self.strings[i] for i in header["cases"]]
+        self._case_ids = {case: i for i, case in enumerate(self.cases)}
+        self.shards: List[Dict[str, Any]] = header["shards"]
+        self.num_records: int = header["num_records"]
+        self._records_offset: int = header["records_offset"]
+        self._index_offset: int = header["index_offset"]
+        self._entries = []
+        for e in header["entries"]:
+            self._entries.append((self.strings[e["runfile"]],
+                                  [[self.strings[x] for x in lst] for lst in e["args"]]))
+
+    def close(self) -> None:
+        self._mm.close()
+        self._fid.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self) -> int:
+        return self.num_records
+
+    def __iter__(self):
+        for i in range(self.num_records):
+            yield self.record(i)
+
+    def _raw(self, i: int) -> Tuple[int, ...]:
+        if not 0 <= i < self.num_records:
+            raise IndexError(f"Record {i} out of range")
+        return RECORD.unpack_from(self._mm, self._records_offset + i * RECORD.size)
+
+    def record(self, i: int) -> ManifestJob:
+        shard, case, entry, process, step, combo = self._raw(i)
+        runfile, arg_lists = self._entries[entry]
+        args = resolve_args(self.cases[case], step, runfile, combo_values(arg_lists, combo))
+        return ManifestJob(self.cases[case], step, runfile, args, shard, process, entry, combo)
+
+    def by_process(self, process: int, shard: int = 0) -> List[ManifestJob]:
+        # All jobs run by HTCondor process ID `process` of the cluster that ran shard `shard`
+        # (more than one for a bundled line)
+        info = self.shards[shard]
+        first, num = info["first_record"], info["num_records"]
+        if num == info["num_processes"]:
+            # No bundles in this shard: direct access
+            if not 0 <= process < num:
+                return []
+            return [self.record(first + process)]
+        column = _Column(self, first, first + num, lambda i: self._raw(i)[3])
+        lo = bisect.bisect_left(column, process)
+        hi = bisect.bisect_right(column, process)
+        return [self.record(first + i) for i in range(lo, hi)]
+
+    def by_case_step(self, case: str, step: int) -> List[ManifestJob]:
+        if case not in self._case_ids:
+            return []
+        key = (self._case_ids[case], step)
+
+        def _key(i):
+            return INDEX.unpack_from(self._mm, self._index_offset + i * INDEX.size)[:2]
+
+        column = _Column(self, 0, self.num_records, _key)
+        lo = bisect.bisect_left(column, key)
+        hi = bisect.bisect_right(column, key)
+        return [self.record(INDEX.unpack_from(self._mm, self._index_offset + i * INDEX.size)[2])
+                for i in range(lo, hi)]
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Look up jobs in a binary job manifest.")
+    ap.add_argument("manifest", help="Manifest file (e.g. jobs.manifest)")
+    ap.add_argument("--process", type=int, help="HTCondor process ID to look up")
+    ap.add_argument("--shard", type=int, default=0, help="Shard (cluster) of --process (default: 0)")
+    ap.add_argument("--case", help="Case to look up (together with --step)")
+    ap.add_argument("--step", type=int, help="Step to look up (together with --case)")
+    args = ap.parse_args()
+
+    with JobManifest(args.manifest) as manifest:
+        jobs: Optional[List[ManifestJob]] = None
+        if args.process is not None:
+            jobs = manifest.by_process(args.process, shard=args.shard)
+        elif args.case is not None and args.step is not None:
+            jobs = manifest.by_case_step(args.case, args.step)
+        if jobs is None:
+            print(f"{len(manifest)} jobs in {len(manifest.shards)} shards, cases: {', '.join(manifest.cases)}")
+            for shard, info in enumerate(manifest.shards):
+                print(f"  shard {shard}: {info['file']} ({info['num_records']} jobs, "
+                      f"{info['num_processes']} processes)")
+            return
+        for job in jobs:
+            print(f"{job.case} {job.step} {job.runfile} {' '.join(job.args)}  "
+                  f"(shard {job.shard}, process {job.process})")
+
+
+if __name__ == "__main__":
+    main()
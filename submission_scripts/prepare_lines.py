@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+import itertools
+import subprocess
+import sys
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+from generate_jobs import load_cases
+from runfiles import DEFAULT_ENGINE, PREPARE_RUNNER, runfile_info
+
+
+# Preparation stage, run by submit.sh before spooling
+# ===================================================
+#
+# Builds the collimated line once for every (machine, colldb, engine) triple used in the jobs
+# spec, with scripts/prepared_line.py, into data/prepared/ (which gets spooled with data/). The
+# scripts load this cache instead of installing the collimators and computing the twiss in every
+# job. This has to run inside the xsuite environment of the study.
+
+
+def line_triples(cases: "Dict[str, List[Dict[str, Any]]]") -> List[Tuple[str, str, str]]:
+    # Only the machine, colldb and engine arguments matter, so the product is over those alone
+    triples = []
+    for entries in cases.values():
+        for e in entries:
+            info = runfile_info(str(e["runfile"]))
+            if info is None or "machine" not in info["args"] or "colldb" not in info["args"]:
+                continue
+            names = info["args"]
+            arg_lists = e["args"]
+            machines = arg_lists[names.index("machine")]
+            colldbs = arg_lists[names.index("colldb")]
+            if "engine" in names and names.index("engine") < len(arg_lists):
+                engines = arg_lists[names.index("engine")]
+            else:
+                engines = [DEFAULT_ENGINE]
+            for triple in itertools.product(machines, colldbs, engines):
+                triple = tuple(map(str, triple))
+                if triple not in triples:
+                    triples.append(triple)
+    return triples
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Build the prepared-line cache for all lines in a jobs spec.")
+    ap.add_argument("--spec", required=True, help="Jobs YAML (e.g. example.jobs.yaml)")
+    ap.add_argument("--root", default=".", help="Directory containing scripts/ and data/ (default: .)")
+    ap.add_argument("--python", default=sys.executable, help="Python executable with xsuite (default: this one)")
+    ap.add_argument("--dry-run", action="store_true", help="Only list the lines that would be prepared")
+    args = ap.parse_args()
+
+    triples = line_triples(load_cases(args.spec))
+    print(f"Preparing {len(triples)} lines")
+    failed = []
+    for machine, colldb, engine in triples:
+        print(f"  {machine}, {colldb}, {engine}", flush=True)
+        if args.dry_run:
+            continue
+        if subprocess.call([args.python, PREPARE_RUNNER, machine, colldb, engine], cwd=Path(args.root)) != 0:
+            failed.append((machine, colldb, engine))
+    if failed:
+        # Not fatal for the study: the jobs of these lines build them themselves
+        print(f"Failed to prepare {len(failed)} lines, their jobs will build the line themselves")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
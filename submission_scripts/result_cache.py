@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+import hashlib
+import os
+import shutil
+from pathlib import Path
+from typing import Dict, Optional, Sequence, Tuple
+
+from manifest import JobManifest
+from runfiles import SCRIPT_HELPERS, expected_outputs, named_args
+
+
+# Content-addressed store of job results
+# ======================================
+#
+# Every job gets a hash built from everything that determines its outputs: the runfile source
+# (and that of the helper modules it imports), the content of the data files it references
+# (machine JSON, colldb YAML, ...), its resolved argument list, its seed and the name of the
+# environment tarball it runs in. The outputs of finished jobs are stored under
+# <store>/<hash[:2]>/<hash>/, such that an identical job in a later study does not need to run again.
+
+
+class ResultCache:
+    def __init__(self, store, root=".", env_name: str = ""):
+        self.store = Path(store)
+        self.root = Path(root)
+        self.env_name = env_name
+        self._file_hashes: Dict[Path, Tuple[int, int, str]] = {}
+        self._arg_tokens: Dict[str, str] = {}
+        self._known: Optional[set] = None
+
+    def file_hash(self, path: Path) -> str:
+        # Cached on (size, mtime), such that every data file is only read once
+        path = path.resolve()
+        st = path.stat()
+        cached = self._file_hashes.get(path)
+        if cached is not None and cached[:2] == (st.st_size, st.st_mtime_ns):
+            return cached[2]
+        h = hashlib.sha256()
+        with path.open("rb") as fid:
+            for chunk in iter(lambda: fid.read(1 << 20), b""):
+                h.update(chunk)
+        self._file_hashes[path] = (st.st_size, st.st_mtime_ns, h.hexdigest())
+        return h.hexdigest()
+
+    def job_hash(self, runfile: str, args: Sequence[str], seed) -> str:
+        h = hashlib.sha256()
+        h.update(self._arg_token(runfile))
+        for helper in SCRIPT_HELPERS:
+            h.update(self._arg_token(helper))
+        for arg in args:
+            h.update(self._arg_token(arg))
+        h.update(f"seed:{seed}\n".encode())
+        h.update(f"env:{self.env_name}\n".encode())
+        return h.hexdigest()
+
+    def _arg_token(self, arg: str) -> bytes:
+        # Arguments pointing to a file are represented by their content
+        if arg not in self._arg_tokens:
+            path = self.root / arg
+            if path.is_file():
+                self._arg_tokens[arg] = f"file:{arg}:{self.file_hash(path)}\n"
+            else:
+                self._arg_tokens[arg] = f"arg:{arg}\n"
+        return self._arg_tokens[arg].encode()
+
+    def result_dir(self, job_hash: str) -> Path:
+        return self.store / job_hash[:2] / job_hash
+
+    def known_hashes(self) -> set:
+        # List the store once, such that misses do not need a directory access each
+        if self._known is None:
+            self._known = set()
+            if self.store.is_dir():
+                with os.scandir(self.store) as prefixes:
+                    for prefix in prefixes:
+                        if prefix.is_dir():
+                            with os.scandir(prefix.path) as results:
+                                self._known.update(r.name for r in results if r.is_dir())
+        return self._known
+
+    def lookup(self, job_hash: str, outputs: Sequence[str]) -> Optional[Path]:
+        # Only a complete set of non-empty outputs counts as a hit
+        if job_hash not in self.known_hashes():
+            return None
+        result_dir = self.result_dir(job_hash)
+        try:
+            with os.scandir(result_dir) as files:
+                present = {f.name: f.stat().st_size for f in files if f.is_file()}
+        except FileNotFoundError:
+            return None
+        if all(present.get(name, 0) > 0 for name in outputs):
+            return result_dir
+        return None
+
+    def store_outputs(self, job_hash: str, job_dir: Path, outputs: Sequence[str]) -> bool:
+        if not all((job_dir / name).is_file() and (job_dir / name).stat().st_size > 0 for name in outputs):
+            return False
+        result_dir = self.result_dir(job_hash)
+        result_dir.mkdir(parents=True, exist_ok=True)
+        for name in outputs:
+            _link_or_copy(job_dir / name, result_dir / name)
+        return True
+
+    def restore(self, result_dir: Path, job_dir: Path, outputs: Sequence[str]) -> None:
+        job_dir.mkdir(parents=True, exist_ok=True)
+        for name in outputs:
+            _link_or_copy(result_dir / name, job_dir / name)
+
+
+def _link_or_copy(src: Path, dst: Path) -> None:
+    # Hard links are free, but not possible across file systems
+    if dst.exists():
+        dst.unlink()
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def job_seed(runfile: str, args: Sequence[str], step: int):
+    # Jobs without a seed argument are not reproducible, so there the step identifies the sample
+    seed = named_args(runfile, args).get("seed")
+    return seed if seed is not None else f"step{step}"
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Add the results of a finished study to the result store.")
+    ap.add_argument("--manifest", required=True, help="Job manifest of the study (jobs.manifest)")
+    ap.add_argument("--study-dir", required=True, help="Directory with the study outputs (studies/<study>)")
+    ap.add_argument("--store", required=True, help="Result store directory")
+    ap.add_argument("--env-name", default="", help="Name of the environment tarball the study ran with")
+    ap.add_argument("--root", default=".", help="Directory containing scripts/ and data/ (default: .)")
+    args = ap.parse_args()
+
+    cache = ResultCache(args.store, root=args.root, env_name=args.env_name)
+    study_dir = Path(args.study_dir)
+    stored, incomplete = 0, 0
+    with JobManifest(args.manifest) as manifest:
+        for job in manifest:
+            outputs = expected_outputs(job.runfile, job.args)
+            job_hash = cache.job_hash(job.runfile, job.args, job_seed(job.runfile, job.args, job.step))
+            if cache.store_outputs(job_hash, study_dir / job.case / f"job_{job.step}", outputs):
+                stored += 1
+            else:
+                incomplete += 1
+    print(f"Stored {stored} job results in {args.store} ({incomplete} jobs without complete outputs)")
+
+
+if __name__ == "__main__":
+    main()
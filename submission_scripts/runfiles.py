@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+import hashlib
+import os
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+
+# What we know about the tracking scripts in scripts/, keyed on the runfile name.
+#   args:    names of the positional arguments of the script (after the runfile itself)
+#   upper:   arguments that the script converts to upper case before using them
+#   outputs: files written by every job, formatted with the (named or positional) arguments
+#   num_part, num_turns: size of the simulation, used to seed the runtime cost model (num_part
+#            can depend on the engine, with 'default' for the other engines)
+RUNFILES: Dict[str, Dict[str, Any]] = {
+    "fast_instability.py": {
+        "args": ["machine", "colldb", "plane", "phase", "engine", "seed"],
+        "upper": ["plane"],
+        "outputs": [
+            "lossmap_B1{plane}_ph{phase}.json",
+            "coll_summary_B1{plane}_ph{phase}.out",
+            "particles_dict_B1{plane}_ph{phase}.npz",
+        ],
+        "num_part": 5000,
+        "num_turns": 100,
+    },
+    "blowup.py": {
+        "args": ["machine", "colldb", "plane", "engine", "seed"],
+        "upper": ["plane"],
+        "outputs": ["lossmap_B1{plane}.json", "coll_summary_B1{plane}.out"],
+        "num_part": 100,
+        "num_turns": 1500,
+    },
+    "pencil.py": {
+        "args": ["machine", "colldb", "plane", "engine", "seed"],
+        "upper": ["plane"],
+        "outputs": ["lossmap_B1{plane}.json", "coll_summary_B1{plane}.out"],
+        "num_part": {"everest": 50000, "default": 5000},
+        "num_turns": 200,
+    },
+    "offmom.py": {
+        "args": ["machine", "colldb", "plane", "engine", "seed"],
+        "upper": [],
+        "outputs": ["lossmap_B1{plane}.json", "coll_summary_B1{plane}.out"],
+        "num_part": 1000,
+        "num_turns": 1500,
+    },
+}
+
+
+# Modules in scripts/ imported by the runfiles, which determine the job outputs as much as the
+# runfiles themselves, and the script that builds the prepared-line cache
+SCRIPT_HELPERS = ["scripts/prepared_line.py", "scripts/worker.py", "scripts/checkpoint.py",
+                  "scripts/timing.py"]
+PREPARE_RUNNER = "scripts/prepared_line.py"
+
+# Placeholders in the job arguments, replaced for every job by the step (JOBID) or by a
+# reproducible seed derived from the job (SEED)
+JOBID = "$JOBID"
+SEED = "$SEED"
+# Seeds are positive and fit in an int32, which all engines accept
+MAX_SEED = 2**31 - 1
+_MASK64 = 2**64 - 1
+
+# Scattering engines accepted by the scripts, and the one they use when none is given
+ENGINES = ["everest", "fluka", "geant4", "black"]
+DEFAULT_ENGINE = "geant4"
+
+
+@lru_cache(maxsize=None)
+def runfile_info(runfile: str) -> Optional[Dict[str, Any]]:
+    return RUNFILES.get(os.path.basename(runfile))
+
+
+def named_args(runfile: str, args: Sequence[str]) -> Dict[str, str]:
+    info = runfile_info(runfile)
+    if info is None:
+        return {}
+    named = {}
+    for name, value in zip(info["args"], args):
+        named[name] = value.upper() if name in info["upper"] else value
+    return named
+
+
+def expected_outputs(runfile: str, args: Sequence[str], entry: Optional[Dict[str, Any]] = None) -> List[str]:
+    # An entry in the jobs YAML can override the outputs with an 'outputs' list of templates
+    if entry is not None and "outputs" in entry:
+        templates = entry["outputs"]
+    else:
+        info = runfile_info(runfile)
+        if info is None:
+            raise ValueError(f"Unknown outputs for runfile '{runfile}': add an 'outputs' list to its entry")
+        templates = info["outputs"]
+    named = named_args(runfile, args)
+    return [str(tt).format(*args, **named) for tt in templates]
+
+
+def engine_of(runfile: str, args: Sequence[str]) -> str:
+    engine = named_args(runfile, args).get("engine", DEFAULT_ENGINE)
+    return engine if engine in ENGINES else DEFAULT_ENGINE
+
+
+@lru_cache(maxsize=65536)
+def arg_template(case: str, runfile: str, values: Tuple[Any, ...]) -> Tuple[Tuple[str, ...], Tuple[int, ...],
+                                                                           Tuple[int, ...], int]:
+    # The arguments of a combo of an entry as strings, with the positions of the $JobID and $Seed
+    # placeholders, and the hash prefix of the seeds of all its steps. Made once per combo, such that
+    # resolving the arguments of a step costs a few string assignments.
+    args = tuple(str(v) for v in values)
+    jobid_at = tuple(ii for ii, arg in enumerate(args) if arg.upper() == JOBID)
+    seed_at = tuple(ii for ii, arg in enumerate(args) if arg.upper() == SEED)
+    prefix = 0
+    if seed_at:
+        # Stable across runs and machines (unlike hash()), and independent of the position of
+        # the job in the jobs list
+        key = "|".join([case, os.path.basename(runfile),
+                        *(JOBID if ii in jobid_at else arg for ii, arg in enumerate(args) if ii not in seed_at)])
+        prefix = int(hashlib.sha256(key.encode()).hexdigest()[:16], 16)
+    return args, jobid_at, seed_at, prefix
+
+
+def derive_seed(prefix: int, step: int) -> int:
+    # Mix the step into the hash prefix of the combo (the splitmix64 finaliser), which is much
+    # cheaper than a hash per job and gives uncorrelated seeds for consecutive steps
+    z = (prefix + (step + 1) * 0x9E3779B97F4A7C15) & _MASK64
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return (z ^ (z >> 31)) % MAX_SEED + 1
+
+
+def fill_args(template: Tuple[Tuple[str, ...], Tuple[int, ...], Tuple[int, ...], int], step: int) -> List[str]:
+    # The arguments of a step from arg_template
+    args, jobid_at, seed_at, prefix = template
+    args = list(args)
+    for ii in jobid_at:
+        args[ii] = str(step)
+    if seed_at:
+        seed = str(derive_seed(prefix, step))
+        for ii in seed_at:
+            args[ii] = seed
+    return args
+
+
+def resolve_args(case: str, step: int, runfile: str, values: Sequence[Any]) -> List[str]:
+    return fill_args(arg_template(case, runfile, tuple(values)), step)
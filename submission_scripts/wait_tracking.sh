@@ -0,0 +1,11 @@
+#!/bin/bash
+
+# Usage: ./wait_tracking.sh STUDYNAME
+#
+# PRE script of the merge DAG (see results/merge_tree.py): returns when all tracking clusters of
+# the study (one log per submitted shard) are done, such that the merge starts on complete outputs.
+
+for log in submission.$1.*.log
+do
+    condor_wait "$log"
+done
@@ -2,6 +2,13 @@
 
 STUDYNAME=ExampleStudy
 JOBSFILE=example.jobs.yaml
+SHARDSIZE=50000   # Maximum number of jobs per submitted cluster (0 to submit everything as one cluster)
+RESUME=false      # Set to true to only resubmit the jobs whose outputs are missing in studies/${STUDYNAME}
+COSTDB=cost_model.json  # Measured runtimes to refine the cost model (see submission_scripts/cost_model.py), if present
+LONGESTFIRST=false # Submit the jobs with the longest predicted runtime first (within every shard)
+PREPARELINES=true # Build the collimated lines once here instead of in every job (see scripts/prepared_line.py)
+RESULTSTORE=''    # Result store to reuse the outputs of identical jobs of earlier studies (see submission_scripts/result_cache.py)
+MERGEFANIN=0      # Merge the job outputs in a tree of this fan-in as a DAG after the tracking (see results/merge_tree.py, 0 to not merge)
 
 ENVNAME=0.45.15_geant4
 environments=(geant4)
@@ -63,13 +70,33 @@ fi
 cd $STUDYPATH
 
 
+# Build the collimated lines once for the whole study, in the same environment as the jobs, into
+# data/prepared/ (such that they are spooled with data/)
+if [ "$PREPARELINES" = true ]
+then
+    echo "Preparing lines..."
+    (
+        cd $SPOOLPATH
+        rm -rf prepare_env
+        mkdir prepare_env
+        tar -xzf ${ENVPATH}$envfile -C prepare_env
+        source ${STUDYPATH}/submission_scripts/environment.sh "${environments[@]}"
+        source prepare_env/bin/activate
+        python ${STUDYPATH}/submission_scripts/prepare_lines.py --spec ${STUDYPATH}/$JOBSFILE --root ${STUDYPATH}
+        deactivate
+        rm -r prepare_env
+    )
+    echo
+fi
+
+
 # Spool the necessary files
 echo "Spooling files..."
 if [ -f ${SPOOLPATH}files_${STUDYNAME}.tar.gz ]
 then
     rm ${SPOOLPATH}files_${STUDYNAME}.tar.gz
 fi
-tar -C . -czf ${SPOOLPATH}files_${STUDYNAME}.tar.gz scripts data -C ${ENVPATH} $envfile -C ${STUDYPATH}/submission_scripts environment.sh
+tar -C . -czf ${SPOOLPATH}files_${STUDYNAME}.tar.gz scripts data results/postprocess.py results/merge_tree.py results/particle_store.py -C ${ENVPATH} $envfile -C ${STUDYPATH}/submission_scripts environment.sh
 echo
 
 
@@ -85,15 +112,51 @@ ln -fns $DIR $STUDYNAME
 cp submission_scripts/job.sh $DIR
 cp submission_scripts/submission.sub $DIR
 echo "Generating job list..."
-python submission_scripts/generate_jobs.py --spec $JOBSFILE --out ${DIR}jobs.list --preview
+genargs=(--spec $JOBSFILE --out ${DIR}jobs.list --shard-size $SHARDSIZE --preview)
+if [ "$RESUME" = true ]
+then
+    genargs+=(--resume ${STUDYPATH}/studies/${STUDYNAME})
+fi
+if [ -n "$RESULTSTORE" ]
+then
+    genargs+=(--result-store $RESULTSTORE --study-dir ${STUDYPATH}/studies/${STUDYNAME} --env-name $envfile)
+fi
+if [ -f "$COSTDB" ]
+then
+    genargs+=(--cost-db $COSTDB)
+fi
+if [ "$LONGESTFIRST" = true ]
+then
+    genargs+=(--longest-first)
+fi
+python submission_scripts/generate_jobs.py "${genargs[@]}"
 echo "Job list generated."
 echo
+if [ "$MERGEFANIN" -gt 0 ]
+then
+    echo "Planning merge tree..."
+    python results/merge_tree.py plan --index ${DIR}jobs.index.json --study-dir ${STUDYPATH}/studies/${STUDYNAME} --fanin $MERGEFANIN --out ${DIR}merge_graph.json \
+        --dag ${DIR}merge.dag --name $STUDYNAME --path $STUDYPATH
+    cp submission_scripts/merge.sub submission_scripts/wait_tracking.sh $DIR
+    echo
+fi
 
 cd $DIR
-if [ ${#environments[@]} -gt 0 ]
+ENV_LIST="${environments[*]}"
+# Every shard is submitted as a separate cluster, all in parallel, with its own submit macros from the index
+while read -r macros
+do
+    if [ ${#environments[@]} -gt 0 ]
+    then
+        condor_submit NAME="$STUDYNAME" PATH="$STUDYPATH" ENV_LIST="$ENV_LIST" $macros submission.sub &
+    else
+        condor_submit NAME="$STUDYNAME" PATH="$STUDYPATH" $macros submission.sub &
+    fi
+done < <(python -c "import json; [print(' '.join(f'{k}={v}' for k, v in s['macros'].items())) for s in json.load(open('jobs.index.json'))['shards']]")
+wait
+
+# The merge DAG waits for the tracking clusters itself (in the PRE script of its root node)
+if [ "$MERGEFANIN" -gt 0 ]
 then
-    ENV_LIST="${environments[*]}"
-    condor_submit NAME="$STUDYNAME" PATH="$STUDYPATH" ENV_LIST="$ENV_LIST" submission.sub
-else
-    condor_submit NAME="$STUDYNAME" PATH="$STUDYPATH" submission.sub
+    condor_submit_dag merge.dag
 fi